@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -19,6 +20,8 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 
 MEDIA_ROOT = BASE_DIR / 'WMS_MAIN/static'
 MEDIA_URL = '/media/'
+# Seconds browsers may reuse media that isn't content addressed, see WMS_MAIN/media.py
+MEDIA_MAX_AGE = 60 * 60
 
 
 # Quick-start development settings - unsuitable for production
@@ -55,16 +58,23 @@ MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'WMS_MAIN.media.MediaMiddleware',
+    'WMS_MAIN.instrumentation.InstrumentationMiddleware',
+    'WMS_MAIN.metrics.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'WMS_MAIN.tenants.TenantMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "whitenoise.middleware.WhiteNoiseMiddleware",
 ]
 
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedStaticFilesStorage'
+STORAGES = {
+    'default': {'BACKEND': 'WMS_MAIN.media.MediaStorage'},
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedStaticFilesStorage'},
+}
 
 CORS_ALLOWED_ORIGINS = [
     # FOR DEVELOPMENT SERVER TESTING ONLY
@@ -86,6 +96,11 @@ CORS_ALLOW_HEADERS = (
 
 CORS_ALLOW_CREDENTIALS = True 
 
+# lets the frontend read the order feeds' incremental polling cursor
+CORS_EXPOSE_HEADERS = (
+  "x-feed-cursor",
+)
+
 SESSION_COOKIE_SAMESITE = 'None'
 SESSION_COOKIE_SECURE = True
 # END FOR DEVELOPMENT SERVER TESTING ONLY
@@ -124,15 +139,38 @@ DATABASES = {
     #     'NAME': BASE_DIR / 'db.sqlite3',
     # }
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'WMS_MAIN.postgres_pool',
         'NAME': os.getenv('PGDATABASE'),
         'USER': os.getenv('PGUSER'),
         'PASSWORD': os.getenv('PGPASSWORD'),
         'HOST': os.getenv('PGHOST'),
         'PORT': os.getenv('PGPORT'),
+        'CONN_HEALTH_CHECKS': os.getenv('PGCONN_HEALTH_CHECKS', '1') == '1',
+        'OPTIONS': {},
     }
 }
 
+# Database connections, see WMS_MAIN/postgres_pool/base.py
+# PGPOOL=1 (the default) keeps a pool of up to PGPOOL_MAX_SIZE connections in each worker
+# process, reused by every request. Workers x PGPOOL_MAX_SIZE (plus the send_emails workers)
+# has to stay below Postgres' max_connections.
+# PGPOOL=0 opens a connection per thread instead, kept for PGCONN_MAX_AGE seconds. Only use it
+# with a WSGI server: under ASGI every request runs on a new thread and would open a new one.
+# libpq's own variables apply as well, e.g. PGCONNECT_TIMEOUT
+# SQLITE_PATH=<file> uses a SQLite database instead, e.g. for local load tests
+if os.getenv('SQLITE_PATH'):
+    DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / os.getenv('SQLITE_PATH')}}
+elif os.getenv('PGPOOL', '1') == '1':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'max_size': int(os.getenv('PGPOOL_MAX_SIZE', 10)),
+        'timeout': float(os.getenv('PGPOOL_TIMEOUT', 10)),
+        'max_idle': float(os.getenv('PGPOOL_MAX_IDLE', 300)),
+        'max_lifetime': float(os.getenv('PGPOOL_MAX_LIFETIME', 3600)),
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv('PGCONN_MAX_AGE', 60))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -178,7 +216,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'WMS_MAIN.authentication.CachedTokenAuthentication',
     ],
 }
 
@@ -188,3 +226,86 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_PASS')
+
+# Largest order a customer can place, one order item is written per unit
+ORDER_MAX_LINES = 100
+ORDER_MAX_QUANTITY = 50
+
+# How long deleted orders / order items are remembered for the order feeds' ?since= cursor.
+# Clients polling with an older cursor get a full resync
+ORDER_FEED_RETENTION_HOURS = int(os.getenv('ORDER_FEED_RETENTION_HOURS', 24))
+# How far before the cursor a poll looks again, longer than the order writes' transactions
+ORDER_FEED_CURSOR_OVERLAP_SECONDS = 10
+
+# Restaurant event stream (api/events/), see WMS_MAIN/events.py
+# The in process broker only reaches subscribers connected to the same worker process
+EVENT_BROKER = os.getenv('EVENT_BROKER', 'WMS_MAIN.events.InProcessBroker')
+EVENT_STREAM_HEARTBEAT_SECONDS = 15
+EVENT_STREAM_QUEUE_SIZE = 100
+
+# Seconds a restaurant's serialized menu is cached for, see WMS_MAIN/menus.py
+MENU_SNAPSHOT_TIMEOUT = 60 * 60
+
+# Resolved staff tokens kept in each worker process, see WMS_MAIN/authentication.py
+AUTH_TOKEN_CACHE_SIZE = 1024
+AUTH_TOKEN_CACHE_TTL = int(os.getenv('AUTH_TOKEN_CACHE_TTL', 60))
+
+# Stripe calls, see WMS_MAIN/payments.py
+load_dotenv(os.path.join(BASE_DIR, '.env'))
+STRIPE_API_KEY = os.getenv('STRIPE_KEY')
+# e.g. http://127.0.0.1:12111 to use the fake Stripe (python manage.py fake_stripe)
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+STRIPE_MAX_CONCURRENCY = int(os.getenv('STRIPE_MAX_CONCURRENCY', 10))
+STRIPE_TIMEOUT = 10
+STRIPE_MAX_RETRIES = 2
+STRIPE_CALL_TIMEOUT = 30
+# Seconds a restaurant's stored Stripe onboarding state is used before asking Stripe again,
+# Stripe's account.updated webhook (api/v1/webhook/) keeps it current in between
+STRIPE_ACCOUNT_STATUS_TTL = 5 * 60
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+# Seconds a table's checkout URL is reused while its bill doesn't change
+STRIPE_CHECKOUT_CACHE_TIMEOUT = 30 * 60
+
+# Email outbox, see WMS_MAIN/outbox.py (sent by python manage.py send_emails)
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_SECONDS = 60
+# how long a worker has to send the batch it claimed before other workers can claim it again
+EMAIL_OUTBOX_LEASE_SECONDS = 10 * 60
+
+# Menu image processing, see WMS_MAIN/images.py
+MENU_IMAGE_MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+MENU_IMAGE_MAX_PIXELS = 80_000_000
+MENU_IMAGE_MAX_SIZE = 1600
+MENU_IMAGE_WIDTHS = [320, 640, 960]
+MENU_IMAGE_QUALITY = 82
+MENU_IMAGE_WORKERS = 2
+
+# Per view query and latency instrumentation (Server-Timing, logs and api/stats/), see
+# WMS_MAIN/instrumentation.py. Off unless INSTRUMENTATION=1
+INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION') == '1'
+# latest request durations kept per view for the percentiles
+INSTRUMENTATION_SAMPLES = 1000
+# the same SQL this many times in one request is logged as a likely N+1
+INSTRUMENTATION_SIMILAR_QUERIES = 5
+
+# Operational metrics (request durations, orders, kitchen and assistance times, Stripe calls)
+# served in Prometheus' text format by api/metrics/, see WMS_MAIN/metrics.py. On unless
+# METRICS=0, the endpoint answers only with METRICS_TOKEN set, sent as a bearer token
+METRICS_ENABLED = os.getenv('METRICS', '1') == '1'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# where the workers of the host write their metrics to be summed, local to the host
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'wms-metrics'))
+METRICS_FLUSH_SECONDS = 5
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # one JSON line per request when the instrumentation is enabled
+        'WMS_MAIN.instrumentation': {'handlers': ['console'], 'level': 'INFO' if INSTRUMENTATION_ENABLED else 'WARNING', 'propagate': False},
+    },
+}
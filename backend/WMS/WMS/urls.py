@@ -17,8 +17,6 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from WMS_MAIN.views import CustomPasswordResetDoneView, CustomPasswordResetView
-from django.conf import settings
-from django.conf.urls.static import static
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -26,4 +24,4 @@ urlpatterns = [
     # password reset pages (to be moved to the root)
     path('password-change/<str:token>/', CustomPasswordResetView.as_view(), name='password-change'),
     path('completed-password-change/', CustomPasswordResetDoneView.as_view(), name='completed-password-change'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
@@ -2,5 +2,4 @@
 
 default_app_config = 'WMS_MAIN.apps.WmsMainConfig'
 
-# Import the signals module
-from . import signals
\ No newline at end of file
+# The signals module is imported in WmsMainConfig.ready() once the models are loaded
@@ -0,0 +1,81 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+# Cached token authentication
+# Staff screens poll every few seconds, so resolving token -> user -> restaurant user ->
+# restaurant is done with one select_related query and then kept in a bounded in-process
+# LRU cache for settings.AUTH_TOKEN_CACHE_TTL seconds.
+# Entries are dropped when the token is deleted (logout) and when the user or their
+# restaurant user (role) changes, see the receivers in signals.py. Other worker processes
+# keep their own cache, so a change reaches them within the TTL at the latest.
+
+# A thread-safe least recently used cache whose entries expire after ttl seconds
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    # Drops every entry whose value matches the predicate
+    def delete_where(self, predicate):
+        with self.lock:
+            for key in [key for key, (_, value) in self.entries.items() if predicate(value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+token_cache = TTLCache(settings.AUTH_TOKEN_CACHE_SIZE, settings.AUTH_TOKEN_CACHE_TTL)
+
+def invalidate_token(key):
+    token_cache.delete(key)
+
+def invalidate_user(user_id):
+    token_cache.delete_where(lambda token: token.user_id == user_id)
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            try:
+                token = Token.objects.select_related('user__restaurantuser__restaurant').get(key=key)
+            except Token.DoesNotExist:
+                raise AuthenticationFailed('Invalid token.')
+            token_cache.set(key, token)
+
+        # every request gets its own copy, views may change the instances they are given
+        token = copy.deepcopy(token)
+        if not token.user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        return (token.user, token)
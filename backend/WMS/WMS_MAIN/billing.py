@@ -0,0 +1,47 @@
+from django.db.models import Count, F, Sum
+from .models import OrderItem
+from .serializers import OrderItemSerializer
+
+# Bill computation shared by BillAPIView, StaffBillAPIView and StripeCheckout
+# The bill is grouped and summed in the database, so it costs the same number of
+# queries however many order items the table has:
+# {
+#     'table_number': 1,
+#     'lines': [
+#         {'menu_item': 1, 'name': 'Beer', 'price': Decimal('8.00'), 'quantity': 10, 'subtotal': Decimal('80.00')},
+#         ...
+#     ],                                (sorted by menu item name)
+#     'bill_total': Decimal('80.00')
+# }
+
+def table_order_items(restaurant, table_number):
+    return OrderItem.objects.filter(order__customer_session__restaurant=restaurant, order__customer_session__table_number=table_number)
+
+# One query, grouped by menu item
+def bill_lines(restaurant, table_number):
+    lines = table_order_items(restaurant, table_number).values('menu_item').annotate(
+        name=F('menu_item__name'),
+        price=F('menu_item__price'),
+        quantity=Count('id'),
+        subtotal=Sum('menu_item__price'),
+    ).order_by('name', 'menu_item')
+    return list(lines)
+
+def compute_bill(restaurant, table_number):
+    lines = bill_lines(restaurant, table_number)
+    return {
+        'table_number': table_number,
+        'lines': lines,
+        'bill_total': sum(line['subtotal'] for line in lines),
+    }
+
+# The bill response of BillAPIView and StaffBillAPIView. 'order_list' (one entry per
+# order item, sorted by menu item name) is kept for the frontend, which groups it itself.
+# Returns None if the table has no orders
+def bill_response_data(restaurant, table_number):
+    bill = compute_bill(restaurant, table_number)
+    if not bill['lines']:
+        return None
+    order_items = table_order_items(restaurant, table_number).order_by('menu_item__name', 'id')
+    bill['order_list'] = OrderItemSerializer(order_items, many=True).data
+    return bill
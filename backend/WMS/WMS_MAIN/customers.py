@@ -0,0 +1,38 @@
+from django.utils import timezone
+from .metrics import ASSISTANCE_WAIT
+from .models import CustomerSession
+
+# Per-request customer session resolver
+# Customers are identified by their django session key. Their CustomerSession, with its
+# restaurant, is looked up once per request through the unique session key index and then
+# reused by every view and helper handling the request.
+
+# Returns the request's CustomerSession, or None if the caller isn't seated at a table
+def get_customer_session(request):
+    # the cache is kept on the HttpRequest, which DRF's Request wraps
+    request = getattr(request, '_request', request)
+    if not hasattr(request, '_customer_session'):
+        customer_session = None
+        if session_key := request.session.session_key:
+            try:
+                customer_session = CustomerSession.objects.select_related('restaurant').get(session=session_key)
+            except CustomerSession.DoesNotExist:
+                pass
+        request._customer_session = customer_session
+    return request._customer_session
+
+# Updates the cached CustomerSession after it is created or deleted during the request
+def set_customer_session(request, customer_session):
+    getattr(request, '_request', request)._customer_session = customer_session
+
+# Sets whether the table needs assistance, the time it waited is recorded when it's cleared
+def set_need_assistance(customer_session, need_assistance):
+    now = timezone.now()
+    if need_assistance and not customer_session.need_assistance:
+        customer_session.assistance_requested_at = now
+    elif not need_assistance and customer_session.need_assistance:
+        if customer_session.assistance_requested_at is not None:
+            ASSISTANCE_WAIT.observe((now - customer_session.assistance_requested_at).total_seconds())
+        customer_session.assistance_requested_at = None
+    customer_session.need_assistance = need_assistance
+    customer_session.save(update_fields=['need_assistance', 'assistance_requested_at'])
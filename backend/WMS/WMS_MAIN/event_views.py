@@ -0,0 +1,76 @@
+import asyncio
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.authtoken.models import Token
+from .events import get_broker
+
+# Server-sent event stream of a restaurant's events (see events.py)
+# Needs the ASGI application (WMS/asgi.py), a WSGI worker cannot hold the connection open.
+# Request:
+#   - Method: GET
+#   - token (string)   => staff token, as a query parameter because EventSource
+#                         cannot set headers, or in the Authorization header
+# Response:
+#   - Status 200: a text/event-stream of
+#         event: order_placed
+#         data: {"type": "order_placed", "restaurant": 1, "data": {"order_id": 1, "table_number": 1}}
+#     plus a keepalive comment every settings.EVENT_STREAM_HEARTBEAT_SECONDS and a
+#     resync event if events had to be dropped (refetch the order feeds)
+#   - Status 401: if the token is invalid or does not belong to a staff member
+# Example usage:
+#   const events = new EventSource(`${backendApi}/api/events/?token=${token}`)
+#   events.addEventListener('order_placed', (e) => ...)
+async def event_stream(request):
+    key = request.GET.get('token')
+    if key is None:
+        key = request.headers.get('Authorization', '').removeprefix('Token ').strip()
+    restaurant_id = await staff_restaurant_id(key)
+    if restaurant_id is None:
+        return JsonResponse({'error': 'Invalid token'}, status=401)
+
+    broker = get_broker()
+    subscription = broker.subscribe(restaurant_id)
+    response = StreamingHttpResponse(stream(broker, subscription), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # stop reverse proxies from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@sync_to_async
+def staff_restaurant_id(key):
+    if not key:
+        return None
+    try:
+        token = Token.objects.select_related('user__restaurantuser').get(key=key)
+    except Token.DoesNotExist:
+        return None
+    finally:
+        # the stream stays open for hours, it mustn't hold on to a pooled database connection
+        if not connection.in_atomic_block:
+            connection.close()
+    if not hasattr(token.user, 'restaurantuser'):
+        return None
+    return token.user.restaurantuser.restaurant_id
+
+async def stream(broker, subscription):
+    try:
+        yield 'retry: 3000\n\n'
+        while True:
+            try:
+                event = await subscription.get(settings.EVENT_STREAM_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            if subscription.overflowed:
+                subscription.overflowed = False
+                yield 'event: resync\ndata: {}\n\n'
+            yield format_event(event)
+    finally:
+        # the client disconnected
+        broker.unsubscribe(subscription)
+
+def format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
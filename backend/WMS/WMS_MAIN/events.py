@@ -0,0 +1,92 @@
+import asyncio
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+# Restaurant event fan-out
+# Views publish events for a restaurant and staff screens subscribe to them through
+# the event stream (see event_views.py) instead of polling the database.
+#
+# Event format:
+# {
+#     'type': 'order_placed' | 'order_item_status' | 'assistance' | 'table_occupancy',
+#     'restaurant': 1,
+#     'data': {...}
+# }
+#
+# The broker used is settings.EVENT_BROKER. Any class with the same
+# subscribe / unsubscribe / publish methods can replace the default in process
+# broker, e.g. a message broker backed one for multiple worker processes or a
+# local stand-in in tests.
+
+ORDER_PLACED = 'order_placed'
+ORDER_ITEM_STATUS = 'order_item_status'
+ASSISTANCE = 'assistance'
+TABLE_OCCUPANCY = 'table_occupancy'
+
+# A subscriber's queue of events, owned by the event loop that subscribed
+class Subscription:
+    def __init__(self, restaurant_id, maxsize):
+        self.restaurant_id = restaurant_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+        # set when events had to be dropped, the subscriber should resync from the order feeds
+        self.overflowed = False
+
+    # runs on the subscriber's event loop
+    def deliver(self, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.overflowed = True
+        self.queue.put_nowait(event)
+
+    # waits up to timeout seconds for the next event, raises asyncio.TimeoutError otherwise
+    async def get(self, timeout):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+# Fans events out to the subscribers of this process only.
+# publish() can be called from any thread (e.g. sync views run in a thread pool under ASGI)
+class InProcessBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(set)
+
+    def subscribe(self, restaurant_id):
+        subscription = Subscription(restaurant_id, settings.EVENT_STREAM_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers[restaurant_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.restaurant_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[subscription.restaurant_id]
+
+    def publish(self, restaurant_id, event):
+        with self.lock:
+            subscribers = list(self.subscribers.get(restaurant_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+            except RuntimeError:
+                # the subscriber's event loop has been closed
+                self.unsubscribe(subscription)
+
+_brokers = {}
+
+# Returns the broker configured by settings.EVENT_BROKER, one instance per process
+def get_broker():
+    path = settings.EVENT_BROKER
+    if path not in _brokers:
+        _brokers[path] = import_string(path)()
+    return _brokers[path]
+
+# Publishes an event to the restaurant's subscribers once the current transaction commits
+def publish(restaurant_id, event_type, **data):
+    event = {'type': event_type, 'restaurant': restaurant_id, 'data': data}
+    transaction.on_commit(lambda: get_broker().publish(restaurant_id, event))
@@ -0,0 +1,129 @@
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+# Fake Stripe API for offline tests and benchmarks
+# Answers the handful of endpoints the Stripe views use, after an injected latency and with an
+# optional share of 503s (which the gateway retries):
+#   POST /v1/accounts                   => {'id': 'acct_1', 'object': 'account', ...}
+#   GET  /v1/accounts/<id>              => the account
+#   POST /v1/account_links              => {'object': 'account_link', 'url': ...}
+#   POST /v1/checkout/sessions          => {'id': 'cs_1', 'object': 'checkout.session', 'url': ...}
+# Requests repeating an Idempotency-Key get the first response back, as from Stripe.
+# Example usage:
+#   with FakeStripe(latency=0.2) as fake:
+#       ... settings.STRIPE_API_BASE = fake.url
+class FakeStripe:
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.accounts = {}
+        self.idempotent_responses = {}
+        # (method, path) of every request received, retries included
+        self.requests = []
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Returns (status, body) for a request
+    def respond(self, method, path, params, idempotency_key):
+        with self.lock:
+            self.requests.append((method, path))
+            if idempotency_key and idempotency_key in self.idempotent_responses:
+                return self.idempotent_responses[idempotency_key]
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, {'error': {'type': 'api_error', 'message': 'Injected failure'}}
+
+        with self.lock:
+            response = self.route(method, path, params)
+            if idempotency_key and response[0] == 200:
+                self.idempotent_responses[idempotency_key] = response
+            return response
+
+    def route(self, method, path, params):
+        if method == 'POST' and path == '/v1/accounts':
+            account = {
+                'id': f'acct_{next(self.ids)}',
+                'object': 'account',
+                'type': params.get('type', 'express'),
+                'details_submitted': False,
+                'charges_enabled': False,
+            }
+            self.accounts[account['id']] = account
+            return 200, account
+        if method == 'GET' and path.startswith('/v1/accounts/'):
+            account = self.accounts.get(path.removeprefix('/v1/accounts/'))
+            if account is None:
+                return 404, {'error': {'type': 'invalid_request_error', 'message': 'No such account'}}
+            return 200, account
+        if method == 'POST' and path == '/v1/account_links':
+            return 200, {
+                'object': 'account_link',
+                'url': f"https://connect.stripe.test/setup/{params.get('account')}",
+            }
+        if method == 'POST' and path == '/v1/checkout/sessions':
+            session_id = f'cs_{next(self.ids)}'
+            return 200, {
+                'id': session_id,
+                'object': 'checkout.session',
+                'mode': params.get('mode'),
+                'url': f'https://checkout.stripe.test/pay/{session_id}',
+            }
+        return 404, {'error': {'type': 'invalid_request_error', 'message': f'Unrecognized request URL ({method}: {path})'}}
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.handle_api('GET')
+
+            def do_POST(self):
+                self.handle_api('POST')
+
+            def handle_api(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                params = dict(parse_qsl(self.rfile.read(length).decode())) if length else {}
+                path = self.path.split('?', 1)[0]
+                status, body = fake.respond(method, path, params, self.headers.get('Idempotency-Key'))
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,171 @@
+from datetime import timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db.models import F, Prefetch, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework import status
+from .models import FeedTombstone, Order, OrderItem
+from .serializers import OrderSerializer, OrderItemSerializer
+
+# Builds the nested order payload used by the kitchen/manager order screens:
+# [
+#     {
+#         'order': {'customer_session': 1, 'order_time': '12:00:00'},
+#         'order_items': [OrderItem, OrderItem, ...],   (sorted by menu item name)
+#         'table_number': 1,
+#         'order_id': 1
+#     },
+#     ...
+# ]
+# The payload is built from exactly two queries regardless of how many orders
+# there are: one for the orders (with the table number annotated from the
+# customer session) and one prefetch for all of their order items.
+
+# Attaches the table number and the name-ordered order items to an Order queryset
+def with_order_items(queryset):
+    item_queryset = OrderItem.objects.order_by('menu_item__name', 'id')
+    return queryset.annotate(
+        table_number=F('customer_session__table_number'),
+    ).prefetch_related(
+        Prefetch('orderitem_set', queryset=item_queryset, to_attr='feed_items'),
+    )
+
+# Serializes a queryset prepared by with_order_items into the nested payload
+def serialize_order_feed(queryset):
+    orders = list(queryset)
+    order_data = OrderSerializer(orders, many=True).data
+    return [
+        {
+            'order': data,
+            'order_items': OrderItemSerializer(order.feed_items, many=True).data,
+            'table_number': order.table_number,
+            'order_id': order.id
+        }
+        for order, data in zip(orders, order_data)
+    ]
+
+def build_order_feed(queryset):
+    return serialize_order_feed(with_order_items(queryset))
+
+# Incremental polling
+# The order feeds (allorders/, orders/, orderitems/) accept an optional ?since=<cursor>
+# query parameter. Every feed response carries the cursor for the next poll in the
+# X-Feed-Cursor header.
+#   - without ?since= the response body is unchanged (the full list)
+#   - with ?since= the response body is
+#     {
+#         'changed': [...],   (rows created or updated after the cursor, same shape as the full list)
+#         'deleted': [1, 2],  (primary keys of rows deleted after the cursor)
+#         'cursor': '2024-06-01T12:00:00.000000Z',
+#         'reset': False
+#     }
+#   - if the cursor is older than settings.ORDER_FEED_RETENTION_HOURS the deletions are
+#     no longer known, so 'changed' holds the full list and 'reset' is True
+# The cursor is the time of the poll, but updated_at is set when a row is written, before its
+# transaction commits: a row written just before a poll and committed just after it would be
+# older than the next cursor. The feeds go back settings.ORDER_FEED_CURSOR_OVERLAP_SECONDS
+# before the cursor, so rows seen by the previous poll can come again and clients replace them
+# by primary key.
+FEED_CURSOR_HEADER = 'X-Feed-Cursor'
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+class FeedCursor:
+    def __init__(self, request):
+        self.now = timezone.now()
+        self.since = self.parse(request.query_params.get('since'))
+        retention = timedelta(hours=settings.ORDER_FEED_RETENTION_HOURS)
+        self.reset = self.since is not None and self.since < self.now - retention
+
+    def parse(self, value):
+        if value is None:
+            return None
+        since = parse_datetime(value)
+        if since is None:
+            raise ValidationError({'since': 'Invalid cursor'})
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since, dt_timezone.utc)
+        return since
+
+    @property
+    def incremental(self):
+        return self.since is not None and not self.reset
+
+    # rows written after this, committed or not when the cursor was made
+    @property
+    def window_start(self):
+        return self.since - timedelta(seconds=settings.ORDER_FEED_CURSOR_OVERLAP_SECONDS)
+
+    # Filters an OrderItem (or any model with updated_at) queryset down to the changed rows
+    def changed(self, queryset):
+        if not self.incremental:
+            return queryset
+        return queryset.filter(updated_at__gt=self.window_start)
+
+    # Orders also count as changed when any of their order items changed status
+    def changed_orders(self, queryset):
+        if not self.incremental:
+            return queryset
+        # only the order items of the queryset's orders, not those of every restaurant
+        changed_items = OrderItem.objects.filter(order__in=queryset, updated_at__gt=self.window_start).values('order_id')
+        return queryset.filter(Q(updated_at__gt=self.window_start) | Q(id__in=changed_items))
+
+    def deleted(self, model_name, **filters):
+        if not self.incremental:
+            return []
+        tombstones = FeedTombstone.objects.filter(model_name=model_name, deleted_at__gt=self.window_start, **filters)
+        return list(tombstones.values_list('object_id', flat=True))
+
+    def response(self, data, deleted=None):
+        cursor = self.now.astimezone(dt_timezone.utc).strftime(CURSOR_FORMAT)
+        if self.since is None:
+            response = Response(data, status=status.HTTP_200_OK)
+        else:
+            response = Response({
+                'changed': data,
+                'deleted': deleted or [],
+                'cursor': cursor,
+                'reset': self.reset
+            }, status=status.HTTP_200_OK)
+        response[FEED_CURSOR_HEADER] = cursor
+        return response
+
+# Records tombstones for the given orders and all of their order items, then prunes
+# tombstones of the restaurant that are past the retention window
+def record_deleted_orders(orders, restaurant_id, table_number):
+    order_ids = list(orders.values_list('id', flat=True))
+    if not order_ids:
+        return
+    item_ids = OrderItem.objects.filter(order__in=order_ids).values_list('id', flat=True)
+    now = timezone.now()
+    tombstones = [
+        FeedTombstone(restaurant_id=restaurant_id, table_number=table_number, model_name='order', object_id=pk, deleted_at=now)
+        for pk in order_ids
+    ] + [
+        FeedTombstone(restaurant_id=restaurant_id, table_number=table_number, model_name='orderitem', object_id=pk, deleted_at=now)
+        for pk in item_ids
+    ]
+    FeedTombstone.objects.bulk_create(tombstones)
+    prune_tombstones(restaurant_id, now)
+
+# Records tombstones for order items deleted on their own, with their menu item, and marks
+# their orders changed so the feeds send them again without the order items
+def record_deleted_order_items(order_items):
+    rows = list(order_items.filter(order__customer_session__isnull=False).values_list(
+        'id', 'order_id', 'order__customer_session__restaurant_id', 'order__customer_session__table_number',
+    ))
+    if not rows:
+        return
+    now = timezone.now()
+    FeedTombstone.objects.bulk_create([
+        FeedTombstone(restaurant_id=restaurant_id, table_number=table_number, model_name='orderitem', object_id=pk, deleted_at=now)
+        for pk, _, restaurant_id, table_number in rows
+    ])
+    Order.objects.filter(id__in={order_id for _, order_id, _, _ in rows}).update(updated_at=now)
+    for restaurant_id in {restaurant_id for _, _, restaurant_id, _ in rows}:
+        prune_tombstones(restaurant_id, now)
+
+def prune_tombstones(restaurant_id, now):
+    retention = timedelta(hours=settings.ORDER_FEED_RETENTION_HOURS)
+    FeedTombstone.objects.filter(restaurant_id=restaurant_id, deleted_at__lt=now - retention).delete()
@@ -0,0 +1,131 @@
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from PIL import Image, ImageOps, UnidentifiedImageError
+from rest_framework.exceptions import ValidationError
+from .models import MenuItem
+from .menus import bump_menu_version
+
+logger = logging.getLogger(__name__)
+
+# Menu image pipeline
+# Uploads are only validated in the request. Once the menu item is saved the image is processed
+# on a pool of settings.MENU_IMAGE_WORKERS threads:
+#   - rotated upright from its EXIF orientation, downscaled to fit settings.MENU_IMAGE_MAX_SIZE
+#     and re-encoded as JPEG, which drops its metadata (EXIF, GPS, ICC, comments)
+#   - resized to each of settings.MENU_IMAGE_WIDTHS as JPEG and WebP
+#   - stored under names derived from the processed image's content, menu_images/<hash>.jpg
+#     and menu_images/<hash>-<width>.jpg / .webp, so a name never changes content
+# MenuItem.image is then switched to the processed image, MenuItem.image_variants lists the
+# sizes and the menu version is bumped. Until then the serializer serves the upload as it is.
+
+DEFAULT_IMAGE = 'menu_images/default_img.png'
+FORMATS = {'JPEG', 'PNG', 'WEBP', 'GIF'}
+
+# Raises a ValidationError unless the upload is an image we can process
+def validate_menu_image(file):
+    if file.size > settings.MENU_IMAGE_MAX_UPLOAD_BYTES:
+        raise ValidationError(f'Images can be at most {settings.MENU_IMAGE_MAX_UPLOAD_BYTES // (1024 * 1024)} MB')
+    try:
+        file.seek(0)
+        with Image.open(file) as image:
+            image_format, (width, height) = image.format, image.size
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        raise ValidationError('Upload a valid JPEG, PNG, WebP or GIF image')
+    finally:
+        file.seek(0)
+    if image_format not in FORMATS:
+        raise ValidationError('Upload a valid JPEG, PNG, WebP or GIF image')
+    if width * height > settings.MENU_IMAGE_MAX_PIXELS:
+        raise ValidationError('The image has too many pixels')
+
+# JPEG has no transparency, transparent areas become white
+def flatten(image):
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+def encode(image, image_format):
+    output = BytesIO()
+    if image_format == 'JPEG':
+        image.save(output, 'JPEG', quality=settings.MENU_IMAGE_QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(output, 'WEBP', quality=settings.MENU_IMAGE_QUALITY, method=4)
+    return output.getvalue()
+
+# Returns {'image': (name, bytes), 'variants': [{'width': ..., 'jpeg': (name, bytes), 'webp': (name, bytes)}, ...]}
+def process_image(file):
+    with Image.open(file) as image:
+        # JPEGs are decoded at a reduced scale straight away when they are much larger
+        image.draft('RGB', (settings.MENU_IMAGE_MAX_SIZE, settings.MENU_IMAGE_MAX_SIZE))
+        image = flatten(ImageOps.exif_transpose(image))
+    image.thumbnail((settings.MENU_IMAGE_MAX_SIZE, settings.MENU_IMAGE_MAX_SIZE), Image.LANCZOS)
+    original = encode(image, 'JPEG')
+    digest = hashlib.sha256(original).hexdigest()[:20]
+
+    variants = []
+    for width in sorted(settings.MENU_IMAGE_WIDTHS):
+        if width >= image.width and variants:
+            break
+        resized = image if width >= image.width else image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        variants.append({
+            'width': resized.width,
+            'jpeg': (f'menu_images/{digest}-{resized.width}.jpg', encode(resized, 'JPEG')),
+            'webp': (f'menu_images/{digest}-{resized.width}.webp', encode(resized, 'WEBP')),
+        })
+    return {'image': (f'menu_images/{digest}.jpg', original), 'variants': variants}
+
+# Content addressed, the storage keeps a file that already exists (see media.py)
+def store(storage, name, data):
+    return storage.save(name, ContentFile(data))
+
+def process_menu_item_image(menu_item_id):
+    item = MenuItem.objects.filter(id=menu_item_id).values('image', 'restaurant_id').first()
+    if item is None or not item['image'] or item['image'] == DEFAULT_IMAGE:
+        return
+    storage = MenuItem._meta.get_field('image').storage
+    upload = item['image']
+    with storage.open(upload) as file:
+        processed = process_image(file)
+
+    image = store(storage, *processed['image'])
+    variants = [
+        {'width': variant['width'], 'jpeg': store(storage, *variant['jpeg']), 'webp': store(storage, *variant['webp'])}
+        for variant in processed['variants']
+    ]
+    # unless another image was uploaded in the meantime
+    if MenuItem.objects.filter(id=menu_item_id, image=upload).update(image=image, image_variants=variants):
+        bump_menu_version(item['restaurant_id'])
+        if upload != image and not MenuItem.objects.filter(image=upload).exists():
+            storage.delete(upload)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.MENU_IMAGE_WORKERS, thread_name_prefix='menu-images')
+        return _executor
+
+def run_in_background(menu_item_id):
+    try:
+        process_menu_item_image(menu_item_id)
+    except Exception:
+        logger.exception('Processing the image of menu item %s failed', menu_item_id)
+    finally:
+        # the pool's threads aren't request threads, nothing else closes their connection
+        connection.close()
+
+# Processes the menu item's image off the request thread once the transaction commits
+def schedule_image_processing(menu_item_id):
+    transaction.on_commit(lambda: get_executor().submit(run_in_background, menu_item_id))
@@ -0,0 +1,166 @@
+import json
+import math
+import logging
+import threading
+import time
+from collections import Counter, deque
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Per view request instrumentation
+# With settings.INSTRUMENTATION_ENABLED (INSTRUMENTATION=1) InstrumentationMiddleware records,
+# for every request, the number of queries and the time spent in them, the queries repeated
+# with the same parameters (duplicates), the response's rendering (serialization) time and its
+# size. Each request gets a JSON log line and is added to the statistics of its view, keyed
+# by the url name of WMS_MAIN/urls.py (e.g. 'all-orders'). Only staff users' responses get a
+# Server-Timing header, it would tell anyone else how many queries a request makes.
+# The same SQL run settings.INSTRUMENTATION_SIMILAR_QUERIES times or more in one request is
+# logged as a likely N+1.
+# The statistics are per worker process, cover every restaurant and are served to staff users
+# by api/stats/.
+# Disabled, the middleware removes itself from the stack and costs nothing.
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = []
+        self.sql_seconds = 0
+        self.render_seconds = 0
+
+    # connection.execute_wrapper() hook, times every query
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_seconds += time.perf_counter() - start
+            self.queries.append((sql, repr(params)))
+
+    def duplicates(self):
+        return len(self.queries) - len(set(self.queries))
+
+    # (sql, times) of the SQL run the most times, with any parameters
+    def most_similar(self):
+        counts = Counter(sql for sql, _ in self.queries)
+        return counts.most_common(1)[0] if counts else (None, 0)
+
+class ViewStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.sql_seconds = 0
+        self.duplicates = 0
+        self.n_plus_one = 0
+        self.render_seconds = 0
+        self.bytes = 0
+        # latest durations, for the percentiles
+        self.durations = deque(maxlen=settings.INSTRUMENTATION_SAMPLES)
+
+    def add(self, status, seconds, stats, size, n_plus_one):
+        self.requests += 1
+        self.errors += status >= 500
+        self.seconds += seconds
+        self.queries += len(stats.queries)
+        self.max_queries = max(self.max_queries, len(stats.queries))
+        self.sql_seconds += stats.sql_seconds
+        self.duplicates += stats.duplicates()
+        self.n_plus_one += n_plus_one
+        self.render_seconds += stats.render_seconds
+        self.bytes += size or 0
+        self.durations.append(seconds)
+
+    def summary(self):
+        durations = sorted(self.durations)
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'mean_ms': round(self.seconds / self.requests * 1000, 2),
+            'p50_ms': round(durations[(len(durations) - 1) // 2] * 1000, 2),
+            'p95_ms': round(durations[math.ceil(len(durations) * 0.95) - 1] * 1000, 2),
+            'mean_queries': round(self.queries / self.requests, 1),
+            'max_queries': self.max_queries,
+            'mean_sql_ms': round(self.sql_seconds / self.requests * 1000, 2),
+            'duplicate_queries': self.duplicates,
+            'n_plus_one_requests': self.n_plus_one,
+            'mean_render_ms': round(self.render_seconds / self.requests * 1000, 2),
+            'mean_bytes': round(self.bytes / self.requests),
+        }
+
+_views = {}
+_lock = threading.Lock()
+
+# {view name: summary} of the requests seen by this process
+def snapshot():
+    with _lock:
+        return {name: stats.summary() for name, stats in sorted(_views.items())}
+
+def reset():
+    with _lock:
+        _views.clear()
+
+def record(view_name, status, seconds, stats, size, n_plus_one):
+    with _lock:
+        if view_name not in _views:
+            _views[view_name] = ViewStats()
+        _views[view_name].add(status, seconds, stats, size, n_plus_one)
+
+class InstrumentationMiddleware:
+    def __init__(self, get_response):
+        if not settings.INSTRUMENTATION_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = request.instrumentation = RequestStats()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+        seconds = time.perf_counter() - stats.started
+
+        match = request.resolver_match
+        view_name = match.view_name if match else '<unresolved>'
+        size = None if response.streaming else len(response.content)
+        sql, similar = stats.most_similar()
+        n_plus_one = similar >= settings.INSTRUMENTATION_SIMILAR_QUERIES
+        record(view_name, response.status_code, seconds, stats, size, n_plus_one)
+
+        # set on the request by the authentication, DRF's included
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_staff:
+            response['Server-Timing'] = ', '.join([
+                f'app;dur={seconds * 1000:.2f}',
+                f'db;dur={stats.sql_seconds * 1000:.2f};desc="{len(stats.queries)} queries, {stats.duplicates()} duplicated"',
+                f'render;dur={stats.render_seconds * 1000:.2f}',
+            ])
+        logger.info(json.dumps({
+            'view': view_name,
+            'method': request.method,
+            'status': response.status_code,
+            'ms': round(seconds * 1000, 2),
+            'queries': len(stats.queries),
+            'sql_ms': round(stats.sql_seconds * 1000, 2),
+            'duplicates': stats.duplicates(),
+            'render_ms': round(stats.render_seconds * 1000, 2),
+            'bytes': size,
+        }))
+        if n_plus_one:
+            logger.warning(json.dumps({'n_plus_one': view_name, 'times': similar, 'sql': sql[:500]}))
+        return response
+
+    # DRF's responses are rendered after the view returns, time it separately
+    def process_template_response(self, request, response):
+        stats = request.instrumentation
+        started = time.perf_counter()
+
+        def rendered(response):
+            stats.render_seconds += time.perf_counter() - started
+        response.add_post_render_callback(rendered)
+        return response
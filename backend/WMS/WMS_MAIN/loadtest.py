@@ -0,0 +1,187 @@
+import math
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from .models import Restaurant, RestaurantUser, Table, Category, MenuItem, CustomerSession, Order, OrderItem
+
+# Load tests of the customer and kitchen hot paths
+# seed() fills the database with restaurants like production ones, dinner_rush() plays a dinner
+# rush against one of them through the whole request stack (middleware, authentication, views)
+# and records every request's latency and queries, report() sums them up per endpoint.
+# The seeded restaurants are marked with LOCATION and can be removed with flush().
+# Example usage (see the seed_load_test and load_test commands):
+#   seed(restaurants=10, tables=20, orders=5)
+#   recorder = Recorder()
+#   for restaurant_id in load_test_restaurants():
+#       dinner_rush(restaurant_id, recorder)
+#   report(recorder)
+
+LOCATION = 'load test'
+MENU_ITEMS = 20
+CATEGORIES = 4
+ITEMS_PER_ORDER = 3
+
+# Creates restaurants with a manager, a menu and tables, as the app would: categories and menu
+# items (within their category) positioned from 1, tables numbered from 0. The first half of
+# the tables is occupied with orders already placed (the kitchen's backlog), the second half
+# is left free for dinner_rush() to seat. Returns the restaurants' ids
+def seed(restaurants, tables, orders, seed=0):
+    rng = random.Random(seed)
+    run = f'{int(time.time())}-{rng.randrange(10 ** 6)}'
+    ids = []
+    for index in range(restaurants):
+        with transaction.atomic():
+            restaurant = Restaurant.objects.create(name=f'Load test {index}', location=LOCATION, num_categories=CATEGORIES)
+            user = User(username=f'loadtest-{run}-{index}@example.com', email=f'loadtest-{run}-{index}@example.com')
+            user.set_unusable_password()
+            user.save()
+            RestaurantUser.objects.create(user=user, restaurant=restaurant, user_role='manager')
+            Token.objects.create(user=user)
+
+            categories = Category.objects.bulk_create([
+                Category(name=f'Category {position}', restaurant=restaurant, position=position, num_menu_items=MENU_ITEMS // CATEGORIES)
+                for position in range(1, CATEGORIES + 1)
+            ])
+            menu_items = MenuItem.objects.bulk_create([
+                MenuItem(
+                    name=f'Dish {dish}',
+                    description='Seeded for load tests',
+                    price=rng.randrange(500, 4000) / 100,
+                    category=categories[dish % CATEGORIES],
+                    preparation_time=rng.randrange(5, 30),
+                    restaurant=restaurant,
+                    position=dish // CATEGORIES + 1,
+                )
+                for dish in range(MENU_ITEMS)
+            ])
+
+            occupied = tables // 2
+            Table.objects.bulk_create([
+                Table(restaurant=restaurant, number=number, occupied=number < occupied)
+                for number in range(tables)
+            ])
+            sessions = CustomerSession.objects.bulk_create([
+                CustomerSession(session=f'loadtest-{run}-{index}-{number}', table_number=number, restaurant=restaurant)
+                for number in range(occupied)
+            ])
+            now = timezone.now()
+            placed = Order.objects.bulk_create([
+                Order(customer_session=session, order_time=(now - timedelta(minutes=5 * (orders - i))).time())
+                for session in sessions
+                for i in range(orders)
+            ])
+            OrderItem.objects.bulk_create([
+                # the older orders have been served
+                OrderItem(order=order, menu_item=rng.choice(menu_items), status=rng.choice(['SERVED', 'SERVED', 'PREPARED', 'ORDER SENT']))
+                for order in placed
+                for _ in range(ITEMS_PER_ORDER)
+            ], batch_size=500)
+        ids.append(restaurant.id)
+    return ids
+
+# The commands only run against SQLite (SQLITE_PATH) unless --yes says the Postgres database
+# is a disposable one, they'd otherwise fill (and clear tables of) the production database
+def disposable_database():
+    return connection.vendor == 'sqlite'
+
+def load_test_restaurants():
+    return list(Restaurant.objects.filter(location=LOCATION).order_by('id').values_list('id', flat=True))
+
+# Removes everything seed() created
+def flush():
+    User.objects.filter(restaurantuser__restaurant__location=LOCATION).delete()
+    Restaurant.objects.filter(location=LOCATION).delete()
+
+# Latency, status and query count of every request, by endpoint
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def request(self, endpoint, method, path, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = method(path, data, content_type='application/json')
+            latency = time.perf_counter() - start
+        with self.lock:
+            self.samples[endpoint].append((latency, response.status_code, len(queries)))
+        return response
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+
+# Seats every free table of the restaurant, then each table orders while the kitchen polls its
+# feed, the kitchen prepares and serves every dish, the tables ask for their bill and the
+# staff clears them (so the scenario can be played again)
+def dinner_rush(restaurant_id, recorder, seed=0):
+    rng = random.Random(seed)
+    key = Token.objects.filter(user__restaurantuser__restaurant_id=restaurant_id).values_list('key', flat=True).first()
+    staff = Client(headers={'Authorization': f'Token {key}'})
+    menu = list(MenuItem.objects.filter(restaurant_id=restaurant_id).values_list('id', flat=True))
+    tables = list(Table.objects.filter(restaurant_id=restaurant_id, occupied=False).order_by('number').values_list('number', flat=True))
+
+    customers = {}
+    for number in tables:
+        customers[number] = Client()
+        recorder.request('customer/', customers[number].post, '/api/customer/', {'restaurant': restaurant_id, 'table_number': number})
+
+    response = recorder.request('allorders/', staff.get, '/api/allorders/')
+    cursor = response['X-Feed-Cursor']
+    for number, customer in customers.items():
+        order_items = [{'menu_item': menu_item, 'quantity': rng.randint(1, 2)} for menu_item in rng.sample(menu, ITEMS_PER_ORDER)]
+        recorder.request('placeorder/', customer.post, '/api/placeorder/', {'order_items': order_items})
+        # the kitchen screen polls between orders
+        response = recorder.request('allorders/', staff.get, '/api/allorders/', {'since': cursor})
+        cursor = response['X-Feed-Cursor']
+
+    order_items = list(OrderItem.objects.filter(
+        order__customer_session__restaurant_id=restaurant_id,
+        order__customer_session__table_number__in=tables,
+    ).order_by('id').values_list('id', flat=True))
+    for item in order_items:
+        recorder.request('orderitems/<pk>/', staff.patch, f'/api/orderitems/{item}/', {'status': 'PREPARED'})
+    recorder.request('allorders/', staff.get, '/api/allorders/', {'since': cursor})
+    for item in order_items:
+        recorder.request('orderitems/<pk>/', staff.patch, f'/api/orderitems/{item}/', {'status': 'SERVED'})
+
+    for number, customer in customers.items():
+        recorder.request('bill/', customer.get, '/api/bill/')
+        recorder.request('staff-ending-customer/', staff.delete, '/api/staff-ending-customer/', {'table_number': number})
+
+# Returns {'endpoints': {endpoint: {...}}, 'requests': ..., 'errors': ..., 'seconds': ..., 'throughput': ...}
+def report(recorder):
+    endpoints = {}
+    for endpoint, samples in sorted(recorder.samples.items()):
+        latencies = sorted(latency for latency, _, _ in samples)
+        queries = [count for _, _, count in samples]
+        endpoints[endpoint] = {
+            'requests': len(samples),
+            'errors': sum(1 for _, status, _ in samples if status >= 400),
+            'p50_ms': round(statistics.median(latencies) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'queries_mean': round(statistics.mean(queries), 1),
+            'queries_max': max(queries),
+        }
+    requests = sum(endpoint['requests'] for endpoint in endpoints.values())
+    return {
+        'endpoints': endpoints,
+        'requests': requests,
+        'errors': sum(endpoint['errors'] for endpoint in endpoints.values()),
+        'seconds': round(recorder.elapsed, 2),
+        'throughput': round(requests / recorder.elapsed, 1) if recorder.elapsed else None,
+    }
+
+# Nearest rank percentile of sorted values
+def percentile(values, share):
+    return values[max(0, math.ceil(share * len(values)) - 1)]
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from WMS_MAIN.models import Restaurant, StripeUserData
+
+# Copies the managers' Stripe accounts (StripeUserData) onto their restaurants, which is where
+# the Stripe views read them from. Restaurants that already have an account are left untouched.
+# Their onboarding state is fetched from Stripe on the next status check.
+# Run it once after adding the Restaurant.stripe_* fields:
+#   python manage.py backfill_stripe_accounts
+class Command(BaseCommand):
+    help = "Copies the managers' Stripe account ids onto their restaurants"
+
+    def handle(self, *args, **options):
+        backfilled = 0
+        accounts = StripeUserData.objects.filter(user__restaurantuser__isnull=False).values_list(
+            'user__restaurantuser__restaurant_id', 'stripe_id'
+        )
+        for restaurant_id, stripe_id in accounts:
+            if Restaurant.objects.filter(stripe_account_id=stripe_id).exists():
+                continue
+            backfilled += Restaurant.objects.filter(id=restaurant_id, stripe_account_id__isnull=True).update(stripe_account_id=stripe_id)
+        self.stdout.write(f'Backfilled the Stripe accounts of {backfilled} restaurant(s)')
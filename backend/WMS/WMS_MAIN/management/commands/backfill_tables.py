@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from WMS_MAIN.models import Restaurant, Table
+
+# Creates the Table rows of every restaurant from the legacy Restaurant.table_numbers
+# document. Tables that already exist are left untouched, so it can be run again safely.
+# Run it once after migrating to the Table model:
+#   python manage.py backfill_tables
+class Command(BaseCommand):
+    help = 'Creates Table rows from the legacy Restaurant.table_numbers JSON field'
+
+    def handle(self, *args, **options):
+        restaurants = Restaurant.objects.only('id', 'table_numbers').order_by('id')
+        for restaurant in restaurants.iterator():
+            tables = []
+            for number, occupied in (restaurant.table_numbers or {}).items():
+                try:
+                    tables.append(Table(restaurant_id=restaurant.id, number=int(number), occupied=bool(occupied)))
+                except (TypeError, ValueError):
+                    self.stderr.write(f'Restaurant {restaurant.id}: skipped invalid table number {number!r}')
+            Table.objects.bulk_create(tables, batch_size=500, ignore_conflicts=True)
+        self.stdout.write(f'Backfilled the tables of {restaurants.count()} restaurant(s)')
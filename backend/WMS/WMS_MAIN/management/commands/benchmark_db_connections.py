@@ -0,0 +1,110 @@
+import statistics
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.utils import load_backend
+from WMS_MAIN.postgres_pool.base import close_pools
+
+# Benchmarks the database connection modes against the configured Postgres (PG* variables).
+# Each simulated request does what Django does around a view: drops the connection if it is
+# obsolete when the request starts and ends, and runs --queries trivial queries in between.
+#   - new:        CONN_MAX_AGE = 0, a new connection per request (the old settings)
+#   - persistent: CONN_MAX_AGE = 60 with health checks, a connection per thread
+#   - pool:       the pool of WMS_MAIN.postgres_pool with --threads connections
+# Requests run on --threads threads like a WSGI server's, or with --thread-per-request each on a
+# new thread like the sync views under ASGI.
+# Example usage:
+#   PGHOST=localhost PGDATABASE=wms python manage.py benchmark_db_connections --requests 500 --threads 4
+#   PGHOST=localhost PGDATABASE=wms python manage.py benchmark_db_connections --thread-per-request
+class Command(BaseCommand):
+    help = 'Measures per-request database latency with new, persistent and pooled connections'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--queries', type=int, default=1, help='queries per request')
+        parser.add_argument('--thread-per-request', action='store_true', help='run every request on a new thread (ASGI)')
+        parser.add_argument('--modes', nargs='+', choices=['new', 'persistent', 'pool'], default=['new', 'persistent', 'pool'])
+
+    def handle(self, *args, **options):
+        default = connections['default']
+        if default.vendor != 'postgresql':
+            raise CommandError('The default database has to be PostgreSQL')
+
+        for mode in options['modes']:
+            settings_dict = {**default.settings_dict, 'ENGINE': 'WMS_MAIN.postgres_pool', 'OPTIONS': dict(default.settings_dict['OPTIONS'])}
+            settings_dict['OPTIONS'].pop('pool', None)
+            if mode == 'new':
+                settings_dict.update(CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False)
+            elif mode == 'persistent':
+                settings_dict.update(CONN_MAX_AGE=60, CONN_HEALTH_CHECKS=True)
+            else:
+                settings_dict.update(CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=True)
+                settings_dict['OPTIONS']['pool'] = {'max_size': options['threads']}
+            try:
+                latencies, opened = benchmark(
+                    settings_dict, f'benchmark-{mode}', options['requests'], options['threads'],
+                    options['queries'], options['thread_per_request'],
+                )
+            finally:
+                close_pools()
+            self.stdout.write(
+                f'{mode:<10} mean {statistics.mean(latencies) * 1000:7.2f}ms  '
+                f'p50 {statistics.median(latencies) * 1000:7.2f}ms  '
+                f'p95 {statistics.quantiles(latencies, n=20)[-1] * 1000:7.2f}ms  '
+                f'{opened} connection(s) opened'
+            )
+
+# Returns (request latencies, number of connections opened)
+def benchmark(settings_dict, alias, requests, threads, queries, thread_per_request):
+    backend = load_backend(settings_dict['ENGINE'])
+    latencies = []
+    wrappers = []
+    # server process ids, one per connection opened
+    backend_pids = set()
+    lock = threading.Lock()
+
+    def new_wrapper():
+        wrapper = backend.DatabaseWrapper(settings_dict, alias)
+        with lock:
+            wrappers.append(wrapper)
+        return wrapper
+
+    def request(wrapper):
+        start = time.perf_counter()
+        # request_started and request_finished close obsolete connections
+        wrapper.close_if_unusable_or_obsolete()
+        for _ in range(queries):
+            with wrapper.cursor() as cursor:
+                cursor.execute('SELECT pg_backend_pid()')
+                backend_pid = cursor.fetchone()[0]
+        wrapper.close_if_unusable_or_obsolete()
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            backend_pids.add(backend_pid)
+
+    def worker(count):
+        wrapper = None if thread_per_request else new_wrapper()
+        for _ in range(count):
+            if thread_per_request:
+                # a new thread has its own connection, as every request under ASGI
+                thread = threading.Thread(target=lambda: request(new_wrapper()))
+                thread.start()
+                thread.join()
+            else:
+                request(wrapper)
+
+    try:
+        workers = [threading.Thread(target=worker, args=(requests // threads,)) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    finally:
+        for wrapper in wrappers:
+            # persistent connections outlive their threads, closed from this one
+            wrapper.inc_thread_sharing()
+            wrapper.close()
+    return latencies, len(backend_pids)
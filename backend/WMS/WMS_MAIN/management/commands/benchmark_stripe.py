@@ -0,0 +1,83 @@
+import asyncio
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from WMS_MAIN.fake_stripe import FakeStripe
+from WMS_MAIN.payments import StripeGateway
+
+# Benchmarks the payment gateway against the fake Stripe with injected latency, offline.
+# Fires --calls checkout session creations at once while a ticker measures how long the event
+# loop (which serves every other request under ASGI) is held up. --blocking makes the same calls
+# the old way, straight from the event loop, for comparison.
+# Example usage:
+#   python manage.py benchmark_stripe --latency 0.5 --calls 100 --concurrency 20
+#   python manage.py benchmark_stripe --latency 0.5 --calls 20 --blocking
+class Command(BaseCommand):
+    help = 'Measures Stripe call throughput and event loop stalls under injected latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=100)
+        parser.add_argument('--latency', type=float, default=0.2, help='seconds the fake Stripe takes per request')
+        parser.add_argument('--error-rate', type=float, default=0, help='share of requests the fake Stripe fails with a 503')
+        parser.add_argument('--concurrency', type=int, default=10, help="size of the gateway's thread pool")
+        parser.add_argument('--blocking', action='store_true', help='call Stripe synchronously from the event loop')
+
+    def handle(self, *args, **options):
+        with FakeStripe(latency=options['latency'], error_rate=options['error_rate']) as fake:
+            gateway = StripeGateway(
+                api_key='sk_test_fake',
+                api_base=fake.url,
+                timeout=10,
+                max_retries=2,
+                max_concurrency=options['concurrency'],
+                call_timeout=60,
+            )
+            try:
+                results = asyncio.run(benchmark(gateway, options['calls'], options['blocking']))
+            finally:
+                gateway.close()
+            requests = len(fake.requests)
+
+        elapsed, latencies, failures, max_lag = results
+        self.stdout.write(f"{options['calls']} call(s) in {elapsed:.2f}s: {options['calls'] / elapsed:.1f} calls/s")
+        if latencies:
+            self.stdout.write(
+                f'latency p50 {statistics.median(latencies):.3f}s, '
+                f'p95 {statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]:.3f}s'
+            )
+        self.stdout.write(f'{failures} failure(s), {requests} request(s) to Stripe including retries')
+        self.stdout.write(f'longest event loop stall {max_lag:.3f}s')
+
+# Returns (elapsed seconds, call latencies, failures, longest event loop stall)
+async def benchmark(gateway, calls, blocking):
+    params = {
+        'mode': 'payment',
+        'line_items': [{'price_data': {'currency': 'aud', 'product_data': {'name': 'dish'}, 'unit_amount': 1000}, 'quantity': 1}],
+        'success_url': 'https://example.com/success',
+        'cancel_url': 'https://example.com/cancel',
+    }
+
+    async def checkout():
+        start = time.perf_counter()
+        if blocking:
+            gateway.client.checkout.sessions.create(params)
+        else:
+            await gateway.create_checkout_session(params)
+        return time.perf_counter() - start
+
+    done = asyncio.Event()
+    async def ticker(interval=0.01):
+        max_lag = 0
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            max_lag = max(max_lag, time.perf_counter() - start - interval)
+        return max_lag
+
+    ticking = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    results = await asyncio.gather(*(checkout() for _ in range(calls)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    done.set()
+    latencies = [result for result in results if not isinstance(result, BaseException)]
+    return elapsed, latencies, calls - len(latencies), await ticking
@@ -0,0 +1,118 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from WMS_MAIN.billing import table_order_items
+from WMS_MAIN.models import Category, CustomerSession, MenuItem, Order, OrderItem, Restaurant, Table
+
+# Runs EXPLAIN on the hot restaurant / table / status queries and fails if any of them
+# sequentially scans a table, i.e. if a query isn't served by the indexes in models.py.
+# By default the data is seeded inside a transaction that is rolled back afterwards, so the
+# query planner sees many restaurants. --no-seed explains against the existing data instead.
+# Example usage:
+#   python manage.py explain_hot_queries
+#   python manage.py explain_hot_queries --restaurants 500 --verbosity 2
+class Command(BaseCommand):
+    help = 'Explains the hot queries and fails if a sequential scan shows up'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--restaurants', type=int, default=200, help='number of restaurants to seed')
+        parser.add_argument('--tables', type=int, default=10, help='tables (and customer sessions) per restaurant')
+        parser.add_argument('--no-seed', action='store_true', help="explain against the database's current data")
+
+    def handle(self, *args, **options):
+        if options['no_seed']:
+            restaurant = Restaurant.objects.order_by('id').first()
+            if restaurant is None:
+                raise CommandError('There are no restaurants to explain the queries with')
+            failures = self.explain_all(restaurant, **options)
+        else:
+            with transaction.atomic():
+                restaurant = seed(options['restaurants'], options['tables'])
+                if connection.vendor == 'postgresql':
+                    with connection.cursor() as cursor:
+                        cursor.execute('ANALYZE')
+                failures = self.explain_all(restaurant, **options)
+                transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError(f"Sequential scan in: {', '.join(failures)}")
+        self.stdout.write('No sequential scans')
+
+    def explain_all(self, restaurant, **options):
+        failures = []
+        for name, queryset in hot_queries(restaurant):
+            plan = queryset.explain()
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{name}:\n{plan}\n')
+            if scanned := sequential_scans(plan):
+                failures.append(name)
+                self.stderr.write(f"{name}: sequential scan of {', '.join(scanned)}")
+        return failures
+
+# (name, queryset) of the hot queries of the given restaurant
+def hot_queries(restaurant):
+    customer_session = CustomerSession.objects.filter(restaurant=restaurant).order_by('id').first()
+    table_number = customer_session.table_number if customer_session else 0
+    return [
+        ('customer session by session key', CustomerSession.objects.filter(session=customer_session.session if customer_session else '')),
+        ('order items of a table', table_order_items(restaurant.id, table_number)),
+        ('orders of a table', Order.objects.filter(customer_session__restaurant=restaurant, customer_session__table_number=table_number)),
+        ('tables needing assistance', CustomerSession.objects.filter(restaurant=restaurant, need_assistance=True)),
+        ('categories by position', Category.objects.filter(restaurant=restaurant).order_by('position')),
+        ('menu items by position', MenuItem.objects.filter(restaurant=restaurant).order_by('position')),
+        ('unserved order items', OrderItem.objects.filter(order__customer_session__restaurant=restaurant).exclude(status='SERVED')),
+        ('table occupancy', Table.objects.filter(restaurant=restaurant, number=table_number)),
+    ]
+
+# Names of the tables a plan reads sequentially, for PostgreSQL and SQLite plans
+def sequential_scans(plan):
+    scanned = []
+    for line in plan.splitlines():
+        line = line.strip()
+        if 'Seq Scan on ' in line:
+            scanned.append(line.split('Seq Scan on ', 1)[1].split()[0])
+        elif ' SCAN ' in f' {line} ' and 'USING' not in line and 'CONSTANT ROW' not in line:
+            # SQLite: "SCAN <table>" without an index, "SEARCH <table> USING INDEX ..." otherwise
+            scanned.append(line.split('SCAN ', 1)[1].split()[0])
+    return scanned
+
+# Seeds restaurants with a menu and every table seated, returns the first restaurant.
+# Most order items have been served, as they would be during service
+def seed(restaurants, tables):
+    created = Restaurant.objects.bulk_create(
+        [Restaurant(name=f'explain {i}', location=f'explain {i}') for i in range(restaurants)]
+    )
+    restaurant_ids = [restaurant.id for restaurant in created]
+    Table.objects.bulk_create(
+        [Table(restaurant_id=rid, number=n, occupied=True) for rid in restaurant_ids for n in range(tables)],
+        batch_size=1000,
+    )
+    Category.objects.bulk_create(
+        [Category(restaurant_id=rid, name=f'category {n}', position=n + 1) for rid in restaurant_ids for n in range(5)],
+        batch_size=1000,
+    )
+    MenuItem.objects.bulk_create(
+        [
+            MenuItem(restaurant_id=rid, name=f'item {n}', description='', price=1, preparation_time=1, position=n + 1)
+            for rid in restaurant_ids for n in range(20)
+        ],
+        batch_size=1000,
+    )
+    CustomerSession.objects.bulk_create(
+        [
+            CustomerSession(restaurant_id=rid, table_number=n, session=f'explain-{rid}-{n}', need_assistance=(n == 0))
+            for rid in restaurant_ids for n in range(tables)
+        ],
+        batch_size=1000,
+    )
+    session_ids = CustomerSession.objects.filter(restaurant_id__in=restaurant_ids).values_list('id', flat=True)
+    Order.objects.bulk_create([Order(customer_session_id=sid) for sid in session_ids for _ in range(3)], batch_size=1000)
+    order_ids = Order.objects.filter(customer_session__restaurant_id__in=restaurant_ids).values_list('id', flat=True)
+    menu_item_id = MenuItem.objects.filter(restaurant_id=restaurant_ids[0]).values_list('id', flat=True).first()
+    OrderItem.objects.bulk_create(
+        [
+            OrderItem(order_id=oid, menu_item_id=menu_item_id, status='ORDER SENT' if n == 0 and i % 10 == 0 else 'SERVED')
+            for i, oid in enumerate(order_ids) for n in range(4)
+        ],
+        batch_size=1000,
+    )
+    return Restaurant.objects.get(pk=restaurant_ids[0])
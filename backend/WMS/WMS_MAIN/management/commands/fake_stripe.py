@@ -0,0 +1,26 @@
+import time
+from django.core.management.base import BaseCommand
+from WMS_MAIN.fake_stripe import FakeStripe
+
+# Serves the fake Stripe API (see fake_stripe.py) until interrupted, for running the app offline.
+# Example usage:
+#   python manage.py fake_stripe --port 12111 --latency 0.5
+#   STRIPE_KEY=sk_test_fake STRIPE_API_BASE=http://127.0.0.1:12111 python manage.py runserver
+class Command(BaseCommand):
+    help = 'Runs a local fake of the Stripe API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+        parser.add_argument('--error-rate', type=float, default=0, help='share of requests answered with a 503')
+
+    def handle(self, *args, **options):
+        fake = FakeStripe(port=options['port'], latency=options['latency'], error_rate=options['error_rate']).start()
+        self.stdout.write(f'Fake Stripe listening on {fake.url}')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fake.stop()
@@ -0,0 +1,83 @@
+import json
+import threading
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from WMS_MAIN.loadtest import Recorder, disposable_database, dinner_rush, load_test_restaurants, report
+
+# Plays a dinner rush (see loadtest.py) at every restaurant seeded by seed_load_test, on
+# --threads threads, and reports latency, throughput and queries per request by endpoint.
+# Runs against the configured database, SQLite with SQLITE_PATH set, or Postgres with --yes
+# (refused otherwise, production is Postgres too).
+# --json writes the report to compare runs before a deploy, --max-queries fails when an
+# endpoint's average goes over it.
+# Example usage:
+#   python manage.py load_test --threads 4 --rounds 3 --json report.json --yes
+#   SQLITE_PATH=loadtest.sqlite3 python manage.py load_test
+class Command(BaseCommand):
+    help = 'Plays a dinner rush against the seeded restaurants and reports per endpoint latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=1, help='restaurants played at once (keep 1 with SQLite)')
+        parser.add_argument('--rounds', type=int, default=1, help='dinner rushes per restaurant')
+        parser.add_argument('--json', help='file to write the report to')
+        parser.add_argument('--max-queries', type=float, help='fail if an endpoint averages more queries per request')
+        parser.add_argument('--yes', action='store_true', help='run against a Postgres database (never the production one)')
+
+    def handle(self, *args, **options):
+        if not (options['yes'] or disposable_database()):
+            raise CommandError(f'Refusing to load test the {connection.vendor} database {connection.settings_dict["NAME"]}, set SQLITE_PATH or pass --yes')
+        restaurants = load_test_restaurants()
+        if not restaurants:
+            raise CommandError('No load test restaurants, run python manage.py seed_load_test first')
+
+        # the test client's requests are for host 'testserver'
+        setup_test_environment()
+        try:
+            recorder = Recorder()
+            failures = []
+            threads = [
+                threading.Thread(target=play, args=(restaurants[i::options['threads']], options['rounds'], recorder, failures))
+                for i in range(options['threads'])
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            recorder.stop()
+        finally:
+            teardown_test_environment()
+        if failures:
+            raise CommandError(f'The dinner rush failed: {failures[0]!r}')
+
+        results = report(recorder)
+        self.stdout.write(f"{'endpoint':<24}{'requests':>9}{'errors':>8}{'p50 ms':>9}{'p99 ms':>9}{'queries':>9}{'max':>5}")
+        for endpoint, stats in results['endpoints'].items():
+            self.stdout.write(
+                f"{endpoint:<24}{stats['requests']:>9}{stats['errors']:>8}{stats['p50_ms']:>9}"
+                f"{stats['p99_ms']:>9}{stats['queries_mean']:>9}{stats['queries_max']:>5}"
+            )
+        self.stdout.write(
+            f"{results['requests']} request(s), {results['errors']} error(s) in {results['seconds']}s: "
+            f"{results['throughput']} requests/s on {connection.vendor}"
+        )
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({**results, 'database': connection.vendor}, f, indent=2)
+
+        if results['errors']:
+            raise CommandError(f"{results['errors']} request(s) failed")
+        if options['max_queries'] is not None:
+            over = [endpoint for endpoint, stats in results['endpoints'].items() if stats['queries_mean'] > options['max_queries']]
+            if over:
+                raise CommandError(f"Over {options['max_queries']} queries per request: {', '.join(over)}")
+
+def play(restaurants, rounds, recorder, failures):
+    try:
+        for number in range(rounds):
+            for restaurant_id in restaurants:
+                dinner_rush(restaurant_id, recorder, seed=number)
+    except Exception as error:
+        failures.append(error)
+    finally:
+        connection.close()
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from WMS_MAIN.images import DEFAULT_IMAGE, process_menu_item_image
+from WMS_MAIN.models import MenuItem
+
+# Processes the images of menu items that don't have resized copies yet (see images.py), e.g.
+# the images uploaded before the image pipeline. Run it once after adding MenuItem.image_variants:
+#   python manage.py process_menu_images
+class Command(BaseCommand):
+    help = "Resizes and re-encodes the menu items' unprocessed images"
+
+    def handle(self, *args, **options):
+        menu_items = MenuItem.objects.filter(image_variants=[]).exclude(image='').exclude(image=DEFAULT_IMAGE).exclude(image__isnull=True)
+        processed = 0
+        for menu_item_id in menu_items.values_list('id', flat=True).iterator():
+            try:
+                process_menu_item_image(menu_item_id)
+                processed += 1
+            except (OSError, ValueError) as error:
+                self.stderr.write(f'Menu item {menu_item_id}: {error}')
+        self.stdout.write(f'Processed the images of {processed} menu item(s)')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from WMS_MAIN.models import Restaurant
+from WMS_MAIN.positions import repair_menu_positions
+
+# Rebuilds the category / menu item positions and the num_categories / num_menu_items
+# counters (see positions.py) of the given restaurants, or of every restaurant
+# Example usage:
+#   python manage.py repair_menu_positions
+#   python manage.py repair_menu_positions 1 2
+class Command(BaseCommand):
+    help = 'Renumbers the menu positions and recounts the menu counters of restaurants'
+
+    def add_arguments(self, parser):
+        parser.add_argument('restaurant_ids', nargs='*', type=int, help='restaurants to repair (default: all)')
+
+    def handle(self, *args, **options):
+        restaurant_ids = options['restaurant_ids']
+        if restaurant_ids:
+            missing = set(restaurant_ids) - set(Restaurant.objects.filter(pk__in=restaurant_ids).values_list('pk', flat=True))
+            if missing:
+                raise CommandError(f'Restaurant(s) {sorted(missing)} do not exist')
+        else:
+            restaurant_ids = list(Restaurant.objects.order_by('pk').values_list('pk', flat=True))
+
+        for restaurant_id in restaurant_ids:
+            written = repair_menu_positions(restaurant_id)
+            self.stdout.write(f'Restaurant {restaurant_id}: {written} row(s) repaired')
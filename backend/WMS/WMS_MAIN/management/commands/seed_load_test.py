@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from WMS_MAIN.loadtest import disposable_database, flush, seed
+
+# Seeds restaurants for the load test (python manage.py load_test), each with a manager, a menu
+# and --tables tables, half of them occupied with --orders orders each.
+# Refuses to run against Postgres without --yes, production is Postgres too.
+# Example usage:
+#   SQLITE_PATH=loadtest.sqlite3 python manage.py seed_load_test --restaurants 20 --tables 30 --orders 5
+#   python manage.py seed_load_test --flush --yes
+class Command(BaseCommand):
+    help = 'Seeds restaurants, tables and orders for the load test'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--restaurants', type=int, default=10)
+        parser.add_argument('--tables', type=int, default=20)
+        parser.add_argument('--orders', type=int, default=5, help='orders per occupied table')
+        parser.add_argument('--seed', type=int, default=0, help='seed of the random menu prices and orders')
+        parser.add_argument('--flush', action='store_true', help='only remove the seeded restaurants')
+        parser.add_argument('--yes', action='store_true', help='run against a Postgres database (never the production one)')
+
+    def handle(self, *args, **options):
+        if not (options['yes'] or disposable_database()):
+            raise CommandError(f'Refusing to seed the {connection.vendor} database {connection.settings_dict["NAME"]}, set SQLITE_PATH or pass --yes')
+        if options['flush']:
+            flush()
+            self.stdout.write('Removed the load test restaurants')
+            return
+        ids = seed(options['restaurants'], options['tables'], options['orders'], options['seed'])
+        self.stdout.write(f'Seeded {len(ids)} restaurant(s), ids {ids[0]} to {ids[-1]}' if ids else 'Seeded no restaurants')
@@ -0,0 +1,48 @@
+import logging
+import time
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections
+from WMS_MAIN.outbox import image_data, retry_dead_emails, send_batch
+
+logger = logging.getLogger(__name__)
+
+# Worker sending the queued emails (see outbox.py), runs until interrupted.
+# Database errors (a restart, a pool timeout) are logged and the worker carries on with a new
+# connection after --interval seconds.
+# Example usage:
+#   python manage.py send_emails
+#   python manage.py send_emails --once             (send what is due and exit, e.g. from cron)
+#   python manage.py send_emails --retry-dead       (requeue the dead-lettered emails first)
+class Command(BaseCommand):
+    help = 'Sends the queued emails in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='exit once no email is due')
+        parser.add_argument('--batch-size', type=int, help='defaults to settings.EMAIL_OUTBOX_BATCH_SIZE')
+        parser.add_argument('--interval', type=float, default=5, help='seconds between polls of an empty queue')
+        parser.add_argument('--retry-dead', action='store_true', help='requeue the dead-lettered emails')
+
+    def handle(self, *args, **options):
+        if options['retry_dead']:
+            self.stdout.write(f'Requeued {retry_dead_emails()} dead email(s)')
+        # the inline images are read from disk once for the worker's lifetime
+        image_data()
+        try:
+            while True:
+                # drops a broken or expired connection, as Django does around each request
+                close_old_connections()
+                try:
+                    sent = send_batch(options['batch_size'])
+                except DatabaseError:
+                    logger.exception('Sending the queued emails failed')
+                    close_old_connections()
+                    time.sleep(options['interval'])
+                    continue
+                if sent:
+                    self.stdout.write(f'Attempted {sent} email(s)')
+                elif options['once']:
+                    return
+                else:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,109 @@
+import os
+import re
+import tempfile
+from urllib.parse import urlparse
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from whitenoise.base import WhiteNoise
+from whitenoise.compress import Compressor
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+# Media files (menu images)
+# Stored by MediaStorage, the default storage, and served by MediaMiddleware before any other
+# middleware runs (no session, user or view), with WhiteNoise's handling of ETag /
+# If-None-Match, Range requests and precompressed .gz / .br variants.
+# Processed menu images are content addressed (see images.py), a name never changes content, so
+# they are sent with Cache-Control: max-age=<forever>, public, immutable and browsers / CDNs
+# don't ask again. Other media (uploads not processed yet, the default image) get
+# settings.MEDIA_MAX_AGE seconds.
+# Another backend (e.g. S3 behind a CDN) only has to replace STORAGES['default'] and keep the
+# content addressed names immutable.
+
+CONTENT_ADDRESSED = re.compile(r'/[0-9a-f]{20}(-\d+)?\.(jpg|webp)$')
+
+def is_content_addressed(name):
+    return bool(CONTENT_ADDRESSED.search('/' + name.lstrip('/')))
+
+# The local filesystem backend
+# A content addressed name that already exists already has the content, it's kept rather than
+# stored again under another name, and compressible files get .gz / .br siblings.
+# Content addressed files are written beside their name and renamed into place, so readers
+# never see one half written and writers racing on the same content (two menu items with the
+# same photo, process_menu_images next to an upload) all succeed with the same name.
+class MediaStorage(FileSystemStorage):
+    compressor = Compressor(quiet=True)
+
+    def _save(self, name, content):
+        if is_content_addressed(name):
+            if not self.exists(name):
+                self._save_in_place(name, content)
+            return name
+        name = super()._save(name, content)
+        if self.compressor.should_compress(name):
+            # writes the variants that are smaller
+            list(self.compressor.compress(self.path(name)))
+        return name
+
+    def _save_in_place(self, name, content):
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, prefix='.saving-', delete=False) as file:
+            try:
+                for chunk in content.chunks():
+                    file.write(chunk)
+            except BaseException:
+                os.unlink(file.name)
+                raise
+        try:
+            os.chmod(file.name, self.file_permissions_mode or 0o644)
+            # atomic, the last writer replaces the same content
+            os.replace(file.name, path)
+        except BaseException:
+            os.unlink(file.name)
+            raise
+
+    def get_available_name(self, name, max_length=None):
+        if is_content_addressed(name):
+            return name
+        return super().get_available_name(name, max_length)
+
+    def delete(self, name):
+        super().delete(name)
+        for extension in ('.gz', '.br'):
+            super().delete(name + extension)
+
+class MediaMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.prefix = urlparse(settings.MEDIA_URL).path
+        # autorefresh: files are looked up per request rather than listed at startup, media
+        # is added while the server runs
+        self.whitenoise = WhiteNoise(
+            None,
+            autorefresh=True,
+            max_age=settings.MEDIA_MAX_AGE,
+            immutable_file_test=lambda path, url: is_content_addressed(url),
+        )
+        self.whitenoise.add_files(str(settings.MEDIA_ROOT), prefix=self.prefix)
+        # content addressed files found so far by URL, they never change so only the first
+        # request for one touches the filesystem more than to open it
+        self.files = {}
+
+    def __call__(self, request):
+        url = request.path_info
+        if not url.startswith(self.prefix):
+            return self.get_response(request)
+        static_file = self.files.get(url)
+        if static_file is None:
+            static_file = self.whitenoise.find_file(url)
+            if static_file is None:
+                return self.get_response(request)
+            if is_content_addressed(url):
+                self.files[url] = static_file
+        try:
+            return WhiteNoiseMiddleware.serve(static_file, request)
+        except FileNotFoundError:
+            # deleted since it was found
+            self.files.pop(url, None)
+            return self.get_response(request)
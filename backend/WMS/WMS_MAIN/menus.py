@@ -0,0 +1,85 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.http import parse_etags
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from .models import Category, MenuItem, MenuVersion
+# serializers.py imports positions.py, which imports this module
+from . import serializers
+
+# Versioned menu snapshots
+# A restaurant's menu is read on every page load of every table's phone but rarely
+# changes, so it is serialized once per menu version and cached:
+# {
+#     'categories': [Category, ...],           (CategoryList's response, sorted by position)
+#     'menu_items': [MenuItem, ...],           (MenuItemList's response)
+#     'menu': b'{"version": 1718000000000000000, "categories": [{..., "menu_items": [MenuItem, ...]}, ...], "uncategorised": [...]}'
+# }
+# The version is changed by the Category / MenuItem signals (see signals.py) and by
+# any bulk update of them, which makes the cached snapshot of the old version unreachable.
+# Responses carry an ETag of the version so unchanged menus are answered with a 304.
+
+def menu_version(restaurant_id):
+    return MenuVersion.objects.filter(restaurant_id=restaurant_id).values_list('version', flat=True).first() or 0
+
+# Versions are timestamps rather than a counter so a version is never reused, even if a
+# restaurant's writes are rolled back or a restaurant id is reused (0 is the never written menu)
+def bump_menu_version(restaurant_id):
+    version = time.time_ns()
+    if not MenuVersion.objects.filter(restaurant_id=restaurant_id).update(version=version):
+        MenuVersion.objects.update_or_create(restaurant_id=restaurant_id, defaults={'version': version})
+
+def menu_etag(restaurant_id, version):
+    return f'"menu-{restaurant_id}-{version}"'
+
+# Image URLs are absolute, so the snapshot also depends on the host it is served from
+def build_menu_snapshot(request, restaurant_id, version):
+    context = {'request': request}
+    categories = list(Category.objects.filter(restaurant_id=restaurant_id).order_by('position', 'id'))
+    menu_items = list(MenuItem.objects.filter(restaurant_id=restaurant_id).order_by('id'))
+    category_data = serializers.CategorySerializer(categories, many=True, context=context).data
+    menu_item_data = serializers.MenuItemSerializer(menu_items, many=True, context=context).data
+
+    items_by_category = {}
+    for item, data in sorted(zip(menu_items, menu_item_data), key=lambda pair: (pair[0].position, pair[0].id)):
+        items_by_category.setdefault(item.category_id, []).append(data)
+    menu = {
+        'version': version,
+        'categories': [
+            {**data, 'menu_items': items_by_category.get(category.id, [])}
+            for category, data in zip(categories, category_data)
+        ],
+        'uncategorised': items_by_category.get(None, []),
+    }
+    return {
+        'categories': category_data,
+        'menu_items': menu_item_data,
+        'menu': JSONRenderer().render(menu),
+    }
+
+def get_menu_snapshot(request, restaurant_id, version):
+    key = f'menu:{restaurant_id}:{version}:{request.scheme}://{request.get_host()}'
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = build_menu_snapshot(request, restaurant_id, version)
+        cache.set(key, snapshot, settings.MENU_SNAPSHOT_TIMEOUT)
+    return snapshot
+
+# Serves one section of the restaurant's menu snapshot, or a 304 if the client's copy is current
+def menu_response(request, restaurant_id, section):
+    version = menu_version(restaurant_id)
+    etag = menu_etag(restaurant_id, version)
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponse(status=304)
+    else:
+        snapshot = get_menu_snapshot(request, restaurant_id, version)
+        if section == 'menu':
+            response = HttpResponse(snapshot['menu'], content_type='application/json')
+        else:
+            response = Response(snapshot[section])
+    response['ETag'] = etag
+    # the browser has to revalidate with If-None-Match before reusing its copy
+    response['Cache-Control'] = 'private, no-cache'
+    return response
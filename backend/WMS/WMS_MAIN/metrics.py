@@ -0,0 +1,335 @@
+import atexit
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files import locks
+from django.db.models import Count
+from .models import CustomerSession
+
+logger = logging.getLogger(__name__)
+
+# Operational metrics in Prometheus' text format
+# Every worker process records into its own registry of counters, gauges and histograms and
+# writes it to a file of settings.METRICS_DIR at most every settings.METRICS_FLUSH_SECONDS
+# (after a request) and when it exits. api/metrics/, scraped with the settings.METRICS_TOKEN
+# bearer token, sums the files of all the host's workers, whichever worker serves it, so the
+# counters only go down when the host restarts. The files of workers that are gone are kept,
+# folded into one, so their counts stay in the totals. METRICS_DIR is per host: with several
+# hosts, each one is a Prometheus target (they're summed in PromQL). Gauges collected from the
+# database when scraped, like the active customer sessions, are the same on every host.
+#   - wms_http_request_duration_seconds: every request, by route (url name), method and status
+#   - wms_orders_placed_total: by restaurant, rate(wms_orders_placed_total[1m]) * 60 is the orders per minute
+#   - wms_order_item_transition_seconds: time an order item spent in its previous status, by
+#     transition (ORDER SENT -> PREPARED, PREPARED -> SERVED), the kitchen's throughput and latency
+#   - wms_assistance_wait_seconds: from a table asking for assistance to it being cleared
+#   - wms_stripe_call_seconds: Stripe calls, by operation and outcome
+#   - wms_active_customer_sessions: seated tables, by restaurant
+# Example usage:
+#   ORDERS_PLACED.inc(restaurant=restaurant_id)
+#   ASSISTANCE_WAIT.observe(seconds)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# seconds, for the minutes spent waiting in the kitchen and on the floor
+WAIT_BUCKETS = (15, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600)
+# the counts of the workers that are gone
+RETIRED = 'retired.json'
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        # {label values: value}
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} takes the labels {", ".join(self.label_names)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    # A copy of the values, as saved in the worker's file
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    # The values of two workers added up
+    def add(self, value, other):
+        return value + other
+
+    def compatible(self, value):
+        return True
+
+    # [(name, [(label, value), ...], value), ...]
+    def samples(self, values):
+        return [(self.name, list(zip(self.label_names, key)), value) for key, value in sorted(values.items())]
+
+    def expose(self, values=None):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples(self.snapshot() if values is None else values):
+            lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return lines
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+# Either set by the code (summed across the workers), or collect() returns
+# {(label value, ...): value} when scraped
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self, values):
+        if self.collect is not None:
+            values = {tuple(str(value) for value in key): value for key, value in self.collect().items()}
+        return super().samples(values)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                # [count per bucket, sum]
+                self.values[key] = [[0] * len(self.buckets), 0]
+            counts, _ = self.values[key]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key][1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {key: [list(counts), total] for key, (counts, total) in self.values.items()}
+
+    def add(self, value, other):
+        return [[a + b for a, b in zip(value[0], other[0])], value[1] + other[1]]
+
+    def samples(self, values):
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            labels = list(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', labels + [('le', format_value(float(bound)))], cumulative))
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+    def compatible(self, value):
+        # buckets changed by a deploy
+        return len(value[0]) == len(self.buckets)
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # {metric name: [[label values, value], ...]}, JSON serializable
+    def dump(self):
+        return {metric.name: [[list(key), value] for key, value in metric.snapshot().items()] for metric in self.metrics}
+
+    # Adds up dump()s into {metric name: {label values: value}}
+    def merge(self, dumps):
+        merged = {metric.name: {} for metric in self.metrics}
+        metrics = {metric.name: metric for metric in self.metrics}
+        for dump in dumps:
+            for name, values in dump.items():
+                # removed since
+                if name not in metrics:
+                    continue
+                metric = metrics[name]
+                for key, value in values:
+                    key = tuple(key)
+                    if len(key) != len(metric.label_names) or not metric.compatible(value):
+                        continue
+                    merged[name][key] = metric.add(merged[name][key], value) if key in merged[name] else value
+        return merged
+
+    def expose(self, values=None):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose(None if values is None else values[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+REGISTRY = Registry()
+
+# Each worker's file, written by it alone
+class FileStore:
+    def __init__(self, registry):
+        self.registry = registry
+        self.lock = threading.Lock()
+        self.flushed_at = 0
+        self.process = None
+
+    @property
+    def directory(self):
+        return Path(settings.METRICS_DIR)
+
+    # <pid>-<random>.json, a new name in a forked process
+    def filename(self):
+        if self.process is None or self.process[0] != os.getpid():
+            self.process = (os.getpid(), uuid.uuid4().hex[:8])
+        return f'{self.process[0]}-{self.process[1]}.json'
+
+    def flush(self):
+        with self.lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            write_json(self.directory / self.filename(), self.registry.dump())
+            self.flushed_at = time.monotonic()
+
+    def flush_if_due(self):
+        if time.monotonic() - self.flushed_at >= settings.METRICS_FLUSH_SECONDS:
+            try:
+                self.flush()
+            except OSError:
+                # the request doesn't fail, the next one tries again
+                self.flushed_at = time.monotonic()
+                logger.exception('Could not write the metrics to %s', self.directory)
+
+    # Every worker's values added up
+    def collect(self):
+        self.flush()
+        with open(self.directory / '.lock', 'a') as lock:
+            locks.lock(lock, locks.LOCK_EX)
+            try:
+                self.retire()
+                dumps = [read_json(path) for path in self.directory.glob('*.json')]
+            finally:
+                locks.unlock(lock)
+        return self.registry.merge(dump for dump in dumps if dump is not None)
+
+    # Folds the files of the workers that are gone into RETIRED, called with the lock held
+    def retire(self):
+        gone = [path for path in self.directory.glob('*-*.json') if not process_alive(int(path.name.split('-')[0]))]
+        if not gone:
+            return
+        retired_path = self.directory / RETIRED
+        dumps = [read_json(retired_path)] + [read_json(path) for path in gone]
+        merged = self.registry.merge(dump for dump in dumps if dump is not None)
+        write_json(retired_path, {name: [[list(key), value] for key, value in values.items()] for name, values in merged.items()})
+        for path in gone:
+            path.unlink(missing_ok=True)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def read_json(path):
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+# Written beside the file and renamed into place, readers never see it half written
+def write_json(path, data):
+    with tempfile.NamedTemporaryFile('w', dir=path.parent, prefix='.writing-', delete=False) as file:
+        json.dump(data, file)
+    os.replace(file.name, path)
+
+STORE = FileStore(REGISTRY)
+# the last requests of a worker that's stopping
+atexit.register(lambda: settings.METRICS_ENABLED and STORE.flush())
+
+def active_customer_sessions():
+    counts = CustomerSession.objects.values('restaurant_id').annotate(count=Count('id')).order_by()
+    return {(row['restaurant_id'],): row['count'] for row in counts}
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'wms_http_request_duration_seconds', 'Time to respond to a request', ['route', 'method', 'status'],
+))
+ORDERS_PLACED = REGISTRY.register(Counter(
+    'wms_orders_placed_total', 'Orders placed by customers', ['restaurant'],
+))
+ORDER_ITEM_TRANSITION = REGISTRY.register(Histogram(
+    'wms_order_item_transition_seconds', 'Time an order item spent in its previous status', ['from_status', 'to_status'],
+    buckets=WAIT_BUCKETS,
+))
+ASSISTANCE_WAIT = REGISTRY.register(Histogram(
+    'wms_assistance_wait_seconds', 'Time a table waited for assistance', buckets=WAIT_BUCKETS,
+))
+STRIPE_CALL = REGISTRY.register(Histogram(
+    'wms_stripe_call_seconds', 'Stripe API calls, including the time queued for a gateway thread', ['operation', 'outcome'],
+))
+ACTIVE_CUSTOMER_SESSIONS = REGISTRY.register(Gauge(
+    'wms_active_customer_sessions', 'Seated tables', ['restaurant'], collect=active_customer_sessions,
+))
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        # streamed responses (the event stream) until their headers
+        match = request.resolver_match
+        REQUEST_DURATION.observe(
+            time.perf_counter() - started,
+            route=match.view_name if match else '<unresolved>', method=request.method, status=response.status_code,
+        )
+        STORE.flush_if_due()
+        return response
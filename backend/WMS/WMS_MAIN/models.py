@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 DIETARY_REQUIREMENT_CHOICES = [
     ('', 'None'),
@@ -19,8 +20,32 @@ DISH_STATUS = [
 class Restaurant(models.Model):
     name = models.CharField(max_length=100)
     location = models.CharField(max_length=200)
-    table_numbers = models.JSONField(max_length=1000)
+    # Legacy {"<table number>": <occupied>} document, superseded by Table and only read by
+    # the backfill_tables command. Can be dropped once every restaurant has been backfilled
+    table_numbers = models.JSONField(max_length=1000, default=dict, blank=True)
     num_categories = models.IntegerField(default=0)
+    # The manager's connected Stripe account and its onboarding state as last seen, kept up
+    # to date by Stripe's account.updated webhook and refreshed after
+    # settings.STRIPE_ACCOUNT_STATUS_TTL seconds (see stripe_views.py)
+    stripe_account_id = models.CharField(max_length=100, null=True, blank=True, unique=True)
+    stripe_details_submitted = models.BooleanField(default=False)
+    stripe_charges_enabled = models.BooleanField(default=False)
+    stripe_checked_at = models.DateTimeField(null=True, blank=True)
+
+# One row per table of a restaurant, seating and unseating are single row conditional
+# updates (see tables.py) so tables of the same restaurant don't contend for one row
+class Table(models.Model):
+    restaurant = models.ForeignKey(Restaurant, on_delete=models.CASCADE, related_name='tables')
+    number = models.IntegerField()
+    occupied = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['restaurant', 'number'], name='unique_restaurant_table_number'),
+        ]
+        indexes = [
+            models.Index(fields=['restaurant', 'occupied'], name='table_restaurant_occupied_idx'),
+        ]
 
 class InvitedUser(models.Model):
     email_address = models.CharField(max_length=320)
@@ -34,18 +59,27 @@ class RestaurantUser(models.Model):
 # CustomerSession -> Order -> OrderItem
 # X -> Y indicates that there exists many Ys to one X
 class CustomerSession(models.Model):
-    session = models.CharField(max_length=500)
+    # the customer's django session key, one table per session (see customers.py)
+    session = models.CharField(max_length=500, unique=True)
     table_number = models.IntegerField()
     restaurant = models.ForeignKey(Restaurant, on_delete=models.CASCADE)
     need_assistance = models.BooleanField(default=False)
+    # when the table asked for assistance, for the wait time metric (see metrics.py)
+    assistance_requested_at = models.DateTimeField(null=True, blank=True)
     
     class Meta:
         unique_together = ['table_number', 'restaurant']
+        indexes = [
+            # the tables waiting for a waiter, only a few sessions at a time
+            models.Index(fields=['restaurant'], condition=models.Q(need_assistance=True), name='session_assistance_idx'),
+        ]
 
 # an order is a batch of order items made at a point in time, associated with a customer session
 class Order(models.Model):
     customer_session = models.ForeignKey(CustomerSession, on_delete=models.CASCADE, null=True)
     order_time = models.TimeField(null=True)
+    # bumped on every save, used by the order feeds' ?since= cursor
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
@@ -53,6 +87,11 @@ class Category(models.Model):
     num_menu_items = models.IntegerField(default=0)
     position = models.IntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['restaurant', 'position'], name='category_position_idx'),
+        ]
+
 class MenuItem(models.Model):
     name = models.CharField(max_length=100)
     description = models.CharField(max_length=400)
@@ -63,14 +102,73 @@ class MenuItem(models.Model):
     popular = models.BooleanField(default=False)
     restaurant = models.ForeignKey(Restaurant, on_delete=models.CASCADE)
     image = models.ImageField(upload_to='menu_images/', blank=True, null=True, default='menu_images/default_img.png')
+    # resized copies of the processed image (see images.py), empty until it has been processed:
+    # [{'width': 320, 'jpeg': 'menu_images/<hash>-320.jpg', 'webp': 'menu_images/<hash>-320.webp'}, ...]
+    image_variants = models.JSONField(default=list, blank=True)
     position = models.IntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['restaurant', 'position'], name='menuitem_position_idx'),
+            # the shift of the later positions when a menu item is deleted (see positions.py)
+            models.Index(fields=['category', 'position'], name='menuitem_category_position_idx'),
+        ]
+
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     menu_item = models.ForeignKey(MenuItem, on_delete=models.CASCADE)
     # quantity = models.IntegerField()
     status = models.CharField(max_length=50, choices=DISH_STATUS, default='ORDER SENT')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # the kitchen's queue, most order items of a restaurant have been served
+            models.Index(fields=['order'], condition=~models.Q(status='SERVED'), name='orderitem_unserved_idx'),
+        ]
+
+# Records a deleted Order or OrderItem so that clients polling the order feeds
+# with a ?since= cursor can drop it, pruned after settings.ORDER_FEED_RETENTION_HOURS
+class FeedTombstone(models.Model):
+    restaurant = models.ForeignKey(Restaurant, on_delete=models.CASCADE)
+    table_number = models.IntegerField()
+    model_name = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+# Changed on every Category / MenuItem write, keys the cached menu snapshots (see menus.py)
+class MenuVersion(models.Model):
+    restaurant = models.OneToOneField(Restaurant, on_delete=models.CASCADE, primary_key=True)
+    version = models.BigIntegerField(default=0)
 
 class StripeUserData(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     stripe_id = models.CharField(max_length=100)
+
+EMAIL_STATUS = [
+    ('PENDING', 'Waiting to be sent'),
+    ('SENT', 'Sent'),
+    ('DEAD', 'Gave up after settings.EMAIL_OUTBOX_MAX_ATTEMPTS attempts'),
+]
+
+# Outbox of emails sent by the send_emails worker rather than inside requests (see outbox.py)
+class OutgoingEmail(models.Model):
+    subject = models.CharField(max_length=200)
+    body = models.TextField()
+    html_body = models.TextField(blank=True, default='')
+    from_email = models.CharField(max_length=320)
+    to = models.JSONField(default=list)
+    # names of the inline images of outbox.image_data() the html body refers to
+    inline_images = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=10, choices=EMAIL_STATUS, default='PENDING')
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the worker's queue
+            models.Index(fields=['next_attempt_at'], condition=models.Q(status='PENDING'), name='email_pending_idx'),
+        ]
@@ -0,0 +1,119 @@
+from datetime import timedelta
+from email.mime.image import MIMEImage
+from functools import lru_cache
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+from .models import OutgoingEmail
+
+# Email outbox
+# Requests only store the email (enqueue_email), the send_emails worker sends the pending ones
+# in batches of settings.EMAIL_OUTBOX_BATCH_SIZE over one reused SMTP connection.
+# A failed email is retried after settings.EMAIL_OUTBOX_RETRY_SECONDS, doubling each attempt, and
+# is dead-lettered (status 'DEAD', with its last error) after settings.EMAIL_OUTBOX_MAX_ATTEMPTS.
+# Several workers can run at once. Each batch is claimed in a short transaction (SELECT ... FOR
+# UPDATE SKIP LOCKED) that leases it, pushing its next attempt settings.EMAIL_OUTBOX_LEASE_SECONDS
+# away, and is then sent outside of any transaction, so a slow SMTP server holds no row lock.
+# Delivery is at least once: the emails of a worker killed mid-batch that weren't marked sent
+# are due again when their lease ends.
+
+def enqueue_email(subject, body, to, html_body='', inline_images=(), from_email="noreply@somehost.local"):
+    return OutgoingEmail.objects.create(
+        subject=subject,
+        body=body,
+        html_body=html_body,
+        from_email=from_email,
+        to=list(to),
+        inline_images=list(inline_images),
+    )
+
+# Inline images of the html emails by name, built once per process
+@lru_cache()
+def image_data():
+    images = {}
+
+    with open(finders.find('images/image-7.png'), 'rb') as f:
+        image_data = f.read()
+    logo = MIMEImage(image_data)
+    logo.add_header('Content-ID', '<logo>')
+    images['logo'] = logo
+
+    with open(finders.find('images/panda_logo.png'), 'rb') as f:
+        image_data = f.read()
+    panda = MIMEImage(image_data)
+    panda.add_header('Content-ID', '<panda>')
+    images['panda'] = panda
+
+    return images
+
+def build_message(email, connection):
+    msg = EmailMultiAlternatives(email.subject, email.body, email.from_email, email.to, connection=connection)
+    if email.html_body:
+        msg.attach_alternative(email.html_body, "text/html")
+    images = image_data()
+    for name in email.inline_images:
+        msg.attach(images[name])
+    return msg
+
+# Sends one batch of due emails, returns the number of emails attempted
+def send_batch(batch_size=None):
+    emails = claim_batch(batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE)
+    if not emails:
+        return 0
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as error:
+        # nothing can be sent, every email of the batch counts a failed attempt
+        for email in emails:
+            failed(email, error)
+            save_attempt(email)
+        return len(emails)
+    try:
+        for email in emails:
+            try:
+                build_message(email, connection).send()
+            except Exception as error:
+                failed(email, error)
+            else:
+                email.status = 'SENT'
+                email.sent_at = timezone.now()
+                email.attempts += 1
+            save_attempt(email)
+    finally:
+        connection.close()
+    return len(emails)
+
+# Leases up to batch_size due emails to this worker, other workers skip them
+def claim_batch(batch_size):
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='PENDING', next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        lease_end = now + timedelta(seconds=settings.EMAIL_OUTBOX_LEASE_SECONDS)
+        OutgoingEmail.objects.filter(pk__in=[email.pk for email in emails]).update(next_attempt_at=lease_end)
+    return emails
+
+def save_attempt(email):
+    email.save(update_fields=['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+
+def failed(email, error):
+    email.attempts += 1
+    email.last_error = f'{type(error).__name__}: {error}'
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = 'DEAD'
+    else:
+        delay = settings.EMAIL_OUTBOX_RETRY_SECONDS * 2 ** (email.attempts - 1)
+        email.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+
+# Puts dead-lettered emails back in the queue, returns how many
+def retry_dead_emails():
+    return OutgoingEmail.objects.filter(status='DEAD').update(
+        status='PENDING', attempts=0, next_attempt_at=timezone.now(), last_error=''
+    )
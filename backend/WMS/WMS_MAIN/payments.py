@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import stripe
+from django.conf import settings
+from .metrics import STRIPE_CALL
+
+# Stripe payment gateway
+# Stripe's library only makes blocking HTTP calls, so the gateway runs them on its own pool of
+# settings.STRIPE_MAX_CONCURRENCY threads and the Stripe views (stripe_views.py) await them.
+# A slow Stripe then only ties up that pool instead of the threads serving order traffic.
+#   - each pool thread keeps its own HTTP session, so connections to Stripe are reused
+#   - every HTTP attempt times out after settings.STRIPE_TIMEOUT seconds
+#   - connection errors, 409s and 5xxs are retried settings.STRIPE_MAX_RETRIES times with
+#     exponential backoff (Stripe's library sends an idempotency key, so retries are safe)
+#   - a call that hasn't finished after settings.STRIPE_CALL_TIMEOUT seconds, including the
+#     time queued for a thread, fails with an APIConnectionError
+# settings.STRIPE_API_BASE can point the gateway at the fake Stripe (fake_stripe.py).
+# Example usage:
+#   account = await get_gateway().retrieve_account(stripe_id)
+class StripeGateway:
+    def __init__(self, api_key, api_base, timeout, max_retries, max_concurrency, call_timeout):
+        self.call_timeout = call_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='stripe')
+        if api_key:
+            self.client = stripe.StripeClient(
+                api_key,
+                base_addresses={'api': api_base, 'connect': api_base},
+                max_network_retries=max_retries,
+                http_client=stripe.RequestsClient(timeout=timeout),
+            )
+        else:
+            self.client = None
+
+    # Runs a blocking Stripe call on the gateway's pool, its latency is recorded by operation
+    async def call(self, operation, method, *args, **kwargs):
+        if self.client is None:
+            raise stripe.error.AuthenticationError('No Stripe API key provided, set STRIPE_KEY')
+        started = time.perf_counter()
+        outcome = 'error'
+        future = self.executor.submit(method, *args, **kwargs)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.call_timeout)
+            outcome = 'ok'
+            return result
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            # only drops the call if it is still queued, a running request ends with its own timeout
+            future.cancel()
+            raise stripe.error.APIConnectionError('Timed out waiting for Stripe')
+        finally:
+            STRIPE_CALL.observe(time.perf_counter() - started, operation=operation, outcome=outcome)
+
+    async def create_account(self, params):
+        return await self.call('create_account', lambda: self.client.accounts.create(params))
+
+    async def retrieve_account(self, stripe_id):
+        return await self.call('retrieve_account', lambda: self.client.accounts.retrieve(stripe_id))
+
+    async def create_account_link(self, params):
+        return await self.call('create_account_link', lambda: self.client.account_links.create(params))
+
+    # Stripe returns the session created first for a repeated idempotency key (for 24 hours)
+    async def create_checkout_session(self, params, idempotency_key=None):
+        options = {'idempotency_key': idempotency_key} if idempotency_key else {}
+        return await self.call('create_checkout_session', lambda: self.client.checkout.sessions.create(params, options))
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+# Returns the gateway for the current settings, one instance (and pool) per process
+def get_gateway():
+    options = (
+        settings.STRIPE_API_KEY,
+        settings.STRIPE_API_BASE,
+        settings.STRIPE_TIMEOUT,
+        settings.STRIPE_MAX_RETRIES,
+        settings.STRIPE_MAX_CONCURRENCY,
+        settings.STRIPE_CALL_TIMEOUT,
+    )
+    with _gateways_lock:
+        if options not in _gateways:
+            _gateways[options] = StripeGateway(*options)
+        return _gateways[options]
@@ -0,0 +1,86 @@
+from django.db import transaction
+from django.db.models import Count, F
+from .menus import bump_menu_version
+from .models import Category, MenuItem, Restaurant
+
+# Menu positions
+# Categories are numbered 1..Restaurant.num_categories within a restaurant and menu items
+# 1..Category.num_menu_items within their category. Appending and deleting change the
+# counters with F() expressions and shift the later positions with a single UPDATE, so
+# concurrent managers cannot read a stale counter. repair_menu_positions rebuilds both.
+
+# Increments the counter and returns the position at the end of the list. The UPDATE holds
+# the counter's row lock until the transaction commits, so concurrent appends are serialized
+def next_category_position(restaurant):
+    Restaurant.objects.filter(pk=restaurant.pk).update(num_categories=F('num_categories') + 1)
+    restaurant.refresh_from_db(fields=['num_categories'])
+    return restaurant.num_categories
+
+def next_menu_item_position(category):
+    Category.objects.filter(pk=category.pk).update(num_menu_items=F('num_menu_items') + 1)
+    category.refresh_from_db(fields=['num_menu_items'])
+    return category.num_menu_items
+
+def delete_category(category):
+    with transaction.atomic():
+        # re-read the position under a lock, a concurrent delete may have shifted it
+        position = Category.objects.select_for_update().filter(pk=category.pk).values_list('position', flat=True).first()
+        if position is None:
+            return
+        Category.objects.filter(restaurant_id=category.restaurant_id, position__gt=position).update(position=F('position') - 1)
+        Restaurant.objects.filter(pk=category.restaurant_id).update(num_categories=F('num_categories') - 1)
+        category.delete()
+
+def delete_menu_item(menu_item):
+    with transaction.atomic():
+        row = MenuItem.objects.select_for_update().filter(pk=menu_item.pk).values_list('category_id', 'position').first()
+        if row is None:
+            return
+        category_id, position = row
+        # uncategorised menu items are not numbered
+        if category_id is not None:
+            MenuItem.objects.filter(category_id=category_id, position__gt=position).update(position=F('position') - 1)
+            Category.objects.filter(pk=category_id).update(num_menu_items=F('num_menu_items') - 1)
+        menu_item.delete()
+
+# Renumbers a restaurant's categories and menu items 1..n in their current order (ties broken
+# by id) and recounts num_categories / num_menu_items. Only the changed rows are written.
+# Returns the number of rows written
+def repair_menu_positions(restaurant_id):
+    with transaction.atomic():
+        restaurant = Restaurant.objects.select_for_update().get(pk=restaurant_id)
+        categories = list(
+            Category.objects.filter(restaurant_id=restaurant_id)
+            .annotate(menu_item_count=Count('menuitem'))
+            .order_by('position', 'id')
+        )
+        menu_items = list(
+            MenuItem.objects.filter(restaurant_id=restaurant_id, category__isnull=False)
+            .order_by('category_id', 'position', 'id')
+        )
+
+        changed_categories = []
+        for position, category in enumerate(categories, start=1):
+            if category.position != position or category.num_menu_items != category.menu_item_count:
+                category.position = position
+                category.num_menu_items = category.menu_item_count
+                changed_categories.append(category)
+
+        changed_menu_items = []
+        positions = {}
+        for menu_item in menu_items:
+            position = positions[menu_item.category_id] = positions.get(menu_item.category_id, 0) + 1
+            if menu_item.position != position:
+                menu_item.position = position
+                changed_menu_items.append(menu_item)
+
+        Category.objects.bulk_update(changed_categories, ['position', 'num_menu_items'], batch_size=500)
+        MenuItem.objects.bulk_update(changed_menu_items, ['position'], batch_size=500)
+        written = len(changed_categories) + len(changed_menu_items)
+        if restaurant.num_categories != len(categories):
+            Restaurant.objects.filter(pk=restaurant_id).update(num_categories=len(categories))
+            written += 1
+        if changed_categories or changed_menu_items:
+            # bulk_update does not send the signals that invalidate the menu snapshot
+            bump_menu_version(restaurant_id)
+    return written
@@ -0,0 +1,184 @@
+import threading
+import time
+from collections import deque
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.postgresql import base, creation
+from django.db.backends.postgresql.psycopg_any import IsolationLevel
+
+# PostgreSQL backend with a pool of connections per worker process
+# ENGINE 'WMS_MAIN.postgres_pool' behaves like django.db.backends.postgresql until
+# OPTIONS['pool'] is set, with the options of Django 5.1's pool (which needs psycopg 3):
+#   'OPTIONS': {'pool': {'max_size': 10, 'timeout': 10, 'max_idle': 300, 'max_lifetime': 3600}}
+# Closing a connection (at the end of every request, CONN_MAX_AGE has to be 0) gives it back to
+# the pool, the next request of any thread takes it rather than opening a new one. At most
+# max_size connections are in use at once, a request waits up to timeout seconds for one and
+# then fails with an OperationalError. Idle connections are closed after max_idle seconds and
+# all of them after max_lifetime seconds. With CONN_HEALTH_CHECKS an idle connection is
+# checked with SELECT 1 before being handed out.
+# Unlike persistent connections (CONN_MAX_AGE) this works under ASGI, where every request runs
+# on its own thread.
+
+POOL_DEFAULTS = {'max_size': 10, 'timeout': 10, 'max_idle': 300, 'max_lifetime': 3600}
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+class ConnectionPool:
+    def __init__(self, max_size, timeout, max_idle, max_lifetime):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        # (connection, returned at), the most recently returned last
+        self.idle = deque()
+        # opening time of every open connection
+        self.opened_at = {}
+
+    # Returns an idle connection that passes check(connection), or one from connect()
+    def getconn(self, connect, check=None):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f'No database connection available after {self.timeout}s ({self.max_size} in use)')
+        try:
+            while True:
+                with self.lock:
+                    connection, returned_at = self.idle.pop() if self.idle else (None, None)
+                if connection is None:
+                    connection = connect()
+                    with self.lock:
+                        self.opened_at[connection] = time.monotonic()
+                    return connection
+                now = time.monotonic()
+                if (
+                    connection.closed
+                    or now - returned_at > self.max_idle
+                    or now - self.opened_at.get(connection, 0) > self.max_lifetime
+                    or (check is not None and not check(connection))
+                ):
+                    self.discard(connection)
+                    continue
+                return connection
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def putconn(self, connection):
+        try:
+            if not connection.closed and connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    self.discard(connection)
+                    return
+            if connection.closed or time.monotonic() - self.opened_at.get(connection, 0) > self.max_lifetime:
+                self.discard(connection)
+                return
+            now = time.monotonic()
+            with self.lock:
+                self.idle.append((connection, now))
+                # the least recently used ones, idle for too long
+                expired = []
+                while now - self.idle[0][1] > self.max_idle:
+                    expired.append(self.idle.popleft()[0])
+            for expired_connection in expired:
+                self.discard(expired_connection)
+        finally:
+            self.slots.release()
+
+    def discard(self, connection):
+        with self.lock:
+            self.opened_at.pop(connection, None)
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    # Closes the idle connections, the ones in use are closed when they're given back
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for connection, _ in idle:
+            self.discard(connection)
+        self.max_lifetime = -1
+
+# One pool per database and connection parameters, shared by the threads of the process
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(key, options):
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(**{**POOL_DEFAULTS, **options})
+        return _pools[key]
+
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # idle pooled connections would keep the test database in use
+        close_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+    # the pool of the current connection, None if it isn't pooled
+    pool = None
+
+    @property
+    def pool_options(self):
+        options = self.settings_dict['OPTIONS'].get('pool')
+        if not options:
+            return None
+        if self.settings_dict['CONN_MAX_AGE'] != 0:
+            raise ImproperlyConfigured('Pooled connections are given back at the end of each request, set CONN_MAX_AGE to 0.')
+        return {} if options is True else options
+
+    def get_connection_params(self):
+        conn_params = super().get_connection_params()
+        conn_params.pop('pool', None)
+        return conn_params
+
+    def get_new_connection(self, conn_params):
+        options = self.pool_options
+        if options is None:
+            return super().get_new_connection(conn_params)
+        pool = get_pool((self.alias, repr(sorted(conn_params.items()))), options)
+        check = self.connection_is_usable if self.settings_dict['CONN_HEALTH_CHECKS'] else None
+        connection = pool.getconn(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params), check)
+        # set by get_new_connection for the connections it opens, the pool's all have it
+        self.isolation_level = IsolationLevel(self.settings_dict['OPTIONS'].get('isolation_level', IsolationLevel.READ_COMMITTED))
+        self.pool = pool
+        return connection
+
+    @staticmethod
+    def connection_is_usable(connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            # outside autocommit the SELECT started a transaction
+            if connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _close(self):
+        if self.pool is None or self.connection is None:
+            return super()._close()
+        connection, pool = self.connection, self.pool
+        self.connection = self.pool = None
+        with self.wrap_database_errors:
+            pool.putconn(connection)
+
+    def close_if_health_check_failed(self):
+        # the pool only hands out checked connections, and they're given back after each request
+        if self.pool is None:
+            super().close_if_health_check_failed()
@@ -3,6 +3,10 @@ from django.contrib.auth.models import User
 from . import models as app_models
 from rest_framework.exceptions import NotFound
 from WMS_MAIN.models import DISH_STATUS
+from django.db import transaction
+from .positions import next_category_position, next_menu_item_position
+from .tables import table_numbers
+from .images import schedule_image_processing, validate_menu_image
 
 # TODO add restaurant
 class UserSerializer(serializers.ModelSerializer):
@@ -16,10 +20,14 @@ class UserSerializer(serializers.ModelSerializer):
         return user
     
 class RestaurantSerializer(serializers.ModelSerializer):
+    table_numbers = serializers.SerializerMethodField()
     class Meta:
         model = app_models.Restaurant
         fields = ['name', 'location', 'table_numbers', 'num_categories']
 
+    def get_table_numbers(self, restaurant):
+        return table_numbers(restaurant.id)
+
 class CombinedRegistrationSerializer(serializers.Serializer):
     # Fields for Manager, Restaurant, and RestaurantUser models
     manager = UserSerializer()
@@ -123,49 +131,77 @@ class OrderItemSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('Invalid status')
         return data
 
-class CategorySerializer(serializers.ModelSerializer):
+# Saves only the fields given in an update, so that editing a category or menu item does not
+# write back a stale copy of the counters and positions maintained in positions.py
+class UpdateGivenFieldsMixin:
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=list(validated_data))
+        return instance
+
+class CategorySerializer(UpdateGivenFieldsMixin, serializers.ModelSerializer):
     pk = serializers.IntegerField(source='id', read_only=True)
     class Meta:
         model = app_models.Category
         fields = ['pk', 'name', 'restaurant', 'num_menu_items', 'position']
+        read_only_fields = ['num_menu_items']
 
     def create(self, validated_data):
-        restaurant = validated_data['restaurant']
-        last_position = restaurant.num_categories + 1
-        validated_data['position'] = last_position
-
-        restaurant.num_categories += 1
-        restaurant.save()
-        return super().create(validated_data=validated_data)
-    
-    def destroy(self, instance):
-        restaurant = instance.restaurant
-        restaurant.num_categories -= 1
-        restaurant.save()
-
-        return super().destroy(instance)
+        with transaction.atomic():
+            validated_data['position'] = next_category_position(validated_data['restaurant'])
+            return super().create(validated_data=validated_data)
 
-class MenuItemSerializer(serializers.ModelSerializer):
+# image_srcset is {'jpeg': '<url> 320w, <url> 640w, ...', 'webp': ...} for <picture> / srcset and
+# thumbnail the smallest JPEG, both fall back to the image itself until it has been processed
+class MenuItemSerializer(UpdateGivenFieldsMixin, serializers.ModelSerializer):
     pk = serializers.IntegerField(source='id', read_only=True)
+    image_srcset = serializers.SerializerMethodField()
+    thumbnail = serializers.SerializerMethodField()
     class Meta:
         model = app_models.MenuItem
-        fields = ['pk', 'name', 'description', 'price', 'category', 'dietary_requirements', 'preparation_time', 'restaurant', 'popular', 'image', 'position']
+        fields = ['pk', 'name', 'description', 'price', 'category', 'dietary_requirements', 'preparation_time', 'restaurant', 'popular', 'image', 'image_srcset', 'thumbnail', 'position']
 
-    def create(self, validated_data):
-        category = validated_data['category']
-        last_position = category.num_menu_items + 1
-        validated_data['position'] = last_position
+    def validate_image(self, image):
+        if image is not None:
+            validate_menu_image(image)
+        return image
 
-        category.num_menu_items += 1
-        category.save()
-        return super().create(validated_data=validated_data)
-    
-    def destroy(self, instance):
-        category = instance.category
-        category.num_menu_items -= 1
-        category.save()
+    def create(self, validated_data):
+        with transaction.atomic():
+            # uncategorised menu items are not numbered
+            if category := validated_data.get('category'):
+                validated_data['position'] = next_menu_item_position(category)
+            menu_item = super().create(validated_data=validated_data)
+            if validated_data.get('image'):
+                schedule_image_processing(menu_item.id)
+            return menu_item
+
+    def update(self, instance, validated_data):
+        if 'image' in validated_data:
+            validated_data['image_variants'] = []
+        menu_item = super().update(instance, validated_data)
+        if validated_data.get('image'):
+            schedule_image_processing(menu_item.id)
+        return menu_item
+
+    def image_url(self, name):
+        url = app_models.MenuItem._meta.get_field('image').storage.url(name)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request is not None else url
+
+    def get_image_srcset(self, menu_item):
+        if not menu_item.image_variants:
+            return None
+        return {
+            image_format: ', '.join(f"{self.image_url(variant[image_format])} {variant['width']}w" for variant in menu_item.image_variants)
+            for image_format in ('jpeg', 'webp')
+        }
 
-        return super().destroy(instance)
+    def get_thumbnail(self, menu_item):
+        if menu_item.image_variants:
+            return self.image_url(menu_item.image_variants[0]['jpeg'])
+        return self.image_url(menu_item.image.name) if menu_item.image else None
 
     # def create(self, validated_data):
     #     image_data = validated_data.pop('image', None)
@@ -176,10 +212,14 @@ class MenuItemSerializer(serializers.ModelSerializer):
     #     return super().create(validated_data=validated_data)
 
 class TableSerializer(serializers.ModelSerializer):
+    table_numbers = serializers.SerializerMethodField()
     class Meta:
         model = app_models.Restaurant
         fields = ['table_numbers']
 
+    def get_table_numbers(self, restaurant):
+        return table_numbers(restaurant.id)
+
 class StripeUserSerializer(serializers.Serializer):
     stripe_id = serializers.CharField()
     
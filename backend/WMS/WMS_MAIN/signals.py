@@ -1,5 +1,4 @@
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
 from django.dispatch import receiver
 from django.template.loader import render_to_string
 from django.urls import reverse
@@ -12,10 +11,16 @@ from django.contrib.sites.shortcuts import get_current_site
 # imports we need to render the template to use in the email
 from django.template.loader import render_to_string
 
-from email.mime.image import MIMEImage
-
-from django.contrib.staticfiles import finders
-from functools import lru_cache
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import pre_delete, post_save, post_delete
+from django.contrib.auth.models import User
+from rest_framework.authtoken.models import Token
+from .models import CustomerSession, Order, OrderItem, Category, MenuItem, Restaurant, RestaurantUser
+from .authentication import invalidate_token, invalidate_user
+from .feeds import record_deleted_order_items, record_deleted_orders
+from .menus import bump_menu_version
+from .outbox import enqueue_email
 
 # https://pypi.org/project/django-rest-passwordreset/
 # pip install django-rest-passwordreset
@@ -29,6 +34,7 @@ from functools import lru_cache
 # For testing purposes
 # curl -X POST http://127.0.0.1:8000/api/password_reset/ -d "email=pagares775@dacgu.com" 
 # Insert any email that is currently in your database to test
+# The email is only queued here, the send_emails worker sends it (see outbox.py)
 @receiver(reset_password_token_created)
 def password_reset_token_created(sender, instance, reset_password_token, *args, **kwargs):
     # we get the current site to get the domain
@@ -51,38 +57,68 @@ def password_reset_token_created(sender, instance, reset_password_token, *args,
     email_html_message = render_to_string('user_reset_password.html', context)
     email_plaintext_message = render_to_string('user_reset_password.txt', context)
 
-    msg = EmailMultiAlternatives(
+    enqueue_email(
         # title:
         "Password Reset for {title}".format(title="WMS User"),
         # message:
         email_plaintext_message,
-        # from:
-        "noreply@somehost.local",
         # to:
-        [reset_password_token.user.email]
+        [reset_password_token.user.email],
+        html_body=email_html_message,
+        inline_images=['logo', 'panda'],
     )
-    msg.attach_alternative(email_html_message, "text/html")
-    images = image_data()
-    for image_name, image in images.items():
-        msg.attach(image)
-    msg.send()
-
-# Attach assets to email
-@lru_cache()
-def image_data():
-    images = {}
-
-    with open(finders.find('images/image-7.png'), 'rb') as f:
-        image_data = f.read()
-    logo = MIMEImage(image_data)
-    logo.add_header('Content-ID', '<logo>')
-    images['logo'] = logo
-
-    with open(finders.find('images/panda_logo.png'), 'rb') as f:
-        image_data = f.read()
-    panda = MIMEImage(image_data)
-    panda.add_header('Content-ID', '<panda>')
-    images['panda'] = panda
-
-    return images
 
+# Order feed tombstones (see feeds.py)
+# pre_delete runs before the cascade so the orders and order items can still be read.
+# Ending a customer session records every order of the table in one batch
+@receiver(pre_delete, sender=CustomerSession)
+def customer_session_deleted(sender, instance, **kwargs):
+    orders = Order.objects.filter(customer_session=instance)
+    record_deleted_orders(orders, instance.restaurant_id, instance.table_number)
+
+# Orders deleted on their own (not as part of a customer session's cascade)
+@receiver(pre_delete, sender=Order)
+def order_deleted(sender, instance, origin=None, **kwargs):
+    deleted_directly = isinstance(origin, Order) or (isinstance(origin, QuerySet) and origin.model is Order)
+    if deleted_directly and (customer_session := instance.customer_session):
+        orders = Order.objects.filter(pk=instance.pk)
+        record_deleted_orders(orders, customer_session.restaurant_id, customer_session.table_number)
+
+# Whether a delete cascades from restaurants, one or a queryset of them
+def restaurant_deleted(origin):
+    return isinstance(origin, Restaurant) or (isinstance(origin, QuerySet) and origin.model is Restaurant)
+
+# Order items deleted with their menu item (delete_menu_item in positions.py), their orders stay.
+# Nothing to record when the whole restaurant is deleted, its tombstones go with it
+@receiver(pre_delete, sender=MenuItem)
+def menu_item_deleted(sender, instance, origin=None, **kwargs):
+    if restaurant_deleted(origin):
+        return
+    record_deleted_order_items(OrderItem.objects.filter(menu_item=instance))
+
+# Any menu write invalidates the restaurant's cached menu snapshot (see menus.py)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=MenuItem)
+def menu_changed(sender, instance, origin=None, **kwargs):
+    # nothing to invalidate when the whole restaurant is deleted, bumping would recreate its
+    # MenuVersion row and fail the delete's foreign keys
+    if restaurant_deleted(origin):
+        return
+    bump_menu_version(instance.restaurant_id)
+
+# Cached token authentication (see authentication.py)
+# The entry is dropped again once the transaction commits, in case a concurrent request
+# cached the old rows in between
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    key = instance.key
+    invalidate_token(key)
+    transaction.on_commit(lambda: invalidate_token(key))
+
+# role changes and deactivated or deleted users
+@receiver([post_save, post_delete], sender=RestaurantUser)
+@receiver([post_save, post_delete], sender=User)
+def token_user_changed(sender, instance, **kwargs):
+    user_id = instance.user_id if sender is RestaurantUser else instance.id
+    invalidate_user(user_id)
+    transaction.on_commit(lambda: invalidate_user(user_id))
@@ -1,136 +1,251 @@
-from rest_framework.views import APIView
-from rest_framework.response import Response
-from django.http import HttpResponseRedirect
-from rest_framework import status
+import functools
+import hashlib
+import json
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.urls import reverse
-from .serializers import StripeUserSerializer, OrderItemSerializer
-from .models import RestaurantUser, OrderItem, CustomerSession as CustomerSessionModel
-from rest_framework.exceptions import NotFound, ValidationError
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from .serializers import StripeUserSerializer
+from .models import Restaurant
+from .authentication import CachedTokenAuthentication
+from .customers import get_customer_session
+from .billing import compute_bill
+from .payments import get_gateway
+from rest_framework.exceptions import APIException, NotFound, ValidationError
 import stripe
 from django.contrib.sites.shortcuts import get_current_site
 
-import os
-from dotenv import load_dotenv
+# The Stripe views are async so that a slow Stripe doesn't hold a server thread: database work
+# runs through sync_to_async and the Stripe calls are awaited on the payment gateway's own
+# thread pool (see payments.py). Like the other api views they take a staff token or a
+# customer session and answer errors with JSON.
+# The restaurant's connected account and its onboarding state are kept on the Restaurant, so
+# status checks and checkouts read one local row instead of asking Stripe every time.
 
-load_dotenv(os.path.join(os.path.dirname(__file__), '../.env'))
-stripe.api_key = os.getenv("STRIPE_KEY")
-
-# curl -X POST http://127.0.0.1:8000/api/register/ -d "email=stripetest@gmail.com&password=stripetest&name=stripe&location=stripe" 
-# curl -X POST http://127.0.0.1:8000/api/login/ -d "username=stripetest@gmail&password=stripetest" 
+# curl -X POST http://127.0.0.1:8000/api/register/ -d "email=stripetest@gmail.com&password=stripetest&name=stripe&location=stripe"
+# curl -X POST http://127.0.0.1:8000/api/login/ -d "username=stripetest@gmail&password=stripetest"
 # curl -X POST http://127.0.0.1:8000/api/v1/accounts/
 
-class StripeAccountExpress(APIView):
-    def post(self, request):
-        if hasattr(self.request.user, "stripeuserdata"):
-            return Response({'message': "User already has a stripe account"}, status=status.HTTP_400_BAD_REQUEST)
+# Wraps an async Stripe view: restricts it to the given method, exempts it from CSRF like the
+# rest framework's views and turns the rest framework's exceptions into JSON responses
+def stripe_view(method):
+    def decorator(view):
+        @csrf_exempt
+        @require_http_methods([method])
+        @functools.wraps(view)
+        async def wrapper(request):
+            try:
+                return await view(request)
+            except APIException as error:
+                # the same body as the rest framework's exception handler
+                data = error.detail if isinstance(error.detail, (list, dict)) else {'detail': error.detail}
+                return JsonResponse(data, status=error.status_code, safe=False)
+        return wrapper
+    return decorator
+
+# The staff member of the token in the Authorization header, AnonymousUser without a token
+@sync_to_async
+def authenticate(request):
+    result = CachedTokenAuthentication().authenticate(request)
+    return result[0] if result else AnonymousUser()
+
+STRIPE_STATUS_FIELDS = ['stripe_account_id', 'stripe_details_submitted', 'stripe_charges_enabled', 'stripe_checked_at']
+
+# The Stripe fields of the staff member's restaurant, None if the user isn't a staff member
+@sync_to_async
+def restaurant_stripe_status(user):
+    if not hasattr(user, 'restaurantuser'):
+        return None
+    return Restaurant.objects.filter(id=user.restaurantuser.restaurant_id).values(*STRIPE_STATUS_FIELDS).first()
+
+# Stores the account's onboarding state on the restaurants connected to it
+@sync_to_async
+def update_account_status(account):
+    Restaurant.objects.filter(stripe_account_id=account['id']).update(
+        stripe_details_submitted=bool(account.get('details_submitted')),
+        stripe_charges_enabled=bool(account.get('charges_enabled')),
+        stripe_checked_at=timezone.now(),
+    )
+
+# Returns the serializer's errors, None once the account is saved for the user and their restaurant
+@sync_to_async
+def save_stripe_account(user, account):
+    serializer = StripeUserSerializer(data={'stripe_id': account['id']}, context={'user': user})
+    if not serializer.is_valid():
+        return serializer.errors
+    serializer.save()
+    Restaurant.objects.filter(id=user.restaurantuser.restaurant_id).update(
+        stripe_account_id=account['id'],
+        stripe_details_submitted=bool(account.get('details_submitted')),
+        stripe_charges_enabled=bool(account.get('charges_enabled')),
+        stripe_checked_at=timezone.now(),
+    )
+    return None
+
+@stripe_view('POST')
+async def stripe_account_express(request):
+    user = await authenticate(request)
+    stripe_status = await restaurant_stripe_status(user)
+    if stripe_status is None:
+        return JsonResponse({'error': 'You are not a staff member.'}, status=403)
+    if stripe_status['stripe_account_id']:
+        return JsonResponse({'message': "User already has a stripe account"}, status=400)
+    try:
+        response = await get_gateway().create_account({'type': 'express'})
+    except stripe.error.StripeError as e:
+        # Handle any errors that occur during the API request
+        return JsonResponse(str(e), status=400, safe=False)
+    if errors := await save_stripe_account(user, response):
+        return JsonResponse(errors, status=400)
+
+    # we get the current site to get the domain
+    current_site = get_current_site(request)
+    link_url = reverse('stripe-account-link')
+
+    # we get the refresh and return url
+    account_link_url = f'https://{current_site.domain}{link_url}'
+    return HttpResponseRedirect(account_link_url)
+
+@stripe_view('POST')
+async def stripe_account_link(request):
+    user = await authenticate(request)
+    stripe_status = await restaurant_stripe_status(user)
+    if not (stripe_status and (stripe_id := stripe_status['stripe_account_id'])):
+        return JsonResponse({'error': 'create stripe account first'}, status=400)
+
+    # we get the current site to get the domain
+    current_site = get_current_site(request)
+
+    # we get the refresh and return url
+    domain_url = f'https://{current_site.domain}'
+    refresh = f'{domain_url}/api/v1/account_links/'
+
+    try:
+        response = await get_gateway().create_account_link({
+            'account': stripe_id,
+            'refresh_url': refresh,
+            'return_url': domain_url,
+            'type': "account_onboarding",
+        })
+    except stripe.error.StripeError as e:
+        return JsonResponse(str(e), status=400, safe=False)
+    return HttpResponseRedirect(response.url)
+
+# Whether the manager has finished Stripe's onboarding
+# Response:
+#   - Status 200: {'details': <details submitted>, 'charges_enabled': <charges enabled>}
+#     from the restaurant's row, Stripe is only asked once the state is older than
+#     settings.STRIPE_ACCOUNT_STATUS_TTL seconds (the stored state is returned if that fails)
+#   - Status 404: if the restaurant has no Stripe account
+@stripe_view('GET')
+async def stripe_account_details_status(request):
+    user = await authenticate(request)
+    stripe_status = await restaurant_stripe_status(user)
+    if not (stripe_status and stripe_status['stripe_account_id']):
+        return JsonResponse({'error': "User does not have stripe account"}, status=404)
+
+    checked_at = stripe_status['stripe_checked_at']
+    if checked_at is None or timezone.now() - checked_at > timedelta(seconds=settings.STRIPE_ACCOUNT_STATUS_TTL):
         try:
-            response = stripe.Account.create(type="express")
+            account = await get_gateway().retrieve_account(stripe_status['stripe_account_id'])
         except stripe.error.StripeError as e:
-            # Handle any errors that occur during the API request
-            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
-        serializer = StripeUserSerializer(data={'stripe_id': response['id']}, context={'user': self.request.user})
-        if serializer.is_valid():
-            serializer.save()
-            # we get the current site to get the domain
-            current_site = get_current_site(request)
-            link_url = reverse('stripe-account-link')
-
-            # we get the refresh and return url
-            account_link_url = f'https://{current_site.domain}{link_url}'
-            return HttpResponseRedirect(account_link_url)
+            if checked_at is None:
+                return JsonResponse(str(e), status=400, safe=False)
         else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-class StripeAccountLink(APIView):
-    def post(self, request):
-        user = self.request.user
-        if not hasattr(user, "stripeuserdata"):
-            return Response({'error': 'create stripe account first'}, status=status.HTTP_400_BAD_REQUEST)
-
-        # we get the current site to get the domain
-        current_site = get_current_site(request)
-
-        # we get the refresh and return url
-        domain_url = f'https://{current_site.domain}'
-        refresh = f'{domain_url}/api/v1/account_links/'
-
-        response = stripe.AccountLink.create(
-            account=user.stripeuserdata.stripe_id,
-            refresh_url=refresh,
-            return_url=domain_url,
-            type="account_onboarding",
+            await update_account_status(account)
+            stripe_status['stripe_details_submitted'] = bool(account.get('details_submitted'))
+            stripe_status['stripe_charges_enabled'] = bool(account.get('charges_enabled'))
+    return JsonResponse({
+        'details': stripe_status['stripe_details_submitted'],
+        'charges_enabled': stripe_status['stripe_charges_enabled'],
+    }, status=200)
+
+# Receives Stripe's events, account.updated keeps the restaurant's onboarding state current
+# Register https://<backend>/api/v1/webhook/ in Stripe's dashboard (Connect events) and set
+# STRIPE_WEBHOOK_SECRET to its signing secret
+@stripe_view('POST')
+async def stripe_webhook(request):
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        return JsonResponse({'error': 'Webhook is not configured'}, status=404)
+    try:
+        event = stripe.Webhook.construct_event(
+            request.body, request.headers.get('Stripe-Signature', ''), settings.STRIPE_WEBHOOK_SECRET
         )
-        return HttpResponseRedirect(response.url)
-    
-# TODO: Use stripe.Account.retrieve to check details submitted parameter in the user's account
-class StripeAccountDetailsStatus(APIView):
-    def get(self, request):
-        user = self.request.user
-        if not user:
-            return Response({'error': 'Invalid user'} ,status=status.HTTP_401_UNAUTHORIZED)
-        if hasattr(user, "stripeuserdata"):
-            stripe_id = user.stripeuserdata.stripe_id
-            account = stripe.Account.retrieve(stripe_id)
-            return Response({'details': account['details_submitted']}, status=status.HTTP_200_OK)
-        else:
-            return Response({'error': "User does not have stripe account"} ,status=status.HTTP_404_NOT_FOUND)
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return JsonResponse({'error': 'Invalid webhook'}, status=400)
+    if event['type'] == 'account.updated':
+        await update_account_status(event['data']['object'])
+    return HttpResponse(status=200)
 
 # Take in response of BillAPIView as request
-class StripeCheckout(APIView):
-    def post(self, request):
-        session = self.request.session.session_key
-        try:
-            session_instance = CustomerSessionModel.objects.get(session=session)
-        except CustomerSessionModel.DoesNotExist:
-            raise NotFound("Customer Session not found")
-        
-        table_number = session_instance.table_number
-        restaurant_instance = session_instance.restaurant
-        orders = OrderItem.objects.filter(order__customer_session__table_number=table_number, order__customer_session__restaurant=restaurant_instance)
-
-        if not orders:
-            raise ValidationError('No orders found for table ', table_number)
-
-        sort_orders = orders.order_by('menu_item__name')
-        
-        if stripe_id := self.obtain_stripe_id(session_instance):
-            response = stripe.checkout.Session.create(
-                mode="payment",
-                #line_items=[{"price": '{{PRICE_ID}}', "quantity": 1}],
-                line_items=self.line_items_parser(sort_orders),
-                payment_intent_data={
-                    "application_fee_amount": 123,
-                    "transfer_data": {"destination": stripe_id},
-                },
-                success_url="https://example.com/success", # Go here if payment succeeds
-                cancel_url="https://example.com/cancel", # Go here if payment fails
-            )
-            return Response({'url': response['url']}, status=status.HTTP_200_OK)
-        else:
-            return Response(status=status.HTTP_400_BAD_REQUEST)
-    
-    def obtain_stripe_id(self, session):
-        restaurant = session.restaurant
-        try:
-            restaurant_user = RestaurantUser.objects.get(restaurant=restaurant)
-            manager_user = restaurant_user.user
-        except RestaurantUser.DoesNotExist:
-            raise ValidationError("User does not have manager level access")
-        if hasattr(manager_user, "stripeuserdata"):
-            return manager_user.stripeuserdata.stripe_id
-        return None
-    
-    def line_items_parser(self, order_list):
-        line_items = []
-        for item in order_list:
-            print("Item",item)
-            dish = {
-                'price_data': {
-                    'currency': 'aud',
-                    'product_data': {'name': item.menu_item.name},
-                    'unit_amount': int(item.menu_item.price * 100),
-                },
-                'quantity': 1,
-            }
-            line_items.append(dish)
-        return line_items
+# A checkout session is created once per customer session and bill: repeated requests for an
+# unchanged bill (double taps, refreshes) get the cached URL back for
+# settings.STRIPE_CHECKOUT_CACHE_TIMEOUT seconds, and concurrent ones share a Stripe
+# idempotency key so Stripe creates a single session for them
+@stripe_view('POST')
+async def stripe_checkout(request):
+    session_instance, bill, stripe_id = await checkout_details(request)
+    if not stripe_id:
+        return HttpResponse(status=400)
+
+    key = checkout_key(session_instance.id, stripe_id, bill)
+    if url := await cache.aget(key):
+        return JsonResponse({'url': url}, status=200)
+    try:
+        response = await get_gateway().create_checkout_session({
+            'mode': "payment",
+            #'line_items': [{"price": '{{PRICE_ID}}', "quantity": 1}],
+            'line_items': line_items_parser(bill['lines']),
+            'payment_intent_data': {
+                "application_fee_amount": 123,
+                "transfer_data": {"destination": stripe_id},
+            },
+            'success_url': "https://example.com/success", # Go here if payment succeeds
+            'cancel_url': "https://example.com/cancel", # Go here if payment fails
+        }, idempotency_key=key)
+    except stripe.error.StripeError as e:
+        return JsonResponse(str(e), status=400, safe=False)
+    await cache.aset(key, response['url'], settings.STRIPE_CHECKOUT_CACHE_TIMEOUT)
+    return JsonResponse({'url': response['url']}, status=200)
+
+# Identifies a customer session's bill, any change to what is paid for or to whom gives a new key
+def checkout_key(customer_session_id, stripe_id, bill):
+    lines = [[line['menu_item'], str(line['price']), line['quantity']] for line in bill['lines']]
+    digest = hashlib.sha256(json.dumps([stripe_id, lines]).encode()).hexdigest()
+    return f'checkout-{customer_session_id}-{digest[:32]}'
+
+# The customer session, its bill and the Stripe account of their restaurant
+@sync_to_async
+def checkout_details(request):
+    session_instance = get_customer_session(request)
+    if session_instance is None:
+        raise NotFound("Customer Session not found")
+
+    bill = compute_bill(session_instance.restaurant_id, session_instance.table_number)
+
+    if not bill['lines']:
+        raise ValidationError('No orders found for table ', session_instance.table_number)
+
+    # the restaurant was loaded with the customer session
+    return session_instance, bill, session_instance.restaurant.stripe_account_id
+
+# One Stripe line item per menu item on the bill
+def line_items_parser(bill_lines):
+    line_items = []
+    for line in bill_lines:
+        dish = {
+            'price_data': {
+                'currency': 'aud',
+                'product_data': {'name': line['name']},
+                'unit_amount': int(line['price'] * 100),
+            },
+            'quantity': line['quantity'],
+        }
+        line_items.append(dish)
+    return line_items
@@ -0,0 +1,50 @@
+from django.db.models import Max
+from .models import Table
+
+# Table occupancy
+# Every operation is a single statement on the table's own row, so concurrent customers
+# seating themselves at different tables of a restaurant never overwrite each other, and
+# two customers scanning the same table cannot both claim it.
+
+# Parses a table number given in a request, returns None if it isn't one
+def parse_table_number(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def restaurant_tables(restaurant_id):
+    return Table.objects.filter(restaurant_id=restaurant_id)
+
+# The {"<table number>": <occupied>} mapping served to the frontend
+def table_numbers(restaurant_id):
+    tables = restaurant_tables(restaurant_id).order_by('number').values_list('number', 'occupied')
+    return {str(number): occupied for number, occupied in tables}
+
+def table_exists(restaurant_id, table_number):
+    return restaurant_tables(restaurant_id).filter(number=table_number).exists()
+
+# Marks a free table occupied, returns False if it doesn't exist or is already occupied
+def seat_table(restaurant_id, table_number):
+    return restaurant_tables(restaurant_id).filter(number=table_number, occupied=False).update(occupied=True) == 1
+
+def free_table(restaurant_id, table_number):
+    restaurant_tables(restaurant_id).filter(number=table_number).update(occupied=False)
+
+# The number after the restaurant's last table (tables are numbered from 0), deleted tables
+# leave gaps that aren't reused
+def next_table_number(restaurant_id):
+    last = restaurant_tables(restaurant_id).aggregate(last=Max('number'))['last']
+    return 0 if last is None else last + 1
+
+# Adds the given table numbers, existing tables are left as they are
+def add_tables(restaurant_id, table_numbers):
+    Table.objects.bulk_create(
+        [Table(restaurant_id=restaurant_id, number=number) for number in table_numbers],
+        ignore_conflicts=True,
+    )
+
+# Deletes a free table, returns False if it doesn't exist or is occupied
+def delete_free_table(restaurant_id, table_number):
+    deleted, _ = restaurant_tables(restaurant_id).filter(number=table_number, occupied=False).delete()
+    return deleted > 0
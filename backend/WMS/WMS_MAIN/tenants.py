@@ -0,0 +1,92 @@
+from django.utils.functional import cached_property
+from rest_framework.exceptions import AuthenticationFailed, NotFound, PermissionDenied
+from .customers import get_customer_session
+
+# Request-scoped tenant context
+# Who is calling and which restaurant they belong to, resolved at most once per request:
+#   - staff (token) => their RestaurantUser's restaurant and user_role
+#   - customers     => the restaurant of their CustomerSession, role 'customer'
+# TenantMiddleware attaches it as request.tenant and TenantMixin gives DRF views access to
+# it. Everything is evaluated lazily, on first access, which has to come after DRF has
+# authenticated the request so that token users are seen.
+
+CUSTOMER = 'customer'
+MANAGER = 'manager'
+
+class Tenant:
+    def __init__(self, request):
+        self.request = request
+
+    @cached_property
+    def restaurant_user(self):
+        return getattr(self.request.user, 'restaurantuser', None)
+
+    @cached_property
+    def customer_session(self):
+        if self.restaurant_user is not None:
+            return None
+        return get_customer_session(self.request)
+
+    @cached_property
+    def restaurant(self):
+        if self.restaurant_user is not None:
+            return self.restaurant_user.restaurant
+        if self.customer_session is not None:
+            return self.customer_session.restaurant
+        return None
+
+    # without loading the restaurant
+    @cached_property
+    def restaurant_id(self):
+        if self.restaurant_user is not None:
+            return self.restaurant_user.restaurant_id
+        if self.customer_session is not None:
+            return self.customer_session.restaurant_id
+        return None
+
+    @cached_property
+    def role(self):
+        if self.restaurant_user is not None:
+            return self.restaurant_user.user_role
+        if self.customer_session is not None:
+            return CUSTOMER
+        return None
+
+# Returns the request's Tenant, kept on the HttpRequest which DRF's Request wraps
+def get_tenant(request):
+    request = getattr(request, '_request', request)
+    if not hasattr(request, 'tenant'):
+        request.tenant = Tenant(request)
+    return request.tenant
+
+class TenantMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        get_tenant(request)
+        return self.get_response(request)
+
+class TenantMixin:
+    @property
+    def tenant(self):
+        return get_tenant(self.request)
+
+    # The staff member's or customer's restaurant id, 404 if the caller is neither
+    def get_restaurant_id(self):
+        if self.tenant.restaurant_id is None:
+            raise NotFound("Customer Session not found, cannot find restaurant")
+        return self.tenant.restaurant_id
+
+    # Raises unless the caller is a manager
+    def check_manager(self, not_staff_message="You are not logged in."):
+        if self.tenant.restaurant_user is None:
+            raise PermissionDenied(not_staff_message)
+        if self.tenant.role != MANAGER:
+            raise AuthenticationFailed("You are not a manager.")
+
+    # Raises unless the caller is a manager of the given restaurant
+    def check_manager_of(self, restaurant_id):
+        self.check_manager()
+        if self.tenant.restaurant_id != restaurant_id:
+            raise AuthenticationFailed("Access denied")
@@ -1,14 +1,88 @@
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import OperationalError, connection, connections
+from django.core.management import CommandError, call_command
+from django.core.cache import cache
+from django.core import mail
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from datetime import timedelta
+from io import BytesIO, StringIO
+from PIL import Image as PILImage
 from django.contrib.auth.models import User
-from .models import Restaurant, MenuItem, OrderItem, Order, Category, CustomerSession
+from .models import Restaurant, RestaurantUser, MenuItem, MenuVersion, OrderItem, Order, Category, CustomerSession, Table, OutgoingEmail
+from .outbox import enqueue_email, retry_dead_emails, send_batch
+from .images import process_menu_item_image
+from .tables import seat_table
 from rest_framework.test import APIClient
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 import json
+import os
+import shutil
+import subprocess
+import sqlite3
+import tempfile
 from pathlib import Path
 import base64
+from decimal import Decimal
+import asyncio
+import threading
+from collections import Counter
+from .events import InProcessBroker
+from .authentication import TTLCache
+from .fake_stripe import FakeStripe
+from .payments import StripeGateway
+from .postgres_pool.base import ConnectionPool, PoolTimeout
+from .loadtest import Recorder, dinner_rush, flush, load_test_restaurants, report, seed
+from .positions import repair_menu_positions
+from . import instrumentation, metrics
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.test import RequestFactory
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+from types import SimpleNamespace
+from contextlib import closing
+from unittest import mock
+import stripe
+import hashlib
+import hmac
+import time
+from .management.commands.explain_hot_queries import sequential_scans
+
+# Saves the test case's uploads and processed images in a temporary MEDIA_ROOT, so that the
+# storage's renamed copies never land in the source tree
+class TemporaryMediaRootMixin:
+    @classmethod
+    def setUpClass(cls):
+        media_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        cls.enterClassContext(override_settings(MEDIA_ROOT=media_root))
+        super().setUpClass()
+
+# The manager registered by ManagerMixin
+MANAGER = {
+    'email': 'testuser@gmail.com',
+    'password': 'testpassword',
+    'name': 'name',
+    'location': 'loc',
+    'table_numbers': {}
+}
+
+# Registers MANAGER and their restaurant (self.restaurant) with `tables` tables, self.client
+# is authenticated with the manager's token (self.token)
+class ManagerMixin:
+    def register_manager(self, tables=3):
+        self.client = APIClient()
+        self.token = self.client.post('/api/register/', MANAGER, format='json').data['token']
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        if tables:
+            self.client.post('/api/updatetables/', {'num': tables, 'list': True}, format='json')
+        self.restaurant = Restaurant.objects.get(location=MANAGER['location'])
 
 class AuthenticationTests(TestCase):
     def setUp(self):
@@ -170,7 +244,7 @@ class RestaurantTest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
         restaurant = Restaurant.objects.get(name='namek')
-        self.assertEqual(len(restaurant.table_numbers), 3)
+        self.assertEqual(restaurant.tables.count(), 3)
 
         # Add 1 table
         num = {'num': 4}
@@ -178,7 +252,7 @@ class RestaurantTest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
         restaurant = Restaurant.objects.get(name='namek')
-        self.assertEqual(len(restaurant.table_numbers), 4)
+        self.assertEqual(restaurant.tables.count(), 4)
 
         response = self.client.get(self.update_table_list, num, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -189,7 +263,7 @@ class RestaurantTest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
         restaurant = Restaurant.objects.get(name='namek')
-        self.assertEqual(len(restaurant.table_numbers), 3)
+        self.assertEqual(restaurant.tables.count(), 3)
 
     # As a customer
     def test_assistance_customer(self):
@@ -343,6 +417,63 @@ class PlaceOrderTest(TestCase):
 
         self.assertEqual(response.data['error'], "['Invalid quantity']")
 
+        # one order item is written per unit
+        response = self.client.post(self.place_order_url, {'order_items': [{'menu_item': 1, 'quantity': 10 ** 9}]}, format='json')
+        self.assertEqual(response.data['error'], "['Invalid quantity']")
+        too_many_lines = [{'menu_item': 1, 'quantity': 1}] * (settings.ORDER_MAX_LINES + 1)
+        response = self.client.post(self.place_order_url, {'order_items': too_many_lines}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(OrderItem.objects.exists())
+
+    def place_order_queries(self, quantity):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.place_order_url, {'order_items': [{'menu_item': 1, 'quantity': quantity}, {'menu_item': 2, 'quantity': quantity}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_bulk_order_query_count(self):
+        manager = self.client.post(self.signup_url, self.data, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + manager.data['token'])
+        self.client.post(self.update_url, {'num': 3, 'list': True}, format='json')
+        self.client.post('/api/logout/')
+        self.client.credentials()
+
+        self.client.post(self.customer_session, {'restaurant': 1, 'table_number': 1}, format='json')
+        restaurant_obj = Restaurant.objects.get(location='loc')
+        category = Category.objects.create(name='hams', restaurant=restaurant_obj)
+        MenuItem.objects.create(name='steamed hams', description='mmm', price=12.99, category=category, dietary_requirements='VG', preparation_time=1, restaurant=restaurant_obj)
+        MenuItem.objects.create(name='beer', description='mmm', price=8, category=category, dietary_requirements='VG', preparation_time=1, restaurant=restaurant_obj)
+
+        single = self.place_order_queries(1)
+        group = self.place_order_queries(10)
+        self.assertEqual(single, group)
+        self.assertEqual(OrderItem.objects.count(), 22)
+
+    def test_menu_item_of_other_restaurant(self):
+        manager = self.client.post(self.signup_url, self.data, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + manager.data['token'])
+        self.client.post(self.update_url, {'num': 3, 'list': True}, format='json')
+
+        self.client.post(self.customer_session, {'restaurant': 1, 'table_number': 1}, format='json')
+        restaurant_obj = Restaurant.objects.get(location='loc')
+        category = Category.objects.create(name='hams', restaurant=restaurant_obj)
+        MenuItem.objects.create(name='steamed hams', description='mmm', price=12.99, category=category, dietary_requirements='VG', preparation_time=1, restaurant=restaurant_obj)
+        other_restaurant = Restaurant.objects.create(name='sustaurant', location='sussyland', table_numbers={})
+        other_item = MenuItem.objects.create(name='sus hams', description='mmm', price=12.99, dietary_requirements='VG', preparation_time=1, restaurant=other_restaurant)
+
+        order_items = {
+            'order_items': [
+                {'menu_item': 1, 'quantity': 1},
+                {'menu_item': other_item.id, 'quantity': 1}
+            ]
+        }
+        response = self.client.post(self.place_order_url, order_items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], "['Invalid menu item']")
+        # a rejected order leaves nothing behind
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertEqual(OrderItem.objects.count(), 0)
+
 class OrderListTest(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -430,11 +561,13 @@ class OrderListTest(TestCase):
                 {'menu_item': 2, 'quantity': 2}
             ],
         }
-        self.client.post(self.place_order_url, order_items, format='json')
+        response = self.client.post(self.place_order_url, order_items, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         response = self.client.get(self.order_url + '?table_number=3')
 
+        # menu item 2 does not exist so the whole order is rejected
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data), 0)
 
     def test_bill(self):
         params = {'restaurant': 1, 'table_number': 1}
@@ -459,6 +592,32 @@ class OrderListTest(TestCase):
         res = self.client.get(self.bill, {'table_number': 1}, format='json')
         # print("Case staff", res.data)
 
+    def test_bill_grouped_lines(self):
+        params = {'restaurant': 1, 'table_number': 1}
+        self.client.post(self.customer_session, params, format='json')
+        category = Category.objects.create(name='hams', restaurant=self.restaurant_obj)
+        MenuItem.objects.create(name='steamed hams', description='mmm', price=12.99, category=category, dietary_requirements='VG', preparation_time=1, restaurant=self.restaurant_obj)
+        MenuItem.objects.create(name='beer', description='mmm1', price=8, category=category, dietary_requirements='V', preparation_time=11, restaurant=self.restaurant_obj)
+        self.client.post(self.place_order_url, {'order_items': [{'menu_item': 1, 'quantity': 1}, {'menu_item': 2, 'quantity': 2}]}, format='json')
+
+        with CaptureQueriesContext(connection) as small:
+            res = self.client.get(self.staff_bill, {'table_number': 1})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([(line['name'], line['quantity']) for line in res.data['lines']], [('beer', 2), ('steamed hams', 1)])
+        self.assertEqual(res.data['lines'][0]['subtotal'], Decimal('16.00'))
+        self.assertEqual(res.data['bill_total'], Decimal('28.99'))
+        self.assertEqual(len(res.data['order_list']), 3)
+
+        self.client.post(self.place_order_url, {'order_items': [{'menu_item': 1, 'quantity': 5}, {'menu_item': 2, 'quantity': 5}]}, format='json')
+        with CaptureQueriesContext(connection) as large:
+            res = self.client.get(self.staff_bill, {'table_number': 1})
+        self.assertEqual(res.data['bill_total'], Decimal('133.94'))
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+        # the customer's bill is the same bill
+        res = self.client.get(self.bill)
+        self.assertEqual(res.data['bill_total'], Decimal('133.94'))
+
 # class PositionTest(TestCase):
 #     def setUp(self):
 #         self.client = APIClient()
@@ -823,7 +982,7 @@ class CategoryCreateRetrieveUpdateDestroyTest(TestCase):
         getResponse = self.client.get(f'/api/categories/{categoryPk}/')
         self.assertEqual(getResponse.status_code, status.HTTP_404_NOT_FOUND)
 
-class MenuItemTest(TestCase):
+class MenuItemTest(TemporaryMediaRootMixin, TestCase):
     def setUp(self):
         self.client = APIClient()
         self.cust_client = APIClient()
@@ -959,6 +1118,92 @@ class MenuItemTest(TestCase):
         patchResponse = self.client.patch(f'/api/menuitems/{self.firstMenuItemPk}/', data=newMenuItem, format='json')
         self.assertEqual(patchResponse.status_code, status.HTTP_403_FORBIDDEN)
 
+    def test_image_pipeline(self):
+        # a sideways photo with its camera metadata
+        photo = PILImage.new('RGB', (1000, 500), 'red')
+        exif = PILImage.Exif()
+        exif[0x0112] = 6
+        exif[0x010F] = 'Camera maker'
+        upload = BytesIO()
+        photo.save(upload, 'JPEG', exif=exif)
+        upload.name = 'photo.jpg'
+        upload.seek(0)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(self.menu_item, data={'name': 'Photo', 'description': 'd', 'price': 1, 'preparation_time': 1, 'image': upload})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # processed after the request
+        self.assertEqual(len(callbacks), 1)
+        self.assertIsNone(response.data['image_srcset'])
+
+        menu_item = MenuItem.objects.get(pk=response.data['pk'])
+        upload_name = menu_item.image.name
+        process_menu_item_image(menu_item.id)
+        menu_item.refresh_from_db()
+        self.assertRegex(menu_item.image.name, r'^menu_images/[0-9a-f]{20}\.jpg$')
+        self.assertFalse(menu_item.image.storage.exists(upload_name))
+        with menu_item.image.open() as file, PILImage.open(file) as image:
+            # upright and without the metadata
+            self.assertEqual(image.size, (500, 1000))
+            self.assertEqual(len(image.getexif()), 0)
+        self.assertEqual([variant['width'] for variant in menu_item.image_variants], [320])
+        with menu_item.image.storage.open(menu_item.image_variants[0]['webp']) as file, PILImage.open(file) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (320, 640)))
+
+        response = self.client.get(f'{self.menu_item}{menu_item.id}/')
+        self.assertEqual(response.data['image_srcset']['webp'], f"http://testserver/media/{menu_item.image_variants[0]['webp']} 320w")
+        self.assertEqual(response.data['thumbnail'], f"http://testserver/media/{menu_item.image_variants[0]['jpeg']}")
+
+    @override_settings(MENU_IMAGE_MAX_PIXELS=100)
+    def test_image_validated(self):
+        with open(self.test_image_path / "nasi.jpg", "rb") as image:
+            response = self.client.post(self.menu_item, data={'name': 'Nasi', 'description': 'd', 'price': 1, 'preparation_time': 1, 'image': image})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_media_served(self):
+        storage = MenuItem._meta.get_field('image').storage
+        name = f'menu_images/{"ab" * 10}-320.jpg'
+        self.assertEqual(storage.save(name, ContentFile(b'0123456789' * 10)), name)
+        self.addCleanup(storage.delete, name)
+        # stored once, the same content under the same name
+        self.assertEqual(storage.save(name, ContentFile(b'0123456789' * 10)), name)
+
+        # a concurrent writer of the same content, which saw no file either
+        with mock.patch.object(storage, 'exists', return_value=False):
+            self.assertEqual(storage.save(name, ContentFile(b'0123456789' * 10)), name)
+        self.assertFalse([file for file in os.listdir(os.path.dirname(storage.path(name))) if file.startswith('.saving-')])
+
+        response = self.client.get(f'/media/{name}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789' * 10)
+        self.assertIn('immutable', response['Cache-Control'])
+        etag = response['ETag']
+        response.close()
+
+        response = self.client.get(f'/media/{name}', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(f'/media/{name}', HTTP_RANGE='bytes=0-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'01234')
+        response.close()
+
+        # not content addressed
+        with open(self.test_image_path / "nasi.jpg", "rb") as image:
+            storage.save('menu_images/nasi.jpg', image)
+        response = self.client.get('/media/menu_images/nasi.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], f'max-age={settings.MEDIA_MAX_AGE}, public')
+        response.close()
+
+        # compressible media gets a precompressed variant
+        svg = storage.save('menu_images/icon.svg', ContentFile(b'<svg xmlns="http://www.w3.org/2000/svg"></svg>' * 20))
+        self.addCleanup(storage.delete, svg)
+        response = self.client.get(f'/media/{svg}', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        response.close()
+
+        self.assertEqual(self.client.get('/media/menu_images/missing.jpg').status_code, 404)
+
 class OrderItemDetailTest(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -1019,10 +1264,8 @@ class CustomerSessionTest(TestCase):
         # give it some tables
         data = {'num': 3, 'list': True}
         self.manager.post('/api/updatetables/', data, format='json')
-        self.assertEqual(len(Restaurant.objects.get().table_numbers.keys()), 3)
-        self.assertEqual(list(Restaurant.objects.get().table_numbers.values())[0], False)
-        self.assertEqual(list(Restaurant.objects.get().table_numbers.values())[1], False)
-        self.assertEqual(list(Restaurant.objects.get().table_numbers.values())[2], False)
+        self.assertEqual(Table.objects.count(), 3)
+        self.assertEqual(list(Table.objects.order_by('number').values_list('occupied', flat=True)), [False, False, False])
 
     def test_customer_start_and_end(self):
         oneAndOnlyRestaurant = Restaurant.objects.get()
@@ -1033,19 +1276,15 @@ class CustomerSessionTest(TestCase):
         csCookie = cookie_response.cookies.get('sessionid')
         cookie_value = csCookie.output().split(';')[0].split(':')[1].strip()
 
-        # check that the json field in the restaurant reflects this new change in availability of tables
-        oneAndOnlyRestaurant = Restaurant.objects.get()
-        tableStatuses = oneAndOnlyRestaurant.table_numbers
-        self.assertTrue(tableStatuses['1'])
+        # check that the restaurant's table reflects this new change in availability of tables
+        self.assertTrue(Table.objects.get(restaurant=oneAndOnlyRestaurant, number=1).occupied)
 
         # finish the customer session
         response = self.customer.delete('/api/customer/', HTTP_COOKIE=cookie_value)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        # check that the json field in the restaurant reflects this new change in availability of tables
-        oneAndOnlyRestaurant = Restaurant.objects.get()
-        tableStatuses = oneAndOnlyRestaurant.table_numbers
-        self.assertFalse(tableStatuses['1'])
+        # check that the restaurant's table reflects this new change in availability of tables
+        self.assertFalse(Table.objects.get(restaurant=oneAndOnlyRestaurant, number=1).occupied)
 
 
     def test_staff_ends_customer_session(self):
@@ -1060,11 +1299,72 @@ class CustomerSessionTest(TestCase):
         response = self.manager.delete('/api/staff-ending-customer/', data={'table_number': 1}, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        # check that the json field in the restaurant reflects this new change in availability of tables
+        # check that the restaurant's table reflects this new change in availability of tables
+        self.assertFalse(Table.objects.get(restaurant=oneAndOnlyRestaurant, number=1).occupied)
+
+
+    def test_table_occupancy_list(self):
+        oneAndOnlyRestaurant = Restaurant.objects.get()
+        self.customer.post('/api/customer/', {'restaurant': oneAndOnlyRestaurant.id, 'table_number': 1}, format='json')
+        response = self.manager.get('/api/updatetables/')
+        self.assertEqual(response.data, {'table_numbers': {'0': False, '1': True, '2': False}})
+
+        # an occupied table can't be deleted, a free one can
+        response = self.manager.delete('/api/updatetables/', {'num': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {'error': 'Table is occupied'})
+        response = self.manager.delete('/api/updatetables/', {'num': 2}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.manager.delete('/api/updatetables/', {'num': 2}, format='json')
+        self.assertEqual(response.data, {'error': 'Table number does not exist'})
+
+        # added after the last table, not over the remaining ones
+        self.manager.delete('/api/updatetables/', {'num': 0}, format='json')
+        self.manager.post('/api/updatetables/', {'num': 2, 'list': True}, format='json')
+        self.assertEqual(list(oneAndOnlyRestaurant.tables.order_by('number').values_list('number', flat=True)), [1, 2, 3])
+
+        # a second customer can't take the occupied table
+        response = APIClient().post('/api/customer/', {'restaurant': oneAndOnlyRestaurant.id, 'table_number': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_customer_reconnects_to_own_table(self):
+        oneAndOnlyRestaurant = Restaurant.objects.get()
+        params = {'restaurant': oneAndOnlyRestaurant.id, 'table_number': 1}
+        self.assertEqual(self.customer.post('/api/customer/', params, format='json').status_code, status.HTTP_201_CREATED)
+        # scanning the table's QR code again keeps the customer's session
+        response = self.customer.post('/api/customer/', params, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(CustomerSession.objects.count(), 1)
+
+        # but can't take a second table
+        response = self.customer.post('/api/customer/', {'restaurant': oneAndOnlyRestaurant.id, 'table_number': 2}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(Table.objects.get(number=2).occupied)
+
+        # a table that doesn't exist
+        response = APIClient().post('/api/customer/', {'restaurant': oneAndOnlyRestaurant.id, 'table_number': 9}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(Table.objects.filter(number=9).exists())
+
+    def test_session_resolved_once_per_request(self):
         oneAndOnlyRestaurant = Restaurant.objects.get()
-        tableStatuses = oneAndOnlyRestaurant.table_numbers
-        self.assertFalse(tableStatuses['1'])
+        self.customer.post('/api/customer/', {'restaurant': oneAndOnlyRestaurant.id, 'table_number': 1}, format='json')
+        with CaptureQueriesContext(connection) as context:
+            response = self.customer.get('/api/orders/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lookups = [query['sql'] for query in context.captured_queries if 'WMS_MAIN_customersession' in query['sql'] and '"session" =' in query['sql']]
+        self.assertEqual(len(lookups), 1)
 
+    def test_backfill_tables(self):
+        restaurant = Restaurant.objects.create(name='legacy', location='legacy', table_numbers={'1': True, '2': False, 'x': False})
+        err = StringIO()
+        call_command('backfill_tables', stdout=StringIO(), stderr=err)
+        self.assertEqual(dict(restaurant.tables.values_list('number', 'occupied')), {1: True, 2: False})
+        self.assertIn("'x'", err.getvalue())
+        # the other restaurant's tables are untouched and running it again changes nothing
+        self.assertEqual(Table.objects.count(), 5)
+        call_command('backfill_tables', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Table.objects.count(), 5)
 
 
 class StripeTest(TestCase):
@@ -1094,6 +1394,8 @@ class StripeTest(TestCase):
         self.num = {'num': 7, 'list': True}
         self.client.post(self.update_url, self.num, format='json')
         self.restaurant_obj = Restaurant.objects.get(location='loc')
+        # cached checkout URLs of other tests' customer sessions
+        cache.clear()
     
     def test_create_acc(self):
         response = self.client.post(self.express)
@@ -1103,6 +1405,85 @@ class StripeTest(TestCase):
         response = self.client.get(self.check)
         # print(response)
 
+    def test_checkout_with_fake_stripe(self):
+        with FakeStripe() as fake, override_settings(STRIPE_API_KEY='sk_test_fake', STRIPE_API_BASE=fake.url):
+            response = self.client.post(self.express)
+            self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+            response = self.client.post(self.link)
+            self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+            self.assertTrue(response['Location'].startswith('https://connect.stripe.test/'))
+            response = self.client.get(self.check)
+            self.assertEqual(response.json()['details'], False)
+
+            customer = APIClient()
+            customer.post(self.customer_session, {'restaurant': self.restaurant_obj.id, 'table_number': 1}, format='json')
+            menu_item = MenuItem.objects.create(name='steamed hams', description='mmm', price=12.99, preparation_time=1, restaurant=self.restaurant_obj)
+            customer.post(self.place_order_url, {'order_items': [{'menu_item': menu_item.id, 'quantity': 2}]}, format='json')
+            response = customer.post(self.checkout)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.json()['url'].startswith('https://checkout.stripe.test/'))
+            self.assertEqual(fake.requests[-1], ('POST', '/v1/checkout/sessions'))
+
+    def test_checkout_deduplicated(self):
+        with FakeStripe() as fake, override_settings(STRIPE_API_KEY='sk_test_fake', STRIPE_API_BASE=fake.url):
+            self.client.post(self.express)
+            customer = APIClient()
+            customer.post(self.customer_session, {'restaurant': self.restaurant_obj.id, 'table_number': 1}, format='json')
+            menu_item = MenuItem.objects.create(name='steamed hams', description='mmm', price=12.99, preparation_time=1, restaurant=self.restaurant_obj)
+            customer.post(self.place_order_url, {'order_items': [{'menu_item': menu_item.id, 'quantity': 2}]}, format='json')
+
+            # a double tap gets the same session
+            url = customer.post(self.checkout).json()['url']
+            self.assertEqual(customer.post(self.checkout).json()['url'], url)
+            self.assertEqual(fake.requests.count(('POST', '/v1/checkout/sessions')), 1)
+
+            # and so does another process, through Stripe's idempotency key
+            cache.clear()
+            self.assertEqual(customer.post(self.checkout).json()['url'], url)
+
+            # a changed bill needs a new session
+            customer.post(self.place_order_url, {'order_items': [{'menu_item': menu_item.id, 'quantity': 1}]}, format='json')
+            self.assertNotEqual(customer.post(self.checkout).json()['url'], url)
+
+    def test_account_status_stored_locally(self):
+        with FakeStripe() as fake, override_settings(STRIPE_API_KEY='sk_test_fake', STRIPE_API_BASE=fake.url, STRIPE_WEBHOOK_SECRET='whsec_test'):
+            self.client.post(self.express)
+            account_id = Restaurant.objects.get(pk=self.restaurant_obj.pk).stripe_account_id
+            self.assertTrue(account_id.startswith('acct_'))
+            requests = len(fake.requests)
+
+            # answered from the restaurant's row
+            fake.accounts[account_id].update(details_submitted=True, charges_enabled=True)
+            self.assertEqual(self.client.get(self.check).json(), {'details': False, 'charges_enabled': False})
+            self.assertEqual(len(fake.requests), requests)
+
+            # Stripe's webhook brings it up to date
+            payload = json.dumps({'id': 'evt_1', 'object': 'event', 'type': 'account.updated', 'data': {'object': fake.accounts[account_id]}})
+            timestamp = int(time.time())
+            signature = hmac.new(b'whsec_test', f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+            response = self.client.post('/api/v1/webhook/', payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get(self.check).json(), {'details': True, 'charges_enabled': True})
+            self.assertEqual(len(fake.requests), requests)
+
+            response = self.client.post('/api/v1/webhook/', payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=f't={timestamp},v1=forged')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            # and Stripe is asked again once the state has expired
+            fake.accounts[account_id].update(charges_enabled=False)
+            Restaurant.objects.filter(pk=self.restaurant_obj.pk).update(stripe_checked_at=None)
+            self.assertEqual(self.client.get(self.check).json(), {'details': True, 'charges_enabled': False})
+            self.assertEqual(fake.requests[-1], ('GET', f'/v1/accounts/{account_id}'))
+
+    def test_gateway_retries(self):
+        with FakeStripe(error_rate=1) as fake:
+            gateway = StripeGateway('sk_test_fake', fake.url, timeout=5, max_retries=2, max_concurrency=2, call_timeout=30)
+            with self.assertRaises(stripe.error.APIError):
+                asyncio.run(gateway.retrieve_account('acct_1'))
+            gateway.close()
+        # the first attempt and two retries
+        self.assertEqual(len(fake.requests), 3)
+
     # def test_checkout(self):
     #     self.client.post(self.express)
     #     self.client.post(self.link)
@@ -1128,4 +1509,935 @@ class StripeTest(TestCase):
     #     self.client.post(self.place_order_url, order_items, format='json')
     #     self.client.post(self.place_order_url, order_items2, format='json')
     #     res = self.client.post(self.checkout, format='json')
-    #     print("Checkout", res.data)
\ No newline at end of file
+    #     print("Checkout", res.data)
+class AllOrdersFeedTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.data = {
+            'email': 'testuser@gmail.com', 
+            'password': 'testpassword', 
+            'name': 'name', 
+            'location': 'loc', 
+            'table_numbers': {}
+        }
+        self.manager = self.client.post('/api/register/', self.data, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.manager.data['token'])
+        self.client.post('/api/updatetables/', {'num': 7, 'list': True}, format='json')
+        self.restaurant = Restaurant.objects.get(location='loc')
+        category = Category.objects.create(name='hams', restaurant=self.restaurant)
+        self.hams = MenuItem.objects.create(name='steamed hams', description='mmm', price=12.99, category=category, dietary_requirements='VG', preparation_time=1, restaurant=self.restaurant)
+        self.aurora = MenuItem.objects.create(name='aurora borealis', description='mmm1', price=12.99, category=category, dietary_requirements='V', preparation_time=11, restaurant=self.restaurant)
+
+    def add_orders(self, table_number, count):
+        session = CustomerSession.objects.create(session=f'session-{table_number}', table_number=table_number, restaurant=self.restaurant)
+        for _ in range(count):
+            order = Order.objects.create(customer_session=session)
+            OrderItem.objects.create(order=order, menu_item=self.hams)
+            OrderItem.objects.create(order=order, menu_item=self.aurora)
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/allorders/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries), response.data
+
+    def test_feed_payload(self):
+        self.add_orders(3, 1)
+        response = self.client.get('/api/allorders/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        order_data = response.data[0]
+        self.assertEqual(order_data['table_number'], 3)
+        self.assertEqual(order_data['order']['customer_session'], CustomerSession.objects.get().id)
+        # order items are sorted by menu item name
+        self.assertEqual([item['menu_item'] for item in order_data['order_items']], [self.aurora.id, self.hams.id])
+
+    def test_query_count_is_constant(self):
+        self.add_orders(1, 1)
+        small_count, small_data = self.count_queries()
+        self.add_orders(2, 30)
+        self.add_orders(3, 30)
+        large_count, large_data = self.count_queries()
+
+        self.assertEqual(len(small_data), 1)
+        self.assertEqual(len(large_data), 61)
+        self.assertEqual(small_count, large_count)
+
+# the rows of the previous poll aren't sent again, see test_overlap_returns_late_commits
+@override_settings(ORDER_FEED_CURSOR_OVERLAP_SECONDS=0)
+class OrderFeedCursorTest(ManagerMixin, TestCase):
+    def setUp(self):
+        self.register_manager()
+        self.cust_client = APIClient()
+        category = Category.objects.create(name='hams', restaurant=self.restaurant)
+        MenuItem.objects.create(name='steamed hams', description='mmm', price=12.99, category=category, dietary_requirements='VG', preparation_time=1, restaurant=self.restaurant)
+        self.cust_client.post('/api/customer/', {'restaurant': self.restaurant.id, 'table_number': 1}, format='json')
+        self.order_items = {'order_items': [{'menu_item': 1, 'quantity': 1}]}
+
+    def test_full_poll_returns_cursor(self):
+        self.cust_client.post('/api/placeorder/', self.order_items, format='json')
+        response = self.client.get('/api/allorders/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertIn('X-Feed-Cursor', response)
+
+    def test_incremental_poll(self):
+        self.cust_client.post('/api/placeorder/', self.order_items, format='json')
+        cursor = self.client.get('/api/allorders/')['X-Feed-Cursor']
+
+        # nothing has changed
+        response = self.client.get('/api/allorders/', {'since': cursor})
+        self.assertEqual(response.data['changed'], [])
+        self.assertEqual(response.data['deleted'], [])
+        self.assertFalse(response.data['reset'])
+
+        # a new order only returns the new order
+        self.cust_client.post('/api/placeorder/', self.order_items, format='json')
+        response = self.client.get('/api/allorders/', {'since': cursor})
+        self.assertEqual([order['order_id'] for order in response.data['changed']], [2])
+        cursor = response.data['cursor']
+
+        # a status change returns the order of the changed item
+        self.client.patch('/api/orderitems/1/', data={'status': 'PREPARED'}, format='json')
+        response = self.client.get('/api/allorders/', {'since': cursor})
+        self.assertEqual([order['order_id'] for order in response.data['changed']], [1])
+        cursor = response.data['cursor']
+
+        customer_response = self.cust_client.get('/api/orderitems/', {'since': cursor})
+        self.assertEqual(customer_response.data['changed'], [])
+
+        # ending the session reports the deleted orders and order items
+        self.client.delete('/api/staff-ending-customer/', data={'table_number': 1}, format='json')
+        response = self.client.get('/api/allorders/', {'since': cursor})
+        self.assertEqual(response.data['changed'], [])
+        self.assertEqual(sorted(response.data['deleted']), [1, 2])
+
+    def test_overlap_returns_late_commits(self):
+        cursor = self.client.get('/api/allorders/')['X-Feed-Cursor']
+        self.cust_client.post('/api/placeorder/', self.order_items, format='json')
+        # written before the poll, committed after it
+        written_at = parse_datetime(cursor) - timedelta(seconds=2)
+        Order.objects.update(updated_at=written_at)
+        OrderItem.objects.update(updated_at=written_at)
+
+        response = self.client.get('/api/allorders/', {'since': cursor})
+        self.assertEqual(response.data['changed'], [])
+        with self.settings(ORDER_FEED_CURSOR_OVERLAP_SECONDS=10):
+            response = self.client.get('/api/allorders/', {'since': cursor})
+        self.assertEqual([order['order_id'] for order in response.data['changed']], [1])
+
+    def test_deleted_menu_item(self):
+        other = MenuItem.objects.create(name='aurora borealis', description='mmm', price=1, preparation_time=1, restaurant=self.restaurant)
+        self.cust_client.post('/api/placeorder/', {'order_items': [{'menu_item': 1, 'quantity': 1}, {'menu_item': other.id, 'quantity': 1}]}, format='json')
+        deleted_item = OrderItem.objects.get(menu_item=other).id
+        cursor = self.client.get('/api/allorders/')['X-Feed-Cursor']
+
+        self.assertEqual(self.client.delete(f'/api/menuitems/{other.id}/').status_code, status.HTTP_204_NO_CONTENT)
+        response = self.cust_client.get('/api/orderitems/', {'since': cursor})
+        self.assertEqual(response.data['deleted'], [deleted_item])
+        # the order comes again without it
+        response = self.client.get('/api/allorders/', {'since': cursor})
+        self.assertEqual(len(response.data['changed'][0]['order_items']), 1)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/allorders/', {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_expired_cursor_resets(self):
+        self.cust_client.post('/api/placeorder/', self.order_items, format='json')
+        response = self.client.get('/api/allorders/', {'since': '2000-01-01T00:00:00Z'})
+        self.assertTrue(response.data['reset'])
+        self.assertEqual(len(response.data['changed']), 1)
+
+# Local stand-in for the event broker, records every published event
+class RecordingBroker:
+    published = []
+
+    def subscribe(self, restaurant_id):
+        pass
+
+    def unsubscribe(self, subscription):
+        pass
+
+    def publish(self, restaurant_id, event):
+        RecordingBroker.published.append(event)
+
+@override_settings(EVENT_BROKER='WMS_MAIN.tests.RecordingBroker')
+class RestaurantEventTest(ManagerMixin, TestCase):
+    def setUp(self):
+        RecordingBroker.published = []
+        self.register_manager()
+        self.cust_client = APIClient()
+        category = Category.objects.create(name='hams', restaurant=self.restaurant)
+        MenuItem.objects.create(name='steamed hams', description='mmm', price=12.99, category=category, dietary_requirements='VG', preparation_time=1, restaurant=self.restaurant)
+
+    def published_types(self):
+        return [event['type'] for event in RecordingBroker.published]
+
+    def test_dinner_events(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cust_client.post('/api/customer/', {'restaurant': self.restaurant.id, 'table_number': 1}, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cust_client.post('/api/placeorder/', {'order_items': [{'menu_item': 1, 'quantity': 1}]}, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch('/api/orderitems/1/', data={'status': 'PREPARED'}, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cust_client.post('/api/tableassistancewithoutparams/', content_type='application/json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete('/api/staff-ending-customer/', data={'table_number': 1}, format='json')
+
+        self.assertEqual(self.published_types(), ['table_occupancy', 'order_placed', 'order_item_status', 'assistance', 'table_occupancy'])
+        self.assertTrue(all(event['restaurant'] == self.restaurant.id for event in RecordingBroker.published))
+        self.assertEqual(RecordingBroker.published[2]['data'], {'order_item': 1, 'order': 1, 'status': 'PREPARED'})
+        self.assertEqual(RecordingBroker.published[4]['data'], {'table_number': 1, 'occupied': False})
+
+    def test_event_stream_requires_staff_token(self):
+        response = self.client.get('/api/events/', {'token': 'not a token'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+class InProcessBrokerTest(TestCase):
+    def test_fan_out_per_restaurant(self):
+        async def scenario():
+            broker = InProcessBroker()
+            subscription = broker.subscribe(1)
+            other_restaurant = broker.subscribe(2)
+            # publishing happens from the sync view threads
+            await asyncio.to_thread(broker.publish, 1, {'type': 'order_placed'})
+            event = await subscription.get(1)
+            self.assertEqual(event, {'type': 'order_placed'})
+            self.assertTrue(other_restaurant.queue.empty())
+
+            broker.unsubscribe(subscription)
+            broker.unsubscribe(other_restaurant)
+            self.assertEqual(broker.subscribers, {})
+
+        asyncio.run(scenario())
+
+    @override_settings(EVENT_STREAM_QUEUE_SIZE=2)
+    def test_slow_subscriber_overflow(self):
+        async def scenario():
+            broker = InProcessBroker()
+            subscription = broker.subscribe(1)
+            for i in range(3):
+                broker.publish(1, {'type': 'order_placed', 'data': i})
+            await asyncio.sleep(0)
+            self.assertTrue(subscription.overflowed)
+            self.assertEqual((await subscription.get(1))['data'], 1)
+
+        asyncio.run(scenario())
+
+class MenuSnapshotTest(ManagerMixin, TestCase):
+    def setUp(self):
+        self.register_manager()
+        self.cust_client = APIClient()
+        self.client.post('/api/categories/', {'name': 'drinks'}, format='json')
+        self.client.post('/api/categories/', {'name': 'hams'}, format='json')
+        self.hams = Category.objects.get(name='hams')
+        MenuItem.objects.create(name='steamed hams', description='mmm', price=12.99, category=self.hams, dietary_requirements='VG', preparation_time=1, restaurant=self.restaurant, position=2)
+        MenuItem.objects.create(name='grilled hams', description='mmm', price=12.99, category=self.hams, dietary_requirements='VG', preparation_time=1, restaurant=self.restaurant, position=1)
+        self.cust_client.post('/api/customer/', {'restaurant': self.restaurant.id, 'table_number': 1}, format='json')
+
+    def test_nested_menu(self):
+        response = self.cust_client.get('/api/menu/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        menu = response.json()
+        self.assertEqual([category['name'] for category in menu['categories']], ['drinks', 'hams'])
+        self.assertEqual([item['name'] for item in menu['categories'][1]['menu_items']], ['grilled hams', 'steamed hams'])
+        self.assertEqual(menu['uncategorised'], [])
+
+    def test_conditional_get(self):
+        response = self.cust_client.get('/api/menu/')
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.cust_client.get('/api/menu/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        # only the django session, the customer session and the menu version are read
+        self.assertEqual(len(context.captured_queries), 3)
+
+        # the list endpoints share the version
+        response = self.cust_client.get('/api/categories/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_menu_write_invalidates_snapshot(self):
+        etag = self.cust_client.get('/api/menu/')['ETag']
+        self.client.patch(f'/api/categories/{self.hams.id}/', data={'name': 'more hams'}, format='json')
+
+        response = self.cust_client.get('/api/menu/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['categories'][1]['name'], 'more hams')
+
+        response = self.cust_client.get('/api/categories/')
+        self.assertEqual(response.data[1]['name'], 'more hams')
+
+    # the admin's bulk delete, the cascade mustn't bump the deleted restaurant's menu version
+    def test_restaurant_queryset_delete(self):
+        restaurant_id = self.restaurant.id
+        self.cust_client.get('/api/menu/')
+        Restaurant.objects.filter(id=restaurant_id).delete()
+        self.assertFalse(MenuVersion.objects.filter(restaurant_id=restaurant_id).exists())
+        self.assertFalse(MenuItem.objects.filter(restaurant_id=restaurant_id).exists())
+        connection.check_constraints()
+
+class PositionUpdateTest(ManagerMixin, TestCase):
+    def setUp(self):
+        self.register_manager(tables=0)
+        self.categories = [Category.objects.create(name=f'category {i}', restaurant=self.restaurant, position=i + 1) for i in range(20)]
+        self.items = [
+            MenuItem.objects.create(name=f'item {i}', description='mmm', price=1, category=self.categories[0], dietary_requirements='VG', preparation_time=1, restaurant=self.restaurant, position=i + 1)
+            for i in range(5)
+        ]
+
+    def test_reorder_categories_query_count(self):
+        reordered = list(reversed(self.categories))
+        payload = {'categories': [{'categoryId': category.id, 'newPosition': i + 1} for i, category in enumerate(reordered)]}
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/position/category/', payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # the number of queries does not grow with the number of categories
+        self.assertLess(len(context.captured_queries), 12)
+        positions = dict(Category.objects.values_list('id', 'position'))
+        self.assertEqual([positions[category.id] for category in reordered], list(range(1, 21)))
+
+    def test_reorder_menu_items(self):
+        payload = {
+            'categoryId': self.categories[0].id,
+            'menuItems': [{'menuItemId': item.id, 'newPosition': 5 - i} for i, item in enumerate(self.items)],
+        }
+        response = self.client.post('/api/position/menuitem/', payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(MenuItem.objects.order_by('position').values_list('name', flat=True)), [f'item {i}' for i in range(4, -1, -1)])
+
+    def test_duplicate_or_gapped_positions(self):
+        for positions in ([1, 1, 2, 3, 4], [1, 2, 3, 4, 6], [0, 1, 2, 3, 4]):
+            payload = {
+                'categoryId': self.categories[0].id,
+                'menuItems': [{'menuItemId': item.id, 'newPosition': position} for item, position in zip(self.items, positions)],
+            }
+            response = self.client.post('/api/position/menuitem/', payload, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(list(MenuItem.objects.order_by('id').values_list('position', flat=True)), [1, 2, 3, 4, 5])
+
+    def test_partial_reorder_rejected(self):
+        # 2 of the category's 5 menu items would share positions 1 and 2 with the others
+        payload = {
+            'categoryId': self.categories[0].id,
+            'menuItems': [{'menuItemId': self.items[3].id, 'newPosition': 1}, {'menuItemId': self.items[4].id, 'newPosition': 2}],
+        }
+        response = self.client.post('/api/position/menuitem/', payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(list(MenuItem.objects.order_by('id').values_list('position', flat=True)), [1, 2, 3, 4, 5])
+
+    def test_other_restaurants_ids(self):
+        other_client = APIClient()
+        data = {**MANAGER, 'email': 'other@gmail.com', 'location': 'other'}
+        other_client.credentials(HTTP_AUTHORIZATION='Token ' + other_client.post('/api/register/', data, format='json').data['token'])
+        payload = {'categories': [{'categoryId': category.id, 'newPosition': 20 - i} for i, category in enumerate(self.categories)]}
+        response = other_client.post('/api/position/category/', payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(list(Category.objects.order_by('id').values_list('position', flat=True)), list(range(1, 21)))
+
+        # a menu item of another category is not found either
+        payload = {'categoryId': self.categories[1].id, 'menuItems': [{'menuItemId': self.items[0].id, 'newPosition': 1}]}
+        response = self.client.post('/api/position/menuitem/', payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_delete_compacts_positions(self):
+        call_command('repair_menu_positions', stdout=StringIO())
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.delete(f'/api/categories/{self.categories[0].id}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        # one shifting UPDATE whatever the number of later categories
+        self.assertLess(len(context.captured_queries), 20)
+        self.assertEqual(list(Category.objects.order_by('id').values_list('position', flat=True)), list(range(1, 20)))
+        self.restaurant.refresh_from_db()
+        self.assertEqual(self.restaurant.num_categories, 19)
+
+        # the deleted category's menu items are uncategorised, delete a categorised one
+        category = self.categories[1]
+        items = [self.client.post('/api/menuitems/', {'name': f'new {i}', 'description': 'mmm', 'price': 1, 'category': category.id, 'preparation_time': 1}).data for i in range(3)]
+        self.assertEqual([item['position'] for item in items], [1, 2, 3])
+        response = self.client.delete(f'/api/menuitems/{items[0]["pk"]}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(list(MenuItem.objects.filter(category=category).order_by('id').values_list('position', flat=True)), [1, 2])
+        category.refresh_from_db()
+        self.assertEqual(category.num_menu_items, 2)
+
+    def test_repair_menu_positions(self):
+        Category.objects.filter(id=self.categories[0].id).update(position=7)
+        MenuItem.objects.filter(id=self.items[2].id).update(position=40)
+        out = StringIO()
+        call_command('repair_menu_positions', self.restaurant.id, stdout=out)
+        self.assertIn(f'Restaurant {self.restaurant.id}', out.getvalue())
+
+        self.restaurant.refresh_from_db()
+        self.assertEqual(self.restaurant.num_categories, 20)
+        categories = Category.objects.order_by('position')
+        self.assertEqual(list(categories.values_list('position', flat=True)), list(range(1, 21)))
+        # ties are broken by id
+        self.assertEqual(categories[5].id, self.categories[0].id)
+        self.assertEqual(list(categories.values_list('num_menu_items', flat=True)), [0] * 5 + [5] + [0] * 14)
+        self.assertEqual(list(MenuItem.objects.order_by('id').values_list('position', flat=True)), [1, 2, 5, 3, 4])
+
+        # nothing left to repair
+        out = StringIO()
+        call_command('repair_menu_positions', stdout=out)
+        self.assertIn('0 row(s) repaired', out.getvalue())
+
+# Many customers scanning the QR codes of the same few tables at once, each request on its
+# own thread and database connection. Every table must end up with exactly one session
+# The claims of TableSeatingConcurrencyTest one after the other, runs on any database
+class TableSeatingTest(TestCase):
+    def setUp(self):
+        self.restaurant = Restaurant.objects.create(name='busy', location='busy')
+        Table.objects.bulk_create([Table(restaurant=self.restaurant, number=number) for number in range(2)])
+
+    def claim(self, table_number):
+        return APIClient().post('/api/customer/', {'restaurant': self.restaurant.id, 'table_number': table_number}, format='json')
+
+    def test_second_claim_fails(self):
+        self.assertTrue(seat_table(self.restaurant.id, 0))
+        self.assertFalse(seat_table(self.restaurant.id, 0))
+        self.assertTrue(Table.objects.get(restaurant=self.restaurant, number=0).occupied)
+
+        self.assertEqual(self.claim(1).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.claim(1).status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(CustomerSession.objects.filter(restaurant=self.restaurant, table_number=1).count(), 1)
+
+    def test_claim_of_table_still_held(self):
+        self.assertEqual(self.claim(1).status_code, status.HTTP_201_CREATED)
+        # marked free while its customer session is still open
+        Table.objects.filter(restaurant=self.restaurant, number=1).update(occupied=False)
+        self.assertEqual(self.claim(1).status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(CustomerSession.objects.filter(restaurant=self.restaurant).count(), 1)
+
+# Real concurrent claims, on a database several threads can write to. SQLite's in-memory test
+# database fails concurrent writers instead of making them wait, it's copied to a file for the test
+class TableSeatingConcurrencyTest(TransactionTestCase):
+    TABLES = 4
+    CUSTOMERS_PER_TABLE = 10
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.use_file_database()
+        self.restaurant = Restaurant.objects.create(name='busy', location='busy')
+        Table.objects.bulk_create([Table(restaurant=self.restaurant, number=number) for number in range(self.TABLES)])
+
+    def test_one_winner_per_table(self):
+        customers = self.TABLES * self.CUSTOMERS_PER_TABLE
+        barrier = threading.Barrier(customers)
+        results = []
+        lock = threading.Lock()
+
+        def scan(table_number):
+            client = APIClient()
+            try:
+                barrier.wait()
+                response = client.post('/api/customer/', {'restaurant': self.restaurant.id, 'table_number': table_number}, format='json')
+                outcome = response.status_code
+            except Exception as error:
+                # e.g. SQLite's "database is locked", fails the assertions below with the error
+                outcome = repr(error)
+            finally:
+                with lock:
+                    results.append((table_number, outcome))
+                connections.close_all()
+
+        threads = [threading.Thread(target=scan, args=(i % self.TABLES,)) for i in range(customers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), customers)
+        for table_number in range(self.TABLES):
+            statuses = Counter(code for number, code in results if number == table_number)
+            self.assertEqual(statuses, {201: 1, 409: self.CUSTOMERS_PER_TABLE - 1})
+        self.assertEqual(CustomerSession.objects.filter(restaurant=self.restaurant).count(), self.TABLES)
+        self.assertEqual(Table.objects.filter(restaurant=self.restaurant, occupied=True).count(), self.TABLES)
+
+    # Every connection opened until the test ends, the main thread's included, uses the copy
+    def use_file_database(self):
+        memory_name = connection.settings_dict['NAME']
+        # the in-memory database only lives as long as a connection to it
+        keep_alive = sqlite3.connect(memory_name, uri=True)
+        self.addCleanup(keep_alive.close)
+        # back on the in-memory database before keep_alive is closed
+        self.addCleanup(connection.ensure_connection)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'seating.sqlite3')
+        with closing(sqlite3.connect(path)) as copy:
+            keep_alive.backup(copy)
+        # a thread's connection is made from the same settings dict
+        self.enterContext(mock.patch.dict(connection.settings_dict, {'NAME': path, 'OPTIONS': {'timeout': 30}}))
+        connection.close()
+        self.addCleanup(connections.close_all)
+
+class ExplainHotQueriesTest(TestCase):
+    def test_no_sequential_scans(self):
+        out = StringIO()
+        call_command('explain_hot_queries', restaurants=20, tables=5, stdout=out, stderr=StringIO())
+        self.assertIn('No sequential scans', out.getvalue())
+        # the seeded data is rolled back
+        self.assertFalse(Restaurant.objects.exists())
+
+    def test_sequential_scans_are_detected(self):
+        postgres = 'Nested Loop\n  ->  Seq Scan on "WMS_MAIN_orderitem"  (cost=0.00..35.50 rows=10 width=4)\n  ->  Index Scan using x on "WMS_MAIN_order"'
+        self.assertEqual(sequential_scans(postgres), ['"WMS_MAIN_orderitem"'])
+        sqlite = '2 0 0 SCAN WMS_MAIN_orderitem\n5 0 0 SEARCH WMS_MAIN_order USING INTEGER PRIMARY KEY (rowid=?)'
+        self.assertEqual(sequential_scans(sqlite), ['WMS_MAIN_orderitem'])
+        self.assertEqual(sequential_scans('3 0 0 SEARCH WMS_MAIN_table USING INDEX t (restaurant_id=?)'), [])
+
+# Every restaurant has a table 1, the table filters of the order feeds must only ever
+# see the caller's restaurant and cost the same however many restaurants there are
+class MultiTenantTableFilterTest(TestCase):
+    def setUp(self):
+        self.restaurant = Restaurant.objects.create(name='home', location='home')
+        user = User.objects.create_user(username='staff@gmail.com', password='testpassword')
+        RestaurantUser.objects.create(user=user, restaurant=self.restaurant)
+        self.staff = APIClient()
+        self.staff.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+        Table.objects.bulk_create([Table(restaurant=self.restaurant, number=number) for number in range(3)])
+        menu_item = MenuItem.objects.create(name='steamed hams', description='mmm', price=1, preparation_time=1, restaurant=self.restaurant)
+
+        self.customer = APIClient()
+        self.customer.post('/api/customer/', {'restaurant': self.restaurant.id, 'table_number': 1}, format='json')
+        self.customer.post('/api/placeorder/', {'order_items': [{'menu_item': menu_item.id, 'quantity': 2}]}, format='json')
+        self.order = Order.objects.get()
+        self.seeded = 0
+
+    # other restaurants with an order of 2 order items at their table 1
+    def seed_restaurants(self, count):
+        for i in range(count):
+            restaurant = Restaurant.objects.create(name=f'other {self.seeded}', location='other')
+            menu_item = MenuItem.objects.create(name='other hams', description='mmm', price=1, preparation_time=1, restaurant=restaurant)
+            Table.objects.create(restaurant=restaurant, number=1, occupied=True)
+            customer_session = CustomerSession.objects.create(restaurant=restaurant, table_number=1, session=f'other-{self.seeded}')
+            order = Order.objects.create(customer_session=customer_session)
+            OrderItem.objects.bulk_create([OrderItem(order=order, menu_item=menu_item) for _ in range(2)])
+            self.seeded += 1
+
+    def feeds(self):
+        return [self.staff.get('/api/orders/', {'table_number': 1}), self.customer.get('/api/orderitems/')]
+
+    def test_only_own_restaurant(self):
+        self.seed_restaurants(5)
+        staff_orders, customer_items = self.feeds()
+        self.assertEqual([order['order_id'] for order in staff_orders.json()], [self.order.id])
+        self.assertEqual(len(staff_orders.json()[0]['order_items']), 2)
+        self.assertEqual({item['order_item']['order'] for item in customer_items.json()}, {self.order.id})
+        self.assertEqual(len(customer_items.json()), 2)
+
+    def test_bounded_query_plan(self):
+        self.seed_restaurants(2)
+        # warm the token cache
+        self.feeds()
+        with CaptureQueriesContext(connection) as few:
+            self.feeds()
+        self.seed_restaurants(30)
+        with CaptureQueriesContext(connection) as many:
+            self.feeds()
+        self.assertEqual(len(few.captured_queries), len(many.captured_queries))
+
+        for query in many.captured_queries:
+            if query['sql'].startswith('SELECT'):
+                self.assertEqual(sequential_scans(query_plan(query['sql'])), [], query['sql'])
+
+# The plan of a captured query. Sequential scans are disabled on PostgreSQL, so that one
+# only shows up in the plan if no index can serve the query, whatever the table sizes
+def query_plan(sql):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}')
+        return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+
+class CachedTokenAuthenticationTest(ManagerMixin, TestCase):
+    def setUp(self):
+        self.register_manager(tables=0)
+
+    def token_queries(self, path):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path)
+        return response, [query for query in context.captured_queries if 'authtoken_token' in query['sql']]
+
+    def test_token_resolved_once(self):
+        response, queries = self.token_queries('/api/updatetables/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # the token, user, restaurant user and restaurant in one query
+        self.assertLessEqual(len(queries), 1)
+        response, queries = self.token_queries('/api/updatetables/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(queries, [])
+
+    def test_logout_invalidates(self):
+        self.client.get('/api/updatetables/')
+        self.assertEqual(self.client.post('/api/logout/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/api/updatetables/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_role_change_invalidates(self):
+        self.assertEqual(self.client.post('/api/updatetables/', {'num': 1, 'list': True}, format='json').status_code, status.HTTP_200_OK)
+        restaurant_user = RestaurantUser.objects.get(user__username='testuser@gmail.com')
+        restaurant_user.user_role = 'Wait'
+        restaurant_user.save()
+        response = self.client.post('/api/updatetables/', {'num': 1, 'list': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_ttl_cache(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        # 'b' was the least recently used
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        cache.delete_where(lambda value: value == 3)
+        self.assertIsNone(cache.get('c'))
+
+        expired = TTLCache(maxsize=2, ttl=0)
+        expired.set('a', 1)
+        self.assertIsNone(expired.get('a'))
+
+class TenantContextTest(ManagerMixin, TestCase):
+    def setUp(self):
+        self.register_manager(tables=2)
+        self.category = self.client.post('/api/categories/', {'name': 'Soup'}, format='json').data['pk']
+
+        self.customer = APIClient()
+        self.customer.post('/api/customer/', {'restaurant': self.restaurant.id, 'table_number': 1}, format='json')
+
+    def test_customer_restaurant_resolved_once(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.customer.get(f'/api/categories/{self.category}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # the session, the customer session (with its restaurant) and the category
+        self.assertEqual(len(context.captured_queries), 3)
+
+    def test_roles(self):
+        # customers and wait staff can read but not change the menu
+        response = self.customer.patch(f'/api/categories/{self.category}/', {'name': 'Salad'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        response = self.client.post('/api/staffregister/', {'email': 'waitstaff@gmail.com', 'password': 'doubleupthepower', 'user_role': 'Wait'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        wait = APIClient()
+        response = wait.post('/api/login/', {'username': 'waitstaff@gmail.com', 'password': 'doubleupthepower'}, format='json')
+        wait.credentials(HTTP_AUTHORIZATION='Token ' + response.data['token'])
+        self.assertEqual(wait.get(f'/api/categories/{self.category}/').status_code, status.HTTP_200_OK)
+        response = wait.patch(f'/api/categories/{self.category}/', {'name': 'Salad'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.data['detail'], 'You are not a manager.')
+
+        response = self.client.patch(f'/api/categories/{self.category}/', {'name': 'Salad'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_other_restaurant(self):
+        other = APIClient()
+        data = {'email': 'other@gmail.com', 'password': 'testpassword', 'name': 'other', 'location': 'other', 'table_numbers': {}}
+        response = other.post('/api/register/', data, format='json')
+        other.credentials(HTTP_AUTHORIZATION='Token ' + response.data['token'])
+        self.assertEqual(other.get(f'/api/categories/{self.category}/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(other.delete(f'/api/categories/{self.category}/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(APIClient().get('/api/categories/').status_code, status.HTTP_404_NOT_FOUND)
+
+class EmailOutboxTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        User.objects.create_user(username='testuser@gmail.com', email='testuser@gmail.com', password='testpassword')
+
+    def test_password_reset_queued(self):
+        response = self.client.post('/api/password_reset/', {'email': 'testuser@gmail.com'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # nothing is sent inside the request
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual((email.status, email.to), ('PENDING', ['testuser@gmail.com']))
+
+        call_command('send_emails', '--once', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['testuser@gmail.com'])
+        # the html alternative and the two inline images
+        self.assertEqual(len(mail.outbox[0].alternatives), 1)
+        self.assertEqual(len(mail.outbox[0].attachments), 2)
+        self.assertEqual(OutgoingEmail.objects.get().status, 'SENT')
+
+    @override_settings(
+        EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1', EMAIL_PORT=1,
+        EMAIL_USE_TLS=False, EMAIL_TIMEOUT=1, EMAIL_OUTBOX_MAX_ATTEMPTS=2,
+    )
+    def test_retries_and_dead_letters(self):
+        enqueue_email('subject', 'body', ['testuser@gmail.com'])
+        self.assertEqual(send_batch(), 1)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), ('PENDING', 1))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        # not due yet
+        self.assertEqual(send_batch(), 0)
+
+        OutgoingEmail.objects.update(next_attempt_at=timezone.now())
+        send_batch()
+        email = OutgoingEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), ('DEAD', 2))
+        self.assertIn('ConnectionRefusedError', email.last_error)
+
+        self.assertEqual(retry_dead_emails(), 1)
+        self.assertEqual(OutgoingEmail.objects.get().status, 'PENDING')
+
+    def test_batch_leased_while_sending(self):
+        enqueue_email('subject', 'body', ['testuser@gmail.com'])
+        leases = []
+
+        def send(message):
+            # other workers don't see the email as due while it's sent
+            leases.append(OutgoingEmail.objects.filter(next_attempt_at__lte=timezone.now()).exists())
+            return 1
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=send):
+            self.assertEqual(send_batch(), 1)
+        self.assertEqual(leases, [False])
+        self.assertEqual(OutgoingEmail.objects.get().status, 'SENT')
+
+    def test_worker_survives_database_errors(self):
+        enqueue_email('subject', 'body', ['testuser@gmail.com'])
+        with mock.patch('WMS_MAIN.management.commands.send_emails.send_batch', side_effect=[OperationalError('restarting'), 1, 0]), \
+                mock.patch('WMS_MAIN.management.commands.send_emails.time.sleep'), \
+                self.assertLogs('WMS_MAIN.management.commands.send_emails', 'ERROR'):
+            call_command('send_emails', '--once', stdout=StringIO())
+
+# Local stand-in for a psycopg2 connection
+class RecordingConnection:
+    def __init__(self):
+        self.closed = 0
+        self.rollbacks = 0
+        self.info = SimpleNamespace(transaction_status=TRANSACTION_STATUS_IDLE)
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.info.transaction_status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+class ConnectionPoolTest(TestCase):
+    def test_connections_reused(self):
+        pool = ConnectionPool(max_size=2, timeout=1, max_idle=60, max_lifetime=60)
+        first = pool.getconn(RecordingConnection)
+        pool.putconn(first)
+        self.assertIs(pool.getconn(RecordingConnection), first)
+        pool.putconn(first)
+
+        # given back in a transaction
+        first = pool.getconn(RecordingConnection)
+        first.info.transaction_status = TRANSACTION_STATUS_INTRANS
+        pool.putconn(first)
+        self.assertEqual(first.rollbacks, 1)
+        self.assertIs(pool.getconn(RecordingConnection), first)
+        pool.putconn(first)
+
+        # failing the health check
+        second = pool.getconn(RecordingConnection, check=lambda connection: False)
+        self.assertIsNot(second, first)
+        self.assertTrue(first.closed)
+        pool.putconn(second)
+
+        pool.close()
+        self.assertTrue(second.closed)
+
+    def test_limit(self):
+        pool = ConnectionPool(max_size=1, timeout=0.05, max_idle=60, max_lifetime=60)
+        connection = pool.getconn(RecordingConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.getconn(RecordingConnection)
+        pool.putconn(connection)
+        self.assertIs(pool.getconn(RecordingConnection), connection)
+
+    def test_expiry(self):
+        pool = ConnectionPool(max_size=2, timeout=1, max_idle=60, max_lifetime=0)
+        connection = pool.getconn(RecordingConnection)
+        pool.putconn(connection)
+        self.assertTrue(connection.closed)
+        self.assertIsNot(pool.getconn(RecordingConnection), connection)
+
+class LoadTestTest(TestCase):
+    def test_dinner_rush(self):
+        restaurant_id, = seed(restaurants=1, tables=4, orders=2)
+        self.assertEqual(OrderItem.objects.filter(order__customer_session__restaurant_id=restaurant_id).count(), 2 * 2 * 3)
+        # seeded like the app would have made it
+        self.assertEqual(repair_menu_positions(restaurant_id), 0)
+        self.assertEqual(list(Table.objects.filter(restaurant_id=restaurant_id).order_by('number').values_list('number', flat=True)), [0, 1, 2, 3])
+
+        recorder = Recorder()
+        with self.captureOnCommitCallbacks(execute=True):
+            dinner_rush(restaurant_id, recorder)
+        recorder.stop()
+        results = report(recorder)
+        self.assertEqual(results['errors'], 0)
+        self.assertEqual(
+            sorted(results['endpoints']),
+            ['allorders/', 'bill/', 'customer/', 'orderitems/<pk>/', 'placeorder/', 'staff-ending-customer/'],
+        )
+        self.assertEqual(results['endpoints']['customer/']['requests'], 2)
+        # the rush's tables were cleared
+        self.assertFalse(Table.objects.filter(restaurant_id=restaurant_id, number__gte=2, occupied=True).exists())
+
+        flush()
+        self.assertFalse(Restaurant.objects.filter(id=restaurant_id).exists())
+
+    def test_refuses_postgres(self):
+        for command in ('seed_load_test', 'load_test'):
+            with mock.patch(f'WMS_MAIN.management.commands.{command}.disposable_database', return_value=False):
+                with self.assertRaisesMessage(CommandError, 'pass --yes'):
+                    call_command(command, stdout=StringIO())
+        self.assertFalse(Restaurant.objects.exists())
+
+        with mock.patch('WMS_MAIN.management.commands.seed_load_test.disposable_database', return_value=False):
+            call_command('seed_load_test', restaurants=1, tables=2, orders=1, yes=True, stdout=StringIO())
+        self.assertEqual(len(load_test_restaurants()), 1)
+
+@override_settings(INSTRUMENTATION_ENABLED=True)
+class InstrumentationTest(ManagerMixin, TestCase):
+    def setUp(self):
+        instrumentation.reset()
+        self.register_manager()
+        self.cust_client = APIClient()
+        self.cust_client.post('/api/customer/', {'restaurant': self.restaurant.id, 'table_number': 1}, format='json')
+        staff = User.objects.create_user(username='staff@gmail.com', password='testpassword', is_staff=True)
+        self.staff_token = Token.objects.create(user=staff).key
+        self.staff_client = APIClient()
+        self.staff_client.credentials(HTTP_AUTHORIZATION='Token ' + self.staff_token)
+
+    def test_stats(self):
+        with self.assertLogs('WMS_MAIN.instrumentation', 'INFO') as logs:
+            response = self.cust_client.get('/api/menu/')
+        # the query counts are for staff only
+        self.assertNotIn('Server-Timing', response)
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((line['view'], line['status']), ('menu', 200))
+        self.assertEqual(line['bytes'], len(response.content))
+
+        # staff only, the statistics are every restaurant's
+        self.assertEqual(self.cust_client.get('/api/stats/').status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get('/api/stats/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertNotIn('Server-Timing', response)
+        response = self.staff_client.get('/api/stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertRegex(response['Server-Timing'], r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries, \d+ duplicated", render;dur=[\d.]+$')
+        self.assertEqual(response.data['menu']['requests'], 1)
+        self.assertGreater(response.data['poc-session']['mean_queries'], 0)
+
+    def test_n_plus_one_logged(self):
+        def view(request):
+            for _ in range(settings.INSTRUMENTATION_SIMILAR_QUERIES):
+                Restaurant.objects.filter(id=self.restaurant.id).exists()
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        request.user = User(is_staff=True)
+        with self.assertLogs('WMS_MAIN.instrumentation', 'WARNING') as logs:
+            response = instrumentation.InstrumentationMiddleware(view)(request)
+        self.assertIn(f'{settings.INSTRUMENTATION_SIMILAR_QUERIES - 1} duplicated', response['Server-Timing'])
+        self.assertEqual(json.loads(logs.records[0].getMessage())['times'], settings.INSTRUMENTATION_SIMILAR_QUERIES)
+        self.assertEqual(instrumentation.snapshot()['<unresolved>']['n_plus_one_requests'], 1)
+
+    @override_settings(INSTRUMENTATION_ENABLED=False)
+    def test_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            instrumentation.InstrumentationMiddleware(lambda request: HttpResponse())
+        # a new client loads the middleware again
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        response = client.get('/api/menu/')
+        self.assertNotIn('Server-Timing', response)
+        client.credentials(HTTP_AUTHORIZATION='Token ' + self.staff_token)
+        response = client.get('/api/stats/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertNotIn('Server-Timing', response)
+
+@override_settings(METRICS_TOKEN='scrape')
+class MetricsTest(ManagerMixin, TestCase):
+    def setUp(self):
+        metrics.REGISTRY.clear()
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir, ignore_errors=True)
+        self.enterContext(override_settings(METRICS_DIR=metrics_dir))
+        self.register_manager()
+        self.cust_client = APIClient()
+        category = Category.objects.create(name='mains', restaurant=self.restaurant)
+        self.menu_item = MenuItem.objects.create(name='steamed hams', description='mmm', price=12.99, category=category, preparation_time=1, restaurant=self.restaurant)
+        self.cust_client.post('/api/customer/', {'restaurant': self.restaurant.id, 'table_number': 1}, format='json')
+
+    def scrape(self):
+        response = APIClient().get('/api/metrics/', HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_kitchen_and_floor(self):
+        self.cust_client.post('/api/placeorder/', {'order_items': [{'menu_item': self.menu_item.id, 'quantity': 1}]}, format='json')
+        order_item = OrderItem.objects.get()
+        OrderItem.objects.filter(pk=order_item.pk).update(updated_at=timezone.now() - timedelta(seconds=90))
+        self.client.patch(f'/api/orderitems/{order_item.pk}/', {'status': 'PREPARED'}, format='json')
+        self.client.patch(f'/api/orderitems/{order_item.pk}/', {'status': 'SERVED'}, format='json')
+
+        self.cust_client.post('/api/tableassistancewithoutparams/')
+        CustomerSession.objects.update(assistance_requested_at=timezone.now() - timedelta(seconds=45))
+        self.client.delete('/api/tableassistancewithoutparams/', {'table_number': 1}, format='json')
+        self.assertIsNone(CustomerSession.objects.get().assistance_requested_at)
+
+        text = self.scrape()
+        self.assertIn(f'wms_orders_placed_total{{restaurant="{self.restaurant.id}"}} 1\n', text)
+        self.assertIn(f'wms_active_customer_sessions{{restaurant="{self.restaurant.id}"}} 1\n', text)
+        # 90 seconds waiting to be prepared
+        self.assertIn('wms_order_item_transition_seconds_bucket{from_status="ORDER SENT",to_status="PREPARED",le="60"} 0\n', text)
+        self.assertIn('wms_order_item_transition_seconds_bucket{from_status="ORDER SENT",to_status="PREPARED",le="120"} 1\n', text)
+        self.assertIn('wms_order_item_transition_seconds_count{from_status="PREPARED",to_status="SERVED"} 1\n', text)
+        self.assertIn('wms_assistance_wait_seconds_bucket{le="30"} 0\n', text)
+        self.assertIn('wms_assistance_wait_seconds_bucket{le="60"} 1\n', text)
+        self.assertIn('wms_http_request_duration_seconds_count{route="place-order",method="POST",status="200"} 1\n', text)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test', ['path'], buckets=[1, 5])
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value, path='a"b')
+        self.assertEqual(histogram.expose(), [
+            '# HELP test_seconds Test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{path="a\\"b",le="1"} 2',
+            'test_seconds_bucket{path="a\\"b",le="5"} 3',
+            'test_seconds_bucket{path="a\\"b",le="+Inf"} 4',
+            'test_seconds_sum{path="a\\"b"} 14.5',
+            'test_seconds_count{path="a\\"b"} 4',
+        ])
+        with self.assertRaises(ValueError):
+            histogram.observe(1)
+
+    def test_workers_summed(self):
+        metrics.ORDERS_PLACED.inc(restaurant=1)
+        metrics.ASSISTANCE_WAIT.observe(20)
+        # a running worker and one that's gone
+        gone = subprocess.Popen(['true'])
+        gone.wait()
+        for pid in (os.getppid(), gone.pid):
+            Path(settings.METRICS_DIR, f'{pid}-worker.json').write_text(json.dumps({
+                'wms_orders_placed_total': [[['1'], 2]],
+                'wms_assistance_wait_seconds': [[[], [[0, 1] + [0] * 10, 20]]],
+                'removed_metric': [[[], 1]],
+            }))
+
+        for _ in range(2):
+            text = self.scrape()
+            self.assertIn('wms_orders_placed_total{restaurant="1"} 5\n', text)
+            self.assertIn('wms_assistance_wait_seconds_bucket{le="30"} 3\n', text)
+            self.assertIn('wms_assistance_wait_seconds_sum 60\n', text)
+            self.assertNotIn('removed_metric', text)
+        # folded into the retired workers' file
+        self.assertFalse(Path(settings.METRICS_DIR, f'{gone.pid}-worker.json').exists())
+        self.assertTrue(Path(settings.METRICS_DIR, metrics.RETIRED).exists())
+
+    def test_token(self):
+        self.assertEqual(APIClient().get('/api/metrics/').status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.client.get('/api/metrics/').status_code, status.HTTP_401_UNAUTHORIZED)
+        with self.settings(METRICS_TOKEN=None):
+            self.assertEqual(APIClient().get('/api/metrics/', HTTP_AUTHORIZATION='Bearer scrape').status_code, status.HTTP_404_NOT_FOUND)
@@ -1,5 +1,5 @@
 from django.urls import path, include
-from . import views, stripe_views
+from . import views, stripe_views, event_views
 
 from django.conf import settings
 from django.conf.urls.static import static
@@ -21,6 +21,8 @@ urlpatterns = [
     path('tableassistance/', views.AssistanceAPIView.as_view(), name="table-assistance"),
     path('tableassistancewithoutparams/', views.AssistanceWithoutParamsView.as_view(), name="table-assistance-without-params"),
     path('stafftableassistance/', views.StaffViewingAssistanceView.as_view(), name="staff-viewing-table-assistance"),
+    # server-sent events for staff screens
+    path('events/', event_views.event_stream, name='event-stream'),
     #path('password/reset/', views.PasswordResetRequest.as_view(), name='password-reset-request'),
     #path('password/reset/confirm/<uidb64>/<token>/', PasswordResetConfirmView.as_view(), name='password_reset_confirm'),
     path('allorders/', views.AllOrdersList.as_view(), name="all-orders"),
@@ -40,12 +42,19 @@ urlpatterns = [
     path('categories/<int:pk>/', views.CategoryDetail.as_view(), name="category-detail"),
     path('menuitems/', views.MenuItemList.as_view(), name="menuitem-list"),
     path('menuitems/<int:pk>/', views.MenuItemDetail.as_view(), name="menuitem-detail"),
+    # GET domain/api/menu/ - Gets the whole menu, categories with their menu items (supports If-None-Match)
+    path('menu/', views.MenuSnapshot.as_view(), name="menu"),
+    # GET domain/api/stats/ - Per view request statistics of every restaurant, for staff users only (INSTRUMENTATION=1)
+    path('stats/', views.InstrumentationStats.as_view(), name="instrumentation-stats"),
+    # GET domain/api/metrics/ - Operational metrics in Prometheus' text format (METRICS_TOKEN bearer token)
+    path('metrics/', views.Metrics.as_view(), name="metrics"),
 
     path('customer/', views.CustomerSession.as_view(), name='poc-session'),
     path('staff-ending-customer/', views.StaffEndingSession.as_view(), name='staff-ending-customer'),
 
-    path('v1/accounts/', stripe_views.StripeAccountExpress.as_view(), name='stripe-express-account'),
-    path('v1/account_links/', stripe_views.StripeAccountLink.as_view(), name='stripe-account-link'),
-    path('v1/account_check/', stripe_views.StripeAccountDetailsStatus.as_view(), name='stripe-account-details'),
-    path('v1/checkout/', stripe_views.StripeCheckout.as_view(), name='stripe-checkout'),
+    path('v1/accounts/', stripe_views.stripe_account_express, name='stripe-express-account'),
+    path('v1/account_links/', stripe_views.stripe_account_link, name='stripe-account-link'),
+    path('v1/account_check/', stripe_views.stripe_account_details_status, name='stripe-account-details'),
+    path('v1/checkout/', stripe_views.stripe_checkout, name='stripe-checkout'),
+    path('v1/webhook/', stripe_views.stripe_webhook, name='stripe-webhook'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file
@@ -1,4 +1,5 @@
 from django.conf import settings
+import hmac
 from typing import Any
 from django.forms import ValidationError
 from django.http.response import HttpResponse as HttpResponse
@@ -10,15 +11,25 @@ from django.http import HttpRequest, JsonResponse, QueryDict
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, generics
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.exceptions import AuthenticationFailed, PermissionDenied, NotFound
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
-from rest_framework.authentication import SessionAuthentication, TokenAuthentication
+from rest_framework.authentication import SessionAuthentication
+from .authentication import CachedTokenAuthentication
 from stripe import Customer
 from .serializers import CategorySerializer, OrderSerializer, OrderItemSerializer, CombinedRegistrationSerializer, MenuItemSerializer, StaffRegisterSerializer, TableSerializer, TablesNeedingAssistanceSerializer, CustomerSession as CustomerSessionSerializer
 from .models import Category, Order, OrderItem, Restaurant, MenuItem, RestaurantUser, CustomerSession as CustomerSessionModel
+from .feeds import FeedCursor, build_order_feed
+from .billing import bill_response_data, table_order_items
+from .menus import bump_menu_version, menu_response
+from .positions import delete_category, delete_menu_item
+from .customers import get_customer_session, set_customer_session, set_need_assistance
+from .tenants import TenantMixin
+from .tables import add_tables, delete_free_table, free_table, next_table_number, parse_table_number, seat_table, table_exists
+from . import events, instrumentation, metrics
 from django.utils import timezone
+from django.db import IntegrityError, transaction
 from rest_framework.parsers import JSONParser
 
 # An APIView that handles manager registration
@@ -117,12 +128,12 @@ class LoginAPIView(APIView):
 #   - Returns status 200 on success
 #   - Returns error status 401 for non authenticated users        
 class LogoutAPIView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
         # simply delete the token to force a logout
-        request.user.auth_token.delete()
+        request.auth.delete()
         return Response(status=status.HTTP_200_OK)
 
 # Checks the database whether a restaurant with the 
@@ -165,15 +176,11 @@ class ValidRestaurantAPIView(APIView):
 #         - Returns an error message if the user is not authenticated
 class RestaurantDetails(APIView):
     def get(self, request):
-        if sessionKey := request.session.session_key:
-            try:
-                cs = CustomerSessionModel.objects.get(session=sessionKey)
+        if request.session.session_key:
+            if cs := get_customer_session(request):
                 restaurant = cs.restaurant
                 return Response({'name': restaurant.name, 'location': restaurant.location, 'table_number': cs.table_number}, status=status.HTTP_200_OK)
-            except CustomerSessionModel.DoesNotExist:
-                return Response(status=404, data={'message': "You're customer session has ended already."})
-            except CustomerSessionModel.MultipleObjectsReturned:
-                return Response(status=500)
+            return Response(status=404, data={'message': "You're customer session has ended already."})
         if user := self.request.user:
             restaurant = user.restaurantuser.restaurant
             return Response({'name': restaurant.name, 'location': restaurant.location}, status=status.HTTP_200_OK)
@@ -251,19 +258,15 @@ class UpdateTableList(APIView):
         role = user.restaurantuser.user_role
         if role == 'manager':
             restaurant = user.restaurantuser.restaurant
-            current_table_numbers = restaurant.table_numbers or {}
-            tables_to_add = request.data.get('num')
+            num = parse_table_number(request.data.get('num'))
+            if num is None:
+                return Response({'error': 'Invalid table number'}, status=status.HTTP_400_BAD_REQUEST)
             if request.data.get('list'):
-                current_size = len(current_table_numbers)
-                for i in range(current_size, current_size + tables_to_add):
-                    current_table_numbers[i] = False
-                restaurant.table_numbers = current_table_numbers
-                restaurant.save()
+                first = next_table_number(restaurant.id)
+                add_tables(restaurant.id, range(first, first + num))
                 return Response(status=status.HTTP_200_OK)
             elif not request.data.get('list'):
-                table_number = request.data.get('num')
-                restaurant.table_numbers[table_number] = False
-                restaurant.save()
+                add_tables(restaurant.id, [num])
                 return Response(status=status.HTTP_200_OK)
         return Response({'error': 'Unauthorized role'}, status=status.HTTP_401_UNAUTHORIZED)
 
@@ -281,15 +284,11 @@ class UpdateTableList(APIView):
         role = user.restaurantuser.user_role
         if role == 'manager':
             restaurant = user.restaurantuser.restaurant
-            current_table_numbers = restaurant.table_numbers or {}
-            table_number = str(request.data.get('num'))
-            if table_number in current_table_numbers:
-                if current_table_numbers[table_number] == True:
-                    return Response({'error': 'Table is occupied'}, status=status.HTTP_400_BAD_REQUEST)
-                del current_table_numbers[table_number]
-                restaurant.table_numbers = current_table_numbers
-                restaurant.save()
+            table_number = parse_table_number(request.data.get('num'))
+            if delete_free_table(restaurant.id, table_number):
                 return Response(status=status.HTTP_200_OK)
+            elif table_exists(restaurant.id, table_number):
+                return Response({'error': 'Table is occupied'}, status=status.HTTP_400_BAD_REQUEST)
             else:
                 return Response({'error': 'Table number does not exist'}, status=status.HTTP_400_BAD_REQUEST)
         return Response({'error': 'Unauthorized role'}, status=status.HTTP_401_UNAUTHORIZED)
@@ -301,6 +300,9 @@ class UpdateTableList(APIView):
 #     - Requires 'categoryId' and 'menuItems' in request data
 # Response:
 #     - Status 200: Successful update of menu item positions
+#     - Status 400: Bad Request
+#         - Returns an error message if the positions are not exactly 1 to the number of menu items given,
+#           or if not every menu item of the category is given
 #     - Status 401: Unauthorized
 #         - Returns an error message if the user is not authenticated
 #     - Status 404: Not Found
@@ -322,14 +324,12 @@ class UpdateMenuItemPosition(APIView):
         if hasattr(user, "restaurantuser"):
             restaurant_instance = user.restaurantuser.restaurant
             category_id = request.data.get('categoryId')
-            menu_list = request.data.get('menuItems')
-            for item in menu_list:
-                try:
-                    menu_item = MenuItem.objects.get(restaurant=restaurant_instance, category__id=category_id, id=item['menuItemId'])
-                except MenuItem.DoesNotExist:
-                    raise NotFound("Menu Item not found")
-                menu_item.position = item['newPosition']
-                menu_item.save()
+            menu_items = MenuItem.objects.filter(restaurant=restaurant_instance, category__id=category_id)
+            try:
+                positions = parse_positions(request.data.get('menuItems'), 'menuItemId')
+                apply_positions(menu_items, positions, restaurant_instance.id, "Menu Item not found")
+            except ValidationError as error:
+                return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
             return Response(status=status.HTTP_200_OK)
         return Response(status=status.HTTP_401_UNAUTHORIZED)
 
@@ -341,6 +341,9 @@ class UpdateMenuItemPosition(APIView):
 #     - Requires 'categories' in request data, each containing 'categoryId' and 'newPosition'
 # Response:
 #     - Status 200: Successful update of category positions
+#     - Status 400: Bad Request
+#         - Returns an error message if the positions are not exactly 1 to the number of categories given,
+#           or if not every category of the restaurant is given
 #     - Status 401: Unauthorized
 #         - Returns an error message if the user is not authenticated
 #     - Status 404: Not Found
@@ -360,17 +363,47 @@ class UpdateCategoryPosition(APIView):
         user = self.request.user
         if hasattr(user, "restaurantuser"):
             restaurant_instance = user.restaurantuser.restaurant
-            category_list = request.data.get('categories')
-            for item in category_list:
-                try:
-                    category = Category.objects.get(restaurant=restaurant_instance, id=item['categoryId'])
-                except Category.DoesNotExist:
-                    raise NotFound("Category does not exist")
-                category.position = item['newPosition']
-                category.save()
+            categories = Category.objects.filter(restaurant=restaurant_instance)
+            try:
+                positions = parse_positions(request.data.get('categories'), 'categoryId')
+                apply_positions(categories, positions, restaurant_instance.id, "Category does not exist")
+            except ValidationError as error:
+                return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
             return Response(status=status.HTTP_200_OK)
         return Response(status=status.HTTP_401_UNAUTHORIZED)
 
+# Parses a reorder request's [{id_key: 1, 'newPosition': 2}, ...] into {1: 2, ...}
+# The new positions have to be exactly 1 to the number of entries, without duplicates or gaps
+def parse_positions(entries, id_key):
+    if not isinstance(entries, list) or not entries:
+        raise ValidationError('A list of new positions is required')
+    try:
+        positions = {int(entry[id_key]): int(entry['newPosition']) for entry in entries}
+    except (KeyError, TypeError, ValueError):
+        raise ValidationError('Invalid position entry')
+    if len(positions) != len(entries):
+        raise ValidationError('Duplicate ids')
+    if sorted(positions.values()) != list(range(1, len(entries) + 1)):
+        raise ValidationError('Positions must be 1 to the number of entries without duplicates or gaps')
+    return positions
+
+# Checks the reorder covers exactly the rows of the queryset, the whole category or restaurant
+# (one query), and writes all of the new positions with a single UPDATE in a transaction.
+# A reorder of only some of the rows would leave them sharing positions with the others
+def apply_positions(queryset, positions, restaurant_id, not_found_message):
+    with transaction.atomic():
+        instances = list(queryset.select_for_update())
+        ids = {instance.id for instance in instances}
+        if not ids.issuperset(positions):
+            raise NotFound(not_found_message)
+        if len(ids) != len(positions):
+            raise ValidationError('The new positions have to include every one of them')
+        for instance in instances:
+            instance.position = positions[instance.id]
+        queryset.model.objects.bulk_update(instances, ['position'])
+        # bulk_update does not send the signals that invalidate the menu snapshot
+        bump_menu_version(restaurant_id)
+
 # Endpoint to list all staff members associated with the restaurant.
 # Request:
 #     - Method: GET
@@ -414,8 +447,8 @@ class AssistanceAPIView(APIView):
             q = CustomerSessionModel.objects.get(restaurant=restaurant_id, table_number=table_number)
             # Checks for valid session or valid staff account
             if request.session.session_key == q.session or hasattr(request.user, 'restaurantuser'):
-                q.need_assistance = not q.need_assistance
-                q.save()
+                set_need_assistance(q, not q.need_assistance)
+                events.publish(q.restaurant_id, events.ASSISTANCE, table_number=q.table_number, need_assistance=q.need_assistance)
                 return Response(status=status.HTTP_200_OK)
             else:
                 return Response({'error': 'Invalid session or staff'}, status=status.HTTP_401_UNAUTHORIZED)
@@ -452,18 +485,16 @@ class AssistanceAPIView(APIView):
 #     - Status 404: Not Found
 #         - Returns an error message if a customer session or the requested table is not found
 class AssistanceWithoutParamsView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def post(self, request):
-        try:
-            if q := CustomerSessionModel.objects.get(session=request.session.session_key):
-                if (q.need_assistance):
-                    return Response(status=200, data={'message': "You already have a call for assistance in progress. We'll be with you shortly."}) 
-                q.need_assistance = True
-                q.save()
-                return Response(status=201, data={'message': "Your call for assistance has been sent. We'll be with you shortly."}) 
-        except CustomerSessionModel.DoesNotExist:
-            return Response(status=401, data={'message': 'You are not in a customer session at the moment.'})
+        if q := get_customer_session(request):
+            if (q.need_assistance):
+                return Response(status=200, data={'message': "You already have a call for assistance in progress. We'll be with you shortly."}) 
+            set_need_assistance(q, True)
+            events.publish(q.restaurant_id, events.ASSISTANCE, table_number=q.table_number, need_assistance=True)
+            return Response(status=201, data={'message': "Your call for assistance has been sent. We'll be with you shortly."}) 
+        return Response(status=401, data={'message': 'You are not in a customer session at the moment.'})
 
     def delete(self, request):
         '''
@@ -477,8 +508,8 @@ class AssistanceWithoutParamsView(APIView):
             if cs.need_assistance == False:
                 return Response(status=404, data={'message': "Customer doesn't need assistance."})
             else:
-                cs.need_assistance = False
-                cs.save()
+                set_need_assistance(cs, False)
+                events.publish(cs.restaurant_id, events.ASSISTANCE, table_number=cs.table_number, need_assistance=False)
                 return Response(status=204, data={'message': "Successfully reassigned customer's assistance status."})
         except CustomerSessionModel.DoesNotExist:
             return Response(status=404, data={'message': "Customer Session was not found. Please ask for another table."})
@@ -493,7 +524,7 @@ class AssistanceWithoutParamsView(APIView):
 #     - Status 401: Unauthorized
 #         - Returns an error message if authentication fails    
 class StaffViewingAssistanceView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def get(self, request):
         restaurant = request.user.restaurantuser.restaurant.pk
@@ -507,7 +538,7 @@ class StaffViewingAssistanceView(APIView):
 
 class AllOrdersList(generics.ListAPIView):
     serializer_class = OrderSerializer
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     def get_queryset(self):
         user = self.request.user
@@ -517,44 +548,35 @@ class AllOrdersList(generics.ListAPIView):
             restaurant = user.restaurantuser.restaurant
             return Order.objects.filter(customer_session__restaurant=restaurant).order_by('id')
         
+    # Builds the whole feed in a constant number of queries (see feeds.py)
+    # Accepts ?since=<cursor> to only return the orders changed since the last poll
     def list(self, request):
-        queryset = self.get_queryset()
-        if not queryset.exists():
-            return Response([], status=status.HTTP_200_OK)
-
-        order_list = []
-        for order in queryset:
-            order_serializer = OrderSerializer(order)
-            order_items = OrderItem.objects.filter(order=order).order_by('menu_item__name')
-            item_serializer = OrderItemSerializer(order_items, many=True)
-            order_data = {
-                'order': order_serializer.data,
-                'order_items': item_serializer.data,
-                'table_number': order.customer_session.table_number,
-                'order_id': order.id
-            }
-            order_list.append(order_data)
-
-        return Response(order_list, status=status.HTTP_200_OK)
+        cursor = FeedCursor(request)
+        order_list = build_order_feed(cursor.changed_orders(self.get_queryset()))
+        deleted = []
+        if hasattr(request.user, 'restaurantuser'):
+            deleted = cursor.deleted('order', restaurant=request.user.restaurantuser.restaurant_id)
+        return cursor.response(order_list, deleted)
 
 class OrderList(generics.ListAPIView):
     serializer_class = OrderSerializer
     
     def get_queryset(self):
         user = self.request.user
-        if not hasattr(user, "restaurantuser"): # Customer placing order - filter order objects of customer session's table number
-            session = self.request.session.session_key
-            try:
-                cs = CustomerSession.objects.get(session=session)
-                return Order.objects.filter(cs).order_by('id')
-            except CustomerSessionModel.DoesNotExist:
-                return Response(status=404, data={'message': "Customer Session was not found. Please ask for another table."})
+        self.customer_session = None
+        self.table_number = None
+        if not hasattr(user, "restaurantuser"): # Customer placing order - filter order objects of customer session
+            self.customer_session = get_customer_session(self.request)
+            if self.customer_session is None:
+                return Order.objects.none()
+            return Order.objects.filter(customer_session=self.customer_session).order_by('id')
         else: # Staff member / manager has restaurantuser field - filter order objects of given table number
-            table_number = self.request.query_params.get('table_number')
-            restaurant = user.restaurantuser.restaurant
-            if table_number == None or str(table_number) not in restaurant.table_numbers.keys():
+            table_number = parse_table_number(self.request.query_params.get('table_number'))
+            restaurant_id = user.restaurantuser.restaurant_id
+            if not table_exists(restaurant_id, table_number):
                 return Order.objects.none()
-            return Order.objects.filter(customer_session__table_number=table_number).order_by('id')
+            self.table_number = table_number
+            return Order.objects.filter(customer_session__restaurant_id=restaurant_id, customer_session__table_number=table_number).order_by('id')
         
     def list(self, request):
         '''
@@ -566,119 +588,129 @@ class OrderList(generics.ListAPIView):
             'table_number': table number
             'order_id': order_id
         }
+        Accepts ?since=<cursor> to only return the orders changed since the last poll (see feeds.py)
         '''
-        queryset = self.get_queryset()
-        if not queryset.exists():
-            return Response([], status=status.HTTP_200_OK)
+        cursor = FeedCursor(request)
+        queryset = cursor.changed_orders(self.get_queryset())
 
         user = request.user
-        order_list = []
+        deleted = []
         if hasattr(user, 'restaurantuser'):
-            table_number = self.request.query_params.get('table_number')
-            for order in queryset:
-                order_serializer = OrderSerializer(order)
-                order_items = OrderItem.objects.filter(order=order).order_by('menu_item__name')
-                item_serializer = OrderItemSerializer(order_items, many=True)
-                order_data = {
-                    'order': order_serializer.data,
-                    'order_items': item_serializer.data,
-                    'table_number': table_number,
-                    'order_id': order.id
-                }
-                order_list.append(order_data)
+            order_list = build_order_feed(queryset)
+            if self.table_number is not None:
+                deleted = cursor.deleted('order', restaurant=user.restaurantuser.restaurant_id, table_number=self.table_number)
         else:
             order_list = OrderSerializer(queryset, many=True).data
+            if cs := self.customer_session:
+                deleted = cursor.deleted('order', restaurant=cs.restaurant_id, table_number=cs.table_number)
 
-        return Response(order_list, status=status.HTTP_200_OK)
+        return cursor.response(order_list, deleted)
 
-class OrderDetail(generics.RetrieveUpdateDestroyAPIView):
+class OrderDetail(TenantMixin, generics.RetrieveUpdateDestroyAPIView):
     serializer_class = OrderSerializer
 
     def get_queryset(self):
-        user = self.request.user
-        if not hasattr(user, "restaurantuser"):
-            session = self.request.session.session_key
-            return Order.objects.filter(customer_session__session=session)
+        if self.tenant.restaurant_user is None:
+            return Order.objects.filter(customer_session=self.tenant.customer_session)
         else:
-            restaurant = user.restaurantuser.restaurant
-            return Order.objects.filter(customer_session__restaurant=restaurant)
+            return Order.objects.filter(customer_session__restaurant_id=self.tenant.restaurant_id)
     
     def get_object(self, request):
         pass
     
     def perform_update(self, serializer):
         instance = serializer.instance
-        user = self.request.user
-        if not hasattr(user, "restaurantuser"):
+        if self.tenant.restaurant_user is None:
             raise ValidationError("You are not logged in.")
+        elif self.tenant.restaurant_id != instance.customer_session.restaurant_id:
+            raise ValidationError("Access denied")
         else:
-            restaurant = user.restaurantuser.restaurant
-            if restaurant.id != instance.restaurant.id:
-                raise ValidationError("Access denied")
-            else:
-                serializer.save()
+            serializer.save()
 
     def perform_destroy(self, instance):
-        user = self.request.user
-        if not hasattr(user, "restaurantuser"):
+        if self.tenant.restaurant_user is None:
             raise ValidationError("You are not logged in.")
+        elif self.tenant.restaurant_id != instance.customer_session.restaurant_id:
+            raise ValidationError("Access denied")
         else:
-            restaurant = user.restaurantuser.restaurant
-            if restaurant.id != instance.restaurant.id:
-                raise ValidationError("Access denied")
-            else:
-                instance.delete()
+            instance.delete()
 
-class CategoryList(generics.ListCreateAPIView):
+class CategoryList(TenantMixin, generics.ListCreateAPIView):
     serializer_class = CategorySerializer
-    authentication_classes = [SessionAuthentication, TokenAuthentication]
+    authentication_classes = [SessionAuthentication, CachedTokenAuthentication]
 
     def get_queryset(self):
-        user = self.request.user
-        if not hasattr(user, 'restaurantuser'):
-            try:
-                restaurant = CustomerSessionModel.objects.get(session=self.request.session.session_key).restaurant
-            except CustomerSessionModel.DoesNotExist:
-                raise NotFound("Customer Session not found, cannot find restaurant")
-        else:
-            restaurant = user.restaurantuser.restaurant
-        if not Restaurant.objects.filter(id=restaurant.id).exists():
-            raise ValidationError("Invalid restaurant")
-        else:
-            return Category.objects.filter(restaurant=restaurant).order_by('position')
+        return Category.objects.filter(restaurant=self.get_restaurant_id()).order_by('position')
+
+    # served from the restaurant's cached menu snapshot (see menus.py)
+    def list(self, request, *args, **kwargs):
+        return menu_response(request, self.get_restaurant_id(), 'categories')
 
     # wrapping the ListCreateAPIView's post request with a modification to the request to have the restaurant data passed in
     def post(self, request, *args, **kwargs):
-        user = request.user
-        if not hasattr(user, 'restaurantuser'):
-            raise PermissionDenied("You are not a staff member.")
-        elif user.restaurantuser.user_role != "manager":
-            raise AuthenticationFailed("You are not a manager.")
-        else:
-            restaurant = user.restaurantuser.restaurant
-            request.data['restaurant'] = restaurant.id
-            return super().post(request, *args, **kwargs)
+        self.check_manager("You are not a staff member.")
+        request.data['restaurant'] = self.tenant.restaurant_id
+        return super().post(request, *args, **kwargs)
+
+# The whole menu of the staff member's or customer's restaurant
+# Request:
+#     - Method: GET
+#     - Requires a customer session or staff token
+# Response:
+#     - Status 200: {'version': 1718000000000000000, 'categories': [{...category, 'menu_items': [...]}, ...], 'uncategorised': [...]}
+#       with categories and their menu items sorted by position
+#     - Status 304: if the If-None-Match header matches the menu's ETag
+#     - Status 404: if the customer session was not found
+class MenuSnapshot(TenantMixin, APIView):
+    authentication_classes = [SessionAuthentication, CachedTokenAuthentication]
+
+    def get(self, request):
+        return menu_response(request, self.get_restaurant_id(), 'menu')
+
+# Per view request statistics of this worker process, see instrumentation.py
+# Request:
+#     - Method: GET
+#     - Requires a staff user's session or token, the statistics cover every restaurant
+# Response:
+#     - Status 200: {'all-orders': {'requests': 120, 'p50_ms': 8.1, 'mean_queries': 3.0, ...}, ...}
+#     - Status 403: if the user isn't staff
+#     - Status 404: if the instrumentation is disabled (settings.INSTRUMENTATION_ENABLED)
+class InstrumentationStats(APIView):
+    authentication_classes = [SessionAuthentication, CachedTokenAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        if not settings.INSTRUMENTATION_ENABLED:
+            return Response({'error': 'Instrumentation is disabled'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(instrumentation.snapshot())
+
+# Operational metrics of all the host's worker processes in Prometheus' text format, see metrics.py
+# Request:
+#     - Method: GET
+#     - Requires the header Authorization: Bearer <settings.METRICS_TOKEN>
+# Response:
+#     - Status 200: the metrics, e.g. wms_orders_placed_total{restaurant="1"} 42
+#     - Status 401: if the token is missing or wrong
+#     - Status 404: if the metrics are disabled or METRICS_TOKEN isn't set
+class Metrics(APIView):
+    authentication_classes = []
+    permission_classes = [AllowAny]
 
-class CategoryDetail(generics.RetrieveUpdateDestroyAPIView):
+    def get(self, request):
+        if not settings.METRICS_ENABLED or not settings.METRICS_TOKEN:
+            return Response({'error': 'Metrics are disabled'}, status=status.HTTP_404_NOT_FOUND)
+        expected = f'Bearer {settings.METRICS_TOKEN}'
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected.encode()):
+            return Response({'error': 'Invalid metrics token'}, status=status.HTTP_401_UNAUTHORIZED)
+        return HttpResponse(metrics.REGISTRY.expose(metrics.STORE.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class CategoryDetail(TenantMixin, generics.RetrieveUpdateDestroyAPIView):
     serializer_class = CategorySerializer
-    authentication_classes = [SessionAuthentication, TokenAuthentication]
+    authentication_classes = [SessionAuthentication, CachedTokenAuthentication]
 
-    # queryset is all Category instances belonging to the restaurant of the User
+    # queryset is all Category instances belonging to the restaurant of the staff member or customer
     def get_queryset(self):
-        # get the restaurant of the staff member or customer
-        user = self.request.user
-        if not hasattr(user, 'restaurantuser'):
-            try:
-                restaurant = CustomerSessionModel.objects.get(session=self.request.session.session_key).restaurant
-            except CustomerSessionModel.DoesNotExist:
-                raise NotFound("Customer Session not found, cannot find restaurant")
-        else:
-            restaurant = user.restaurantuser.restaurant
-        # check the restaurant exists
-        if not Restaurant.objects.filter(id=restaurant.id).exists():
-            raise ValidationError('Invalid restaurant')
-        else:
-            return Category.objects.filter(restaurant=restaurant)
+        return Category.objects.filter(restaurant=self.get_restaurant_id())
 
     def get_serializer(self, *args, **kwargs): # line 66 of mixins.py (UpdateModelMixin)
         # remove the restaurant from data so that we can't change which restaurant the category belongs to
@@ -689,44 +721,12 @@ class CategoryDetail(generics.RetrieveUpdateDestroyAPIView):
 
     # override to ensure that we have a manager AND that the instance belongs to the restaurant of the manager
     def perform_update(self, serializer):
-        instance = serializer.instance
-        user = self.request.user
-        if not hasattr(user, "restaurantuser"):
-            raise PermissionDenied("You are not logged in.")
-        elif user.restaurantuser.user_role != "manager":
-            raise AuthenticationFailed("You are not a manager.")
-        else:
-            restaurant = user.restaurantuser.restaurant
-            if restaurant.id != instance.restaurant.id:
-                raise AuthenticationFailed("Access denied")
-            else:
-                serializer.save()
+        self.check_manager_of(serializer.instance.restaurant_id)
+        serializer.save()
 
     def perform_destroy(self, instance):
-        user = self.request.user
-        if not hasattr(user, "restaurantuser"):
-            raise PermissionDenied("You are not logged in.")
-        elif user.restaurantuser.user_role != "manager":
-            raise AuthenticationFailed("You are not a manager.")
-        else:
-            restaurant = user.restaurantuser.restaurant
-            if restaurant.id != instance.restaurant.id:
-                raise AuthenticationFailed("Access denied")
-            else:
-                self.update_position(instance)
-                instance.delete()
-    
-    def update_position(self, instance):
-        restaurant = instance.restaurant
-        for i in range(instance.position + 1, restaurant.num_categories + 1):
-            try:
-                category = Category.objects.get(restaurant=restaurant, position=i)
-            except Category.DoesNotExist:
-                raise NotFound("Category Does not exist")
-            category.position -= 1
-            category.save()
-        restaurant.num_categories -= 1
-        restaurant.save()
+        self.check_manager_of(instance.restaurant_id)
+        delete_category(instance)
 
 class OrderItemList(generics.ListCreateAPIView):
     serializer_class = OrderItemSerializer
@@ -740,213 +740,196 @@ class OrderItemList(generics.ListCreateAPIView):
         # print('reached')
         user = self.request.user
         if not hasattr(user, "restaurantuser"):
-            session = self.request.session.session_key
-            try:
-                table_number = CustomerSessionModel.objects.get(session=session).table_number
-            except CustomerSessionModel.DoesNotExist:
+            self.customer_session = get_customer_session(self.request)
+            if self.customer_session is None:
                 raise NotFound("Customer Session not found, cannot find table number")
-            return OrderItem.objects.filter(order__customer_session__table_number=table_number).order_by('order__id')
+            return table_order_items(self.customer_session.restaurant_id, self.customer_session.table_number).order_by('order__id')
         else:
             restaurant = user.restaurantuser.restaurant
             return OrderItem.objects.filter(order__customer_session__restaurant=restaurant).order_by('order__id')
         
+    # Accepts ?since=<cursor> to only return the order items changed since the last poll (see feeds.py)
     def list(self, request):
-        queryset = self.get_queryset()
-        if not queryset.exists():
-            return Response([], status=status.HTTP_200_OK)
+        cursor = FeedCursor(request)
+        queryset = cursor.changed(self.get_queryset())
         
         user = request.user
         order_item_list = []
         if not hasattr(user, 'restaurantuser'):
-            for item in queryset:
+            for item in queryset.select_related('order'):
                 order_data = {
                     'order_item': OrderItemSerializer(item).data,
                     'order_time': item.order.order_time
                 }
                 order_item_list.append(order_data)
+            cs = self.customer_session
+            deleted = cursor.deleted('orderitem', restaurant=cs.restaurant_id, table_number=cs.table_number)
         else:
             order_item_list = OrderItemSerializer(queryset, many=True).data
+            deleted = cursor.deleted('orderitem', restaurant=user.restaurantuser.restaurant_id)
         
-        return Response(order_item_list, status=status.HTTP_200_OK)
+        return cursor.response(order_item_list, deleted)
         
-class OrderItemDetail(generics.UpdateAPIView):
+class OrderItemDetail(TenantMixin, generics.UpdateAPIView):
     serializer_class = OrderItemSerializer
 
     def get_queryset(self):
-        user = self.request.user
-        if not hasattr(user, "restaurantuser"):
-            session = self.request.session.session_key
-            OrderItem.objects.filter(order__customer_session__session=session)
+        if self.tenant.restaurant_user is None:
+            return OrderItem.objects.filter(order__customer_session=self.tenant.customer_session)
         else:
-            restaurant = user.restaurantuser.restaurant
-            return OrderItem.objects.filter(order__customer_session__restaurant=restaurant)
+            return OrderItem.objects.filter(order__customer_session__restaurant_id=self.tenant.restaurant_id)
         
     def perform_update(self, serializer):
         instance = serializer.instance
-        user = self.request.user
         # you're not a staff
-        if not hasattr(user, "restaurantuser"):
+        if self.tenant.restaurant_user is None:
             raise PermissionDenied("You are not logged in.")
         else:
-            restaurant = user.restaurantuser.restaurant
+            restaurant_id = self.tenant.restaurant_id
             new_status = serializer.validated_data.get('status')
 
-            if instance.order.customer_session.restaurant != restaurant:
+            if instance.order.customer_session.restaurant_id != restaurant_id:
                 raise AuthenticationFailed('Access denied')
             
             if new_status == 'SERVED':
                 if instance.status != 'PREPARED':
                     raise ValidationError('Order item must be prepared before serving')
             
+            previous_status, previous_updated_at = instance.status, instance.updated_at
             serializer.save(status=new_status)
+            if new_status and new_status != previous_status:
+                metrics.ORDER_ITEM_TRANSITION.observe(
+                    (instance.updated_at - previous_updated_at).total_seconds(), from_status=previous_status, to_status=new_status,
+                )
+            events.publish(restaurant_id, events.ORDER_ITEM_STATUS, order_item=instance.id, order=instance.order_id, status=new_status)
         
+# Places an order for the customer session's table
+# Request:
+#   - order_items (list) => [{'menu_item': 1, 'quantity': 2}, ...]
+# Response:
+#   - Status 200 if the order was placed
+#   - Status 400 with {'error': ...} if a menu item is not on the restaurant's menu, a quantity is invalid
+#     or above settings.ORDER_MAX_QUANTITY, or there are more than settings.ORDER_MAX_LINES lines,
+#     nothing is created in that case
+#   - Status 401 if the caller is not in a customer session
+# All lines are validated against one query for the menu items and the order and its
+# order items (one per unit, the kitchen updates the status of each unit) are written
+# in one transaction with a single bulk insert
 class PlaceOrderAPIView(APIView):
     authentication_classes = [SessionAuthentication]
 
     def post(self, request):
-        session = request.session.session_key
-        if not CustomerSessionModel.objects.filter(session=session):
+        session_obj = get_customer_session(request)
+        if session_obj is None:
             return Response({'error': 'Invalid customer session'}, status=status.HTTP_401_UNAUTHORIZED)
-        try:
-            session_obj = CustomerSessionModel.objects.get(session=session)
-        except CustomerSessionModel.DoesNotExist:
-            raise NotFound("Customer Session not found")
 
         order_items = request.data.get('order_items')
         if not order_items:
             return Response({'error': 'Order items required'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        order = Order.objects.create(customer_session=session_obj, order_time=timezone.now())
-        for item in order_items:
-            menu_item_pk = item['menu_item']
-            quantity = item['quantity']
 
-            try:
-                self.is_valid(menu_item_pk, quantity)
-            except ValidationError as error:
-                return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
-            
-            try:
-                menu_item_instance = MenuItem.objects.get(pk=menu_item_pk)
-            except MenuItem.DoesNotExist:
-                raise NotFound("Selected Menu item does not exist")
-            for _ in range(quantity):
-                OrderItem.objects.create(order=order, menu_item=menu_item_instance)
-        
+        try:
+            lines = self.parse_order_items(order_items, session_obj.restaurant_id)
+        except ValidationError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            order = Order.objects.create(customer_session=session_obj, order_time=timezone.now())
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, menu_item_id=menu_item_pk)
+                for menu_item_pk, quantity in lines
+                for _ in range(quantity)
+            ], batch_size=500)
+
+        metrics.ORDERS_PLACED.inc(restaurant=session_obj.restaurant_id)
+        events.publish(session_obj.restaurant_id, events.ORDER_PLACED, order_id=order.id, table_number=session_obj.table_number)
         return Response({'message': 'Order has been placed successfully'}, status=status.HTTP_200_OK)
-    
-    def is_valid(self, menu_item, quantity):
-        if not MenuItem.objects.filter(pk=menu_item):
+
+    # Validates every line against the restaurant's menu and returns [(menu_item_pk, quantity), ...]
+    def parse_order_items(self, order_items, restaurant_id):
+        if not isinstance(order_items, list) or len(order_items) > settings.ORDER_MAX_LINES:
+            raise ValidationError(f'An order has at most {settings.ORDER_MAX_LINES} lines')
+        try:
+            menu_item_pks = [int(item['menu_item']) for item in order_items]
+        except (KeyError, TypeError, ValueError):
             raise ValidationError('Invalid menu item')
-        elif int(quantity) <= 0:
-            raise ValidationError('Invalid quantity')
+        on_menu = set(MenuItem.objects.filter(restaurant_id=restaurant_id, pk__in=menu_item_pks).values_list('id', flat=True))
 
+        lines = []
+        for menu_item_pk, item in zip(menu_item_pks, order_items):
+            if menu_item_pk not in on_menu:
+                raise ValidationError('Invalid menu item')
+            try:
+                quantity = int(item.get('quantity'))
+            except (TypeError, ValueError):
+                raise ValidationError('Invalid quantity')
+            if quantity <= 0 or quantity > settings.ORDER_MAX_QUANTITY:
+                raise ValidationError('Invalid quantity')
+            lines.append((menu_item_pk, quantity))
+        return lines
+
+# The bill of the customer session's table, see billing.py for the response
 class BillAPIView(APIView):
     permission_classes = [AllowAny]
 
     def get(self, request):
-        session = self.request.session.session_key
-        try:
-            session_instance = CustomerSessionModel.objects.get(session=session)
-        except CustomerSessionModel.DoesNotExist:
+        session_instance = get_customer_session(request)
+        if session_instance is None:
             raise NotFound("Customer Session not found")
         table_number = session_instance.table_number
-        restaurant_instance = session_instance.restaurant
-        orders = OrderItem.objects.filter(order__customer_session__table_number=table_number, order__customer_session__restaurant=restaurant_instance)
+        bill = bill_response_data(session_instance.restaurant_id, table_number)
 
-        if not orders:
+        if bill is None:
             raise ValidationError('No orders found for table ', table_number)
-        bill_total = sum(item.menu_item.price for item in orders)
-
-        sort_orders = orders.order_by('menu_item__name')
-        order_list = OrderItemSerializer(sort_orders, many=True).data
-
-        return Response({
-            'table_number': table_number,
-            'order_list': order_list,
-            'bill_total': bill_total,
-        })
+        return Response(bill)
     
+# The bill of the table given by the table_number query parameter, see billing.py for the response
 class StaffBillAPIView(APIView):
     permission_classes = [AllowAny]
 
     def get(self, request):
         user = self.request.user
-        restaurant = user.restaurantuser.restaurant
+        restaurant = user.restaurantuser.restaurant_id
         table_number = request.query_params.get('table_number')
-        orders = OrderItem.objects.filter(order__customer_session__table_number=table_number, order__customer_session__restaurant=restaurant)
+        bill = bill_response_data(restaurant, table_number)
 
-        if not orders:
+        if bill is None:
             raise ValidationError('No orders found for table ', table_number)
-        bill_total = sum(item.menu_item.price for item in orders)
+        return Response(bill)
 
-        sort_orders = orders.order_by('menu_item__name')
-        order_list = OrderItemSerializer(sort_orders, many=True).data
 
-        return Response({
-            'table_number': table_number,
-            'order_list': order_list,
-            'bill_total': bill_total,
-        })
-
-
-class MenuItemList(generics.ListCreateAPIView):
+class MenuItemList(TenantMixin, generics.ListCreateAPIView):
     serializer_class = MenuItemSerializer
-    authentication_classes = [SessionAuthentication, TokenAuthentication]
+    authentication_classes = [SessionAuthentication, CachedTokenAuthentication]
 
     def get_queryset(self):
-        user = self.request.user
-        if not hasattr(user, 'restaurantuser'):
-            try:
-                restaurant = CustomerSessionModel.objects.get(session=self.request.session.session_key).restaurant
-            except CustomerSessionModel.DoesNotExist:
-                raise NotFound("Customer Session not found, cannot find restaurant")
-        else:
-            restaurant = user.restaurantuser.restaurant
-        if not Restaurant.objects.filter(id=restaurant.id).exists():
-            raise ValidationError("Invalid restaurant")
-        else:
-            return MenuItem.objects.filter(restaurant=restaurant)
+        return MenuItem.objects.filter(restaurant=self.get_restaurant_id())
+
+    # served from the restaurant's cached menu snapshot (see menus.py)
+    def list(self, request, *args, **kwargs):
+        return menu_response(request, self.get_restaurant_id(), 'menu_items')
 
     # overriding later in the stack
     def create(self, request, *args, **kwargs):
-        user = request.user
-        if not hasattr(user, 'restaurantuser'):
-            raise PermissionDenied("You are not a staff member.")
-        elif user.restaurantuser.user_role != "manager":
-            raise AuthenticationFailed("You are not a manager.")
+        self.check_manager("You are not a staff member.")
+        if (isinstance(request.data, QueryDict)):
+            extended_data = QueryDict('', mutable=True)
+            extended_data.update(request.data)
+            extended_data['restaurant'] = self.tenant.restaurant_id
         else:
-            restaurant = user.restaurantuser.restaurant
-            if (isinstance(request.data, QueryDict)):
-                extended_data = QueryDict('', mutable=True)
-                extended_data.update(request.data)
-                extended_data['restaurant'] = restaurant.id
-            else:
-                extended_data = request.data
-            serializer = self.get_serializer(data=extended_data)
-            serializer.is_valid(raise_exception=True)
-            self.perform_create(serializer)
-            headers = self.get_success_headers(serializer.data)
-            return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-
-class MenuItemDetail(generics.RetrieveUpdateDestroyAPIView):
+            extended_data = request.data
+        serializer = self.get_serializer(data=extended_data)
+        serializer.is_valid(raise_exception=True)
+        self.perform_create(serializer)
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+class MenuItemDetail(TenantMixin, generics.RetrieveUpdateDestroyAPIView):
     serializer_class = MenuItemSerializer
-    authentication_classes = [SessionAuthentication, TokenAuthentication]
+    authentication_classes = [SessionAuthentication, CachedTokenAuthentication]
     parser_classes = [JSONParser]
 
     def get_queryset(self):
-        user = self.request.user
-        if not hasattr(user, 'restaurantuser'):
-            try:
-                restaurant = CustomerSessionModel.objects.get(session=self.request.session.session_key).restaurant
-            except CustomerSessionModel.DoesNotExist:
-                raise NotFound("Customer Session not found, cannot find restaurant")
-        else:
-            restaurant = user.restaurantuser.restaurant
-        if not Restaurant.objects.filter(id=restaurant.id).exists():
-            raise ValidationError("Invalid restaurant")
-        else:
-            return MenuItem.objects.filter(restaurant=restaurant)
+        return MenuItem.objects.filter(restaurant=self.get_restaurant_id())
 
     def get_serializer(self, *args, **kwargs): # line 66 of mixins.py (UpdateModelMixin)
         # remove the restaurant from data so that we can't change which restaurant the menuitem belongs to
@@ -956,57 +939,18 @@ class MenuItemDetail(generics.RetrieveUpdateDestroyAPIView):
         return super().get_serializer(*args, **kwargs)
 
     def perform_update(self, serializer):
-        instance = serializer.instance
-        user = self.request.user
-        # you're not a staff
-        if not hasattr(user, "restaurantuser"):
-            raise PermissionDenied("You are not logged in.")
-        # you're not a manager
-        elif user.restaurantuser.user_role != "manager":
-            raise AuthenticationFailed("You are not a manager.")
-        # other checks
-        else:
-            restaurant = user.restaurantuser.restaurant
-            # the instance doesn't belong to you
-            if restaurant.id != instance.restaurant.id:
-                raise AuthenticationFailed("Access denied")
-            # attempting to change category
-            if newCategory := serializer.validated_data.get('category'):
-                # the newCategory exists
-                # if newCategory := Category.objects.get(id=newCategoryId):
-                # it doesn't belong to the manager
-                if not Category.objects.filter(id=newCategory.id).exists():
-                    raise ValidationError("The new category doesn't exist.")
-                elif newCategory.restaurant != restaurant:
-                    raise AuthenticationFailed("Attempting to change the category to another restaurant's.")
-            serializer.save()
+        # you're not a manager of the instance's restaurant
+        self.check_manager_of(serializer.instance.restaurant_id)
+        # attempting to change category, the serializer has already checked that it exists
+        if newCategory := serializer.validated_data.get('category'):
+            # it doesn't belong to the manager
+            if newCategory.restaurant_id != self.tenant.restaurant_id:
+                raise AuthenticationFailed("Attempting to change the category to another restaurant's.")
+        serializer.save()
 
     def perform_destroy(self, instance):
-        user = self.request.user
-        if not hasattr(user, "restaurantuser"):
-            raise PermissionDenied("You are not logged in.")
-        elif user.restaurantuser.user_role != "manager":
-            raise AuthenticationFailed("You are not a manager.")
-        else:
-            restaurant = user.restaurantuser.restaurant
-            if restaurant.id != instance.restaurant.id:
-                raise AuthenticationFailed("Access denied")
-            else:
-                self.update_position(instance)
-                instance.delete()
-    
-    def update_position(self, instance):
-        category = instance.category
-        restaurant = instance.restaurant
-        for i in range(instance.position + 1, category.num_menu_items + 1):
-            try:
-                menu_item = MenuItem.objects.get(restaurant=restaurant, category=category, position=i)
-            except MenuItem.DoesNotExist:
-                raise NotFound("MenuItem Does not exist")
-            menu_item.position -= 1
-            menu_item.save()
-        category.num_menu_items -= 1
-        category.save()
+        self.check_manager_of(instance.restaurant_id)
+        delete_menu_item(instance)
 
 class CustomerSession(APIView):
     authentication_classes = [SessionAuthentication]
@@ -1023,42 +967,42 @@ class CustomerSession(APIView):
             request.session.create()
         
         session = request.session.session_key
-        table_number = request.data.get('table_number')
+        table_number = parse_table_number(request.data.get('table_number'))
         restaurant_id = request.data.get('restaurant')
         try:
             restaurant_instance = Restaurant.objects.get(pk=restaurant_id)
         except Restaurant.DoesNotExist:
             raise NotFound(f"Restaurant with id {restaurant_id} not found")
-        
-        # check if the table inside of restaurant_instance is available
-        if tn := restaurant_instance.table_numbers.get(str(table_number)): # string conversion because json doesn't allow keys to be strings
-            return Response(status=409, data={'Conflict': 'Your input table number is currently in use. By Restaurant instance.'})
-        elif tn == None:
-            return Response(status=404, data={'Not Found': "Your input table number isn't in the restaurant's available table numbers."})
 
-        # if there's an existing order instance associated with their table
-        try: 
-            if q := CustomerSessionModel.objects.get(restaurant=restaurant_id, table_number=table_number):
-                # it belongs to them
-                if q.session == session:
-                    # Update table occupancy state
-                    if str(table_number) in restaurant_instance.table_numbers.keys():
-                        restaurant_instance.table_numbers[str(table_number)] = True
-                        restaurant_instance.save()
-                    return Response(status=200, data={'Success': 'Reconnected to your existing session.'})
-                # it doesn't
-                else:
+        # a session is seated at one table at a time
+        if current := get_customer_session(request):
+            if current.restaurant_id != restaurant_instance.id or current.table_number != table_number:
+                return Response(status=409, data={'Conflict': 'Your session is already seated at another table.'})
+            # Update table occupancy state
+            if seat_table(restaurant_instance.id, table_number):
+                events.publish(restaurant_instance.id, events.TABLE_OCCUPANCY, table_number=table_number, occupied=True)
+            return Response(status=200, data={'Success': 'Reconnected to your existing session.'})
+
+        # Seating is one transactional claim of the table. The conditional UPDATE of the table's
+        # row is the first write, so concurrent claims of the same table queue on its row lock
+        # and only the first one finds it free, the others fall through to the checks below
+        with transaction.atomic():
+            if seat_table(restaurant_instance.id, table_number):
+                try:
+                    with transaction.atomic():
+                        customer_session = CustomerSessionModel.objects.create(table_number=table_number, restaurant=restaurant_instance, session=session)
+                except IntegrityError:
+                    # the table was marked free while another customer session still holds it
+                    transaction.set_rollback(True)
                     return Response(status=409, data={'Conflict': "Your input table number is currently in use. By CustomerSession instance."})
-        except CustomerSessionModel.DoesNotExist:
-            pass
+                set_customer_session(request, customer_session)
+                events.publish(restaurant_instance.id, events.TABLE_OCCUPANCY, table_number=table_number, occupied=True)
+                return Response(status=201)
 
-        # they don't have an order instance
-        CustomerSessionModel.objects.create(table_number=table_number, restaurant=restaurant_instance, session=session) 
-        # Update table occupancy state
-        if str(table_number) in restaurant_instance.table_numbers.keys():
-            restaurant_instance.table_numbers[str(table_number)] = True
-            restaurant_instance.save()
-        return Response(status=201)
+        # the table is occupied or doesn't exist
+        if not table_exists(restaurant_instance.id, table_number):
+            return Response(status=404, data={'Not Found': "Your input table number isn't in the restaurant's available table numbers."})
+        return Response(status=409, data={'Conflict': 'Your input table number is currently in use. By Restaurant instance.'})
 
     # end a customer session
     def delete(self, request):
@@ -1075,23 +1019,20 @@ class CustomerSession(APIView):
         session = request.session.session_key
         if session:
             # delete it if it exists
-            try:
-                cs = CustomerSessionModel.objects.get(session=session)
-            except CustomerSessionModel.DoesNotExist:
+            cs = get_customer_session(request)
+            if cs is None:
                 return Response(status=404)
-            except CustomerSessionModel.MultipleObjectsReturned:
-                return Response(status=500)
 
             # get the table number of the customer
             table_number = cs.table_number
             # get the restaurant of the customer
             restaurant = cs.restaurant
             # change the table status of the restaurant so that the customer's table is available
-            tables = restaurant.table_numbers
-            tables[str(table_number)] = False
-            restaurant.save()
+            free_table(restaurant.id, table_number)
 
             cs.delete() # should trigger cascade removing orders and order items
+            set_customer_session(request, None)
+            events.publish(restaurant.id, events.TABLE_OCCUPANCY, table_number=table_number, occupied=False)
             return Response(status=200)
         else:
             # indicate that the response
@@ -1105,25 +1046,23 @@ class CustomerSession(APIView):
         otherwise 404
         '''
         if request.session.session_key:
-            q = CustomerSessionModel.objects.filter(session=request.session.session_key)
             # if there is a
-            if q:
+            if get_customer_session(request):
                 return Response(status=200)
             else:
                 return Response(status=404)
         return Response(status=404)
 
 class StaffEndingSession(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     def delete(self, request):
         table_number = request.data.get('table_number')
         restaurant = request.user.restaurantuser.restaurant
         try:
             cs = CustomerSessionModel.objects.get(table_number=table_number, restaurant=restaurant)
-            tables = restaurant.table_numbers
-            tables[str(table_number)] = False
-            restaurant.save()
+            free_table(restaurant.id, cs.table_number)
             cs.delete()
+            events.publish(restaurant.id, events.TABLE_OCCUPANCY, table_number=cs.table_number, occupied=False)
             return Response(status=200)
         except CustomerSessionModel.DoesNotExist:
             return Response(status=404)